@@ -0,0 +1,266 @@
+# In memory stand-ins for the AWS services the pipeline talks to
+# S3 (get_object, also conditional, put_object, list_objects_v2 and
+# delete_objects), SQS (send, receive, delete and change visibility in
+# batches) and Secrets Manager (get_secret_value). install() puts a
+# boto3 stand-in into sys.modules, which the lambda code picks up because it
+# imports boto3 inside the functions that need it. Only for load tests, the
+# stand-ins implement just the calls the pipeline makes
+import collections
+import hashlib
+import io
+import itertools
+import json
+import sys
+import threading
+import time
+import types
+
+
+class StubCounters():
+    '''API calls per service and operation'''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = collections.Counter()
+
+    def count(self, service, operation):
+        with self.lock:
+            self.calls['%s.%s' % (service, operation)] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.calls)
+
+
+class StubClientError(Exception):
+    '''Looks like a botocore ClientError to code that checks the code'''
+    def __init__(self, code, message):
+        Exception.__init__(self, "An error occurred (%s): %s" % (code, message))
+        self.response = {'Error': {'Code': code, 'Message': message}}
+
+
+class StubS3Client():
+    def __init__(self, stubs):
+        self.stubs = stubs
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None):
+        self.stubs.counters.count('s3', 'get_object')
+        try:
+            data = self.stubs.objects[(Bucket, Key)]
+        except KeyError:
+            raise StubClientError('NoSuchKey', "s3://%s/%s" % (Bucket, Key))
+        etag = '"%s"' % hashlib.md5(data).hexdigest()
+        if IfNoneMatch == etag:
+            raise StubClientError('304', 'Not Modified')
+        return {'Body': io.BytesIO(data), 'ContentLength': len(data), 'ETag': etag}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.stubs.counters.count('s3', 'put_object')
+        if isinstance(Body, str):
+            Body = Body.encode('utf-8')
+        self.stubs.put_object(Bucket, Key, Body)
+        return {'ETag': '"%s"' % hashlib.md5(Body).hexdigest()}
+
+    def list_objects_v2(self, Bucket, Prefix='', Delimiter=None, ContinuationToken=None, MaxKeys=1000):
+        self.stubs.counters.count('s3', 'list_objects_v2')
+        with self.stubs.lock:
+            keys = sorted([key for bucket, key in self.stubs.objects if bucket == Bucket and key.startswith(Prefix)])
+        contents, prefixes = [], []
+        for key in keys:
+            rest = key[len(Prefix):]
+            if Delimiter and Delimiter in rest:
+                common = Prefix + rest.split(Delimiter, 1)[0] + Delimiter
+                if common not in prefixes:
+                    prefixes.append(common)
+            else:
+                contents.append({'Key': key, 'Size': len(self.stubs.objects[(Bucket, key)])})
+
+        # Pages of MaxKeys entries, the token is the offset
+        entries = [('Contents', content) for content in contents] + [('CommonPrefixes', {'Prefix': prefix}) for prefix in prefixes]
+        start = int(ContinuationToken or 0)
+        page = entries[start:start + MaxKeys]
+        response = {
+            'Contents': [entry for kind, entry in page if kind == 'Contents'],
+            'CommonPrefixes': [entry for kind, entry in page if kind == 'CommonPrefixes'],
+            'IsTruncated': start + MaxKeys < len(entries),
+        }
+        if response['IsTruncated']:
+            response['NextContinuationToken'] = str(start + MaxKeys)
+        return response
+
+    def delete_objects(self, Bucket, Delete):
+        self.stubs.counters.count('s3', 'delete_objects')
+        with self.stubs.lock:
+            for entry in Delete['Objects']:
+                self.stubs.objects.pop((Bucket, entry['Key']), None)
+        return {'Deleted': Delete['Objects']}
+
+
+class StubSecretsManagerClient():
+    def __init__(self, stubs):
+        self.stubs = stubs
+
+    def get_secret_value(self, SecretId):
+        self.stubs.counters.count('secretsmanager', 'get_secret_value')
+        return {'Name': SecretId, 'SecretString': json.dumps(self.stubs.secrets[SecretId])}
+
+
+class StubSqsClient():
+    def __init__(self, stubs):
+        self.stubs = stubs
+
+    def get_queue_url(self, QueueName):
+        self.stubs.counters.count('sqs', 'get_queue_url')
+        return {'QueueUrl': self.stubs.queue(QueueName).url}
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self.stubs.counters.count('sqs', 'send_message_batch')
+        queue = self.stubs.queue_by_url(QueueUrl)
+        for entry in Entries:
+            queue.send(entry['MessageBody'])
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries], 'Failed': []}
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, VisibilityTimeout=30, WaitTimeSeconds=0, **kwargs):
+        self.stubs.counters.count('sqs', 'receive_message')
+        queue = self.stubs.queue_by_url(QueueUrl)
+        messages = queue.receive(MaxNumberOfMessages, VisibilityTimeout, WaitTimeSeconds)
+        return {'Messages': [{'MessageId': message.message_id, 'ReceiptHandle': message.message_id, 'Body': message.body,
+                              'Attributes': {'ApproximateReceiveCount': str(message.receive_count)}} for message in messages]}
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        self.stubs.counters.count('sqs', 'delete_message_batch')
+        queue = self.stubs.queue_by_url(QueueUrl)
+        for entry in Entries:
+            queue.delete_id(entry['ReceiptHandle'])
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries], 'Failed': []}
+
+    def change_message_visibility_batch(self, QueueUrl, Entries):
+        self.stubs.counters.count('sqs', 'change_message_visibility_batch')
+        queue = self.stubs.queue_by_url(QueueUrl)
+        for entry in Entries:
+            queue.change_visibility(entry['ReceiptHandle'], entry['VisibilityTimeout'])
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries], 'Failed': []}
+
+
+class StubMessage():
+    def __init__(self, queue, message_id, body):
+        self.queue = queue
+        self.message_id = message_id
+        self.body = body
+        self.receive_count = 0
+        self.visible_at = 0
+
+    def delete(self):
+        self.queue.stubs.counters.count('sqs', 'delete_message')
+        self.queue.delete(self)
+
+
+class StubQueue():
+    '''SQS queue with visibility timeouts. Long polls return after a second
+    at the latest, keeps the shutdown of a load test short'''
+    def __init__(self, stubs, name):
+        self.stubs = stubs
+        self.name = name
+        self.url = 'https://sqs.us-east-1.amazonaws.com/123456789012/%s' % name
+        self.lock = threading.Condition()
+        self.messages = collections.OrderedDict()
+        self.deleted = 0
+        self._ids = itertools.count()
+
+    def send(self, body):
+        with self.lock:
+            message = StubMessage(self, 'msg-%s-%08d' % (self.name, next(self._ids)), body)
+            self.messages[message.message_id] = message
+            self.lock.notify_all()
+            return message
+
+    def delete(self, message):
+        self.delete_id(message.message_id)
+
+    def delete_id(self, message_id):
+        with self.lock:
+            if self.messages.pop(message_id, None) is not None:
+                self.deleted += 1
+
+    def change_visibility(self, message_id, timeout):
+        with self.lock:
+            message = self.messages.get(message_id)
+            if message is not None:
+                message.visible_at = time.time() + timeout
+                if not timeout:
+                    self.lock.notify_all()
+
+    def receive(self, max_messages=1, visibility_timeout=30, wait_seconds=0):
+        '''Returns up to max_messages visible messages and hides them'''
+        deadline = time.time() + min(wait_seconds, 1)
+        with self.lock:
+            while True:
+                now = time.time()
+                received = []
+                for message in self.messages.values():
+                    if message.visible_at > now:
+                        continue
+                    message.visible_at = now + visibility_timeout
+                    message.receive_count += 1
+                    received.append(message)
+                    if len(received) >= max_messages:
+                        break
+                if received or now >= deadline:
+                    return received
+                self.lock.wait(deadline - now)
+
+    def receive_messages(self, MaxNumberOfMessages=1, VisibilityTimeout=30, WaitTimeSeconds=0, **kwargs):
+        '''Like the receive_messages of a boto3 queue resource'''
+        self.stubs.counters.count('sqs', 'receive_message')
+        return self.receive(MaxNumberOfMessages, VisibilityTimeout, WaitTimeSeconds)
+
+
+class AwsStubs():
+    '''State of all stand-ins: S3 objects, secrets and SQS queues'''
+    def __init__(self):
+        self.counters = StubCounters()
+        self.objects = {}
+        self.secrets = {}
+        self.queues = {}
+        self.lock = threading.Lock()
+
+    def put_object(self, bucket, key, data):
+        with self.lock:
+            self.objects[(bucket, key)] = data
+
+    def put_secret(self, name, secret):
+        self.secrets[name] = secret
+
+    def queue(self, name):
+        with self.lock:
+            if name not in self.queues:
+                self.queues[name] = StubQueue(self, name)
+            return self.queues[name]
+
+    def queue_by_url(self, url):
+        return self.queue(url.rsplit('/', 1)[-1])
+
+    def client(self, service_name, **kwargs):
+        if service_name == 's3':
+            return StubS3Client(self)
+        if service_name == 'secretsmanager':
+            return StubSecretsManagerClient(self)
+        if service_name == 'sqs':
+            return StubSqsClient(self)
+        raise NotImplementedError("No stand-in for the %s client" % service_name)
+
+    def boto3_module(self):
+        '''Module that stands in for boto3'''
+        stubs = self
+
+        class Session():
+            def client(self, service_name, **kwargs):
+                return stubs.client(service_name, **kwargs)
+
+        module = types.ModuleType('boto3')
+        module.client = self.client
+        module.session = types.SimpleNamespace(Session=Session)
+        return module
+
+    def install(self):
+        '''Makes every later "import boto3" use the stand-ins'''
+        sys.modules['boto3'] = self.boto3_module()
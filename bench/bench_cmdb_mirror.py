@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+# CMDB mirror sync and no-op skipping (aws_pipeline/cmdb_mirror.py)
+# Fills the CMDB of the SNOW stand-in with EC2 instances, loads the mirror
+# with one partition and with --partitions, fetches a delta after changing
+# some records, then submits a notification per instance, most of them with
+# what the CMDB has already, with and without the mirror:
+#   bench_cmdb_mirror.py --items 50000 --changed 100
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import generator
+from aws_stubs import AwsStubs
+from harness import DEFAULT_LAMBDA_DIR, load_lambda
+from snow_stub import start_snow_stub
+
+IMPORT_TABLE = 'u_imp_cmdb_ci_ec2_instance'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='CMDB mirror sync and no-op skipping')
+    parser.add_argument('--items', type=int, default=20000, help='EC2 instances in the CMDB')
+    parser.add_argument('--changed', type=int, default=100, help='Instances changed between the syncs, and in the notifications')
+    parser.add_argument('--partitions', type=int, default=8, help='sys_id ranges of the parallel full load')
+    parser.add_argument('--page-size', type=int, default=1000, help='CMDB records per Table API request')
+    parser.add_argument('--latency', type=float, default=20, help='Mean SNOW response time in milliseconds')
+    parser.add_argument('--lambda-dir', default=DEFAULT_LAMBDA_DIR, help='Directory with aws-config-sns-to-snow.py')
+    options = parser.parse_args()
+
+    stubs = AwsStubs()
+    stubs.install()
+    snow = start_snow_stub(options.latency)
+    module = load_lambda(options.lambda_dir)
+    sys.modules['aws_pipeline.metrics'].metrics.output = open(os.devnull, 'w')
+    map_configuration_item = sys.modules['snow_objects.registry'].map_configuration_item
+    CmdbMirror = sys.modules['aws_pipeline.cmdb_mirror'].CmdbMirror
+    SnowBatchSubmitter = sys.modules['snow_objects.batch'].SnowBatchSubmitter
+
+    items = [generator.ec2_item(index) for index in range(options.items)]
+    snow.cmdb.transform(IMPORT_TABLE, [map_configuration_item({'configurationItem': item})[1].snow_data() for item in items])
+    args = {'snow_scheme': 'http', 'snow_hostname': snow.hostname, 'snow_user': 'bench', 'snow_password': 'bench',
+            'snow_batch_size': 100, 'snow_workers': options.partitions, 'snow_rate_limit': 0}
+
+    directory = tempfile.mkdtemp()
+    for partitions in [1, options.partitions]:
+        mirror = CmdbMirror(os.path.join(directory, 'mirror-%s.db' % partitions), args, partitions=partitions, page_size=options.page_size)
+        before = snow.stats.snapshot()
+        start = time.perf_counter()
+        fetched = mirror.sync(full=True)
+        print("full load, %2s partitions %6.1fs %6s SNOW calls %8s records" % (
+            partitions, time.perf_counter() - start, snow.stats.snapshot()['calls'] - before['calls'], sum(fetched.values())))
+
+    # The records of the stand-in share a second, a delta fetches the
+    # records of its watermark second again. A later write moves it on
+    time.sleep(1.1)
+    snow.cmdb.transform(IMPORT_TABLE, [map_configuration_item({'configurationItem': items[-1]})[1].snow_data()])
+    mirror.sync()
+    time.sleep(1.1)
+    for item in items[:options.changed]:
+        item['configuration']['state']['name'] = 'stopped'
+    snow.cmdb.transform(IMPORT_TABLE, [map_configuration_item({'configurationItem': item})[1].snow_data() for item in items[:options.changed]])
+    before = snow.stats.snapshot()
+    start = time.perf_counter()
+    fetched = mirror.sync()
+    print("delta %24.2fs %6s SNOW calls %8s records" % (time.perf_counter() - start, snow.stats.snapshot()['calls'] - before['calls'], sum(fetched.values())))
+
+    # The notifications change the first instances back, the rest is what the
+    # CMDB has
+    for item in items[:options.changed]:
+        item['configuration']['state']['name'] = 'running'
+    for run, cmdb_mirror in [('without mirror', None), ('with mirror', mirror)]:
+        args['cmdb_mirror'] = cmdb_mirror
+        args['snow_submitter'] = SnowBatchSubmitter(args)
+        before = snow.stats.snapshot()
+        start = time.perf_counter()
+        for item in items:
+            message = {'configurationItem': item}
+            module.submit_to_snow(message, map_configuration_item(message)[1], args)
+        args['snow_submitter'].flush()
+        after = snow.stats.snapshot()
+        print("%-14s %14.1fs %6s SNOW calls %8s rows" % (run, time.perf_counter() - start, after['calls'] - before['calls'], after['rows'] - before['rows']))
+    snow.shutdown()
+
+
+if __name__ == "__main__":
+    main()
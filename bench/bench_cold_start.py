@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+# Cold start benchmark of aws-config-sns-to-snow.py
+# Every run is a fresh interpreter, like a new lambda container. Measures the
+# time to load the script (the lambda init phase) and the time until the
+# first EC2 change notification is mapped, plus which heavy modules got
+# imported on the way. --lambda-dir allows to compare against another
+# checkout, e.g. a git worktree of an older commit
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+DEFAULT_LAMBDA_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'lambda')
+
+# Runs in the fresh interpreter, prints its measurements as json
+PROBE = '''
+import importlib.util, json, os, sys, time
+
+start = time.perf_counter()
+spec = importlib.util.spec_from_file_location('snow_lambda', os.path.join(os.environ['LAMBDA_TASK_ROOT'], 'aws-config-sns-to-snow.py'))
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+loaded = time.perf_counter()
+modules_loaded = len(sys.modules)
+heavy_loaded = dict((name, name in sys.modules) for name in ['boto3', 'requests', 'snow_objects.ssm_inventory'])
+
+
+class CollectingSubmitter():
+    def add(self, table, data, tag=None):
+        pass
+
+
+message = {
+    'configurationItem': {
+        'configurationItemCaptureTime': '2019-03-01T10:00:00.123Z',
+        'configurationItemStatus': 'OK',
+        'awsAccountId': '123456789012',
+        'awsRegion': 'us-east-1',
+        'availabilityZone': 'us-east-1a',
+        'resourceType': 'AWS::EC2::Instance',
+        'resourceId': 'i-0123456789abcdef0',
+        'resourceCreationTime': '2019-01-01T10:00:00.000Z',
+        'tags': {'Name': 'bench', 'CostCenter': '1234'},
+        'configuration': {
+            'imageId': 'ami-12345678', 'instanceType': 't3.micro', 'state': {'name': 'running'},
+            'placement': {'tenancy': 'default'}, 'monitoring': {'state': 'disabled'},
+            'subnetId': 'subnet-1', 'vpcId': 'vpc-1', 'cpuOptions': {'threadsPerCore': 2, 'coreCount': 1},
+            'stateTransitionReason': '', 'privateIpAddress': '10.0.0.1', 'networkInterfaces': [],
+        },
+    },
+}
+module.config_change_notification(message, {'snow_submitter': CollectingSubmitter()})
+mapped = time.perf_counter()
+
+print(json.dumps({
+    'load': loaded - start,
+    'first_ec2': mapped - start,
+    'modules_at_load': modules_loaded,
+    'heavy_at_load': heavy_loaded,
+}))
+'''
+
+
+def run_probe(lambda_dir):
+    env = dict(os.environ, LAMBDA_TASK_ROOT=os.path.realpath(lambda_dir), SNOW_SECRET='bench')
+    output = subprocess.check_output([sys.executable, '-c', PROBE], env=env, cwd=lambda_dir)
+    return json.loads(output.decode('utf-8').splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cold start benchmark of the lambda script')
+    parser.add_argument('--runs', type=int, default=10, help='Number of fresh interpreters')
+    parser.add_argument('--lambda-dir', default=DEFAULT_LAMBDA_DIR, help='Directory with aws-config-sns-to-snow.py')
+    options = parser.parse_args()
+
+    results = [run_probe(options.lambda_dir) for _ in range(options.runs)]
+
+    print("runs: %s, lambda dir: %s" % (options.runs, os.path.realpath(options.lambda_dir)))
+    for name in ['load', 'first_ec2']:
+        values = [result[name] * 1000 for result in results]
+        print("%-10s median %7.1f ms, min %7.1f ms, max %7.1f ms" % (name, statistics.median(values), min(values), max(values)))
+    print("modules loaded by the script: %s, of them: %s" % (results[0]['modules_at_load'], results[0]['heavy_at_load']))
+
+
+if __name__ == "__main__":
+    main()
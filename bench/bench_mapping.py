@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+# Throughput of mapping configuration items to SNOW objects, per resource type
+# Timestamps are unique per item by default, the worst case for the memoized
+# timestamp parser. --shared-timestamps gives every item the same ones, like
+# a snapshot of resources that were all captured at once. --lambda-dir allows
+# to compare against another checkout, e.g. a git worktree of an older commit
+import argparse
+import json
+import os
+import sys
+import time
+
+DEFAULT_LAMBDA_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'lambda')
+
+
+def timestamp(index, shared):
+    if shared:
+        index = 0
+    return '2019-03-%02dT%02d:%02d:%02d.%03dZ' % (1 + index // 86400 % 28, index // 3600 % 24, index // 60 % 60, index % 60, index % 1000)
+
+
+def configuration_item(resource_type, index, shared, configuration, supplementary=None):
+    return {
+        'configurationItemCaptureTime': timestamp(index, shared),
+        'configurationItemStatus': 'OK',
+        'awsAccountId': '123456789012',
+        'awsRegion': 'us-east-1',
+        'availabilityZone': 'us-east-1a',
+        'resourceType': resource_type,
+        'resourceId': 'id-%s' % index,
+        'resourceName': 'name-%s' % index,
+        'ARN': 'arn:aws:%s' % index,
+        'resourceCreationTime': timestamp(index + 7, shared),
+        'tags': {'Name': 'host-%s' % index, 'CostCenter': '1234', 'Environment': 'prod', 'Team': 'core', 'Owner': 'ops'},
+        'configuration': configuration,
+        'supplementaryConfiguration': supplementary or {},
+    }
+
+
+def ec2(index, shared):
+    return configuration_item('AWS::EC2::Instance', index, shared, {
+        'imageId': 'ami-12345678', 'instanceType': 'm5.large', 'state': {'name': 'running'},
+        'placement': {'tenancy': 'default'}, 'monitoring': {'state': 'disabled'},
+        'subnetId': 'subnet-1', 'vpcId': 'vpc-1', 'cpuOptions': {'threadsPerCore': 2, 'coreCount': 1},
+        'stateTransitionReason': '', 'privateIpAddress': '10.0.0.%s' % (index % 250),
+        'networkInterfaces': [
+            {'association': {'publicIp': '52.0.%s.%s' % (eni, index % 250)}, 'privateIpAddresses': [{'privateIpAddress': '10.1.%s.%s' % (eni, index % 250)}]}
+            for eni in range(3)
+        ],
+    })
+
+
+def elb(index, shared):
+    return configuration_item('AWS::ElasticLoadBalancingV2::LoadBalancer', index, shared, {
+        'scheme': 'internal', 'state': {'code': 'active'}, 'vpcId': 'vpc-1', 'type': 'application',
+        'availabilityZones': [{'zoneName': 'us-east-1%s' % zone, 'subnetId': 'subnet-%s' % zone} for zone in 'abc'],
+    }, {'LoadBalancerAttributes': [
+        {'key': 'load_balancing.cross_zone.enabled', 'value': 'true'},
+        {'key': 'deletion_protection.enabled', 'value': 'false'},
+        {'key': 'idle_timeout.timeout_seconds', 'value': '60'},
+    ]})
+
+
+def rds(index, shared):
+    return configuration_item('AWS::RDS::DBInstance', index, shared, {
+        'dBInstanceClass': 'db.r5.large', 'engine': 'mysql', 'engineVersion': '5.7', 'dBInstanceStatus': 'available',
+        'dBInstanceIdentifier': 'db-%s' % index, 'autoMinorVersionUpgrade': True,
+    })
+
+
+def s3(index, shared):
+    return configuration_item('AWS::S3::Bucket', index, shared, {'name': 'bucket'}, {
+        'BucketVersioningConfiguration': {'status': 'Enabled'},
+        'BucketLoggingConfiguration': {'destinationBucketName': 'logs'},
+        'AccessControlList': json.dumps({'grantList': [{'grantee': 'AllUsers', 'permission': 'Read'}, {'grantee': 'owner', 'permission': 'FullControl'}]}),
+        'BucketLifecycleConfiguration': {'rules': [{'id': 'expire'}]},
+    })
+
+
+def ssm(index, shared):
+    item = configuration_item('AWS::SSM::ManagedInstanceInventory', index, shared, {
+        'AWS:Application': {'Content': dict([('package-%s' % package, {'Name': 'package-%s' % package, 'Version': '1.%s' % package}) for package in range(20)])},
+    })
+    del item['resourceCreationTime']
+    return item
+
+
+GENERATORS = [('AWS::EC2::Instance', ec2), ('AWS::ElasticLoadBalancingV2::LoadBalancer', elb),
+              ('AWS::RDS::DBInstance', rds), ('AWS::S3::Bucket', s3), ('AWS::SSM::ManagedInstanceInventory', ssm)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Mapping throughput per resource type')
+    parser.add_argument('--items', type=int, default=20000, help='Items per resource type')
+    parser.add_argument('--repeat', type=int, default=3, help='Repetitions, the best one is reported')
+    parser.add_argument('--shared-timestamps', action='store_true', help='Same timestamps for every item')
+    parser.add_argument('--lambda-dir', default=DEFAULT_LAMBDA_DIR, help='Directory with the snow_objects package')
+    options = parser.parse_args()
+
+    sys.path.insert(0, os.path.realpath(options.lambda_dir))
+    from snow_objects.registry import get_handler_class
+
+    print("lambda dir: %s, items: %s, shared timestamps: %s" % (os.path.realpath(options.lambda_dir), options.items, options.shared_timestamps))
+    for resource_type, generator in GENERATORS:
+        cls = get_handler_class(resource_type)
+        messages = [{'configurationItem': generator(index, options.shared_timestamps)} for index in range(options.items)]
+
+        best = None
+        for _ in range(options.repeat):
+            # Every repetition starts with a cold timestamp cache
+            mapping = sys.modules.get('snow_objects.mapping')
+            if mapping is not None:
+                mapping.snow_time.cache_clear()
+
+            start = time.perf_counter()
+            for message in messages:
+                cls(message)
+            seconds = time.perf_counter() - start
+            best = seconds if best is None else min(best, seconds)
+        print("%-45s %9.0f items/s" % (resource_type, options.items / best))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+# Snapshot mapping on one core vs. a process pool (--map-processes)
+# Puts a synthetic snapshot into the S3 stand-in and processes its
+# ConfigurationSnapshotDeliveryCompleted message like the CLI does, once
+# without and once per process count. Checks that every run submits the same
+# rows in the same order:
+#   bench_parallel_map.py --items 2000 --ssm-items 200 --processes 2 4
+import argparse
+import os
+import sys
+import time
+
+import generator
+from aws_stubs import AwsStubs
+from harness import DEFAULT_LAMBDA_DIR, CollectingSubmitter, load_lambda
+
+BUCKET = 'config-bucket'
+KEY = 'AWSLogs/123456789012/Config/us-east-1/snapshot.json.gz'
+
+
+def map_snapshot(module, processes):
+    '''Returns the submitted rows and the seconds it took'''
+    submitter = CollectingSubmitter()
+    args = {'snow_submitter': submitter, 'map_processes': processes}
+    message = generator.snapshot_delivery(BUCKET, KEY)
+
+    start = time.perf_counter()
+    module.process_single_message(message, args)
+    return submitter.rows, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Snapshot mapping on one core vs. a process pool')
+    parser.add_argument('--items', type=int, default=2000, help='Items per resource type')
+    parser.add_argument('--ssm-items', type=int, default=200, help='SSM inventories')
+    parser.add_argument('--packages', type=int, default=generator.DEFAULT_PACKAGES, help='Packages per SSM inventory')
+    parser.add_argument('--processes', type=int, nargs='+', default=[os.cpu_count() or 1], help='Process counts to run')
+    parser.add_argument('--lambda-dir', default=DEFAULT_LAMBDA_DIR, help='Directory with aws-config-sns-to-snow.py')
+    options = parser.parse_args()
+
+    stubs = AwsStubs()
+    stubs.install()
+    items = [generator.configuration_item(resource_type, index, packages=options.packages)
+             for resource_type in generator.RESOURCE_TYPES
+             for index in range(options.items if resource_type != 'AWS::SSM::ManagedInstanceInventory' else options.ssm_items)]
+    stubs.put_object(BUCKET, KEY, generator.gzip_json(generator.snapshot_file(items)))
+
+    module = load_lambda(options.lambda_dir)
+    sys.modules['aws_pipeline.metrics'].metrics.output = open(os.devnull, 'w')
+
+    expected, seconds = map_snapshot(module, 0)
+    print("%-12s %8.0f items/s %8s rows" % ('inline', len(items) / seconds, len(expected)))
+    for processes in options.processes:
+        # The first run starts the pool
+        map_snapshot(module, processes)
+        rows, seconds = map_snapshot(module, processes)
+        print("%-12s %8.0f items/s %8s rows %s" % ('%s processes' % processes, len(items) / seconds, len(rows),
+                                                   'same rows' if rows == expected else 'DIFFERENT ROWS'))
+    sys.modules['aws_pipeline.parallel_map'].close_mapping_pools()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+# Benchmark of the SQS message pre-filter and the json backends
+# Measures messages per second for traffic we skip and traffic we accept,
+# once the way lambda_handler_sqs decoded every message before and once with
+# the pre-filter in front of it
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'lambda'))
+
+from aws_pipeline.prefilter import skip_reason  # noqa: E402
+from snow_objects.registry import ACCEPT_RESOURCES  # noqa: E402
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Copy of the list in aws-config-sns-to-snow.py, the script can't be
+# imported outside of lambda
+SKIP_MESSAGE_TYPES = [
+    'ComplianceChangeNotification',
+    'ConfigRulesEvaluationStarted',
+    'ConfigurationHistoryDeliveryCompleted',
+    'ConfigurationSnapshotDeliveryStarted'
+]
+
+
+def change_notification(resource_type, resource_id, relationships=20):
+    configuration_item = {
+        'configurationItemCaptureTime': '2019-03-01T10:00:00.123Z',
+        'awsAccountId': '123456789012',
+        'configurationItemStatus': 'OK',
+        'resourceType': resource_type,
+        'resourceId': resource_id,
+        'awsRegion': 'us-east-1',
+        'tags': {'Name': resource_id},
+        'relationships': [{'resourceId': 'sg-%s' % i, 'resourceType': 'AWS::EC2::SecurityGroup', 'name': 'Is associated with SecurityGroup'} for i in range(relationships)],
+        'configuration': {'description': 'x' * 2000, 'attachments': [{'id': i} for i in range(50)]},
+    }
+    return {
+        'configurationItemDiff': {'changedProperties': {}, 'changeType': 'UPDATE'},
+        'configurationItem': configuration_item,
+        'notificationCreationTime': '2019-03-01T10:00:01.000Z',
+        'messageType': 'ConfigurationItemChangeNotification',
+        'recordVersion': '1.3',
+    }
+
+
+def compliance_notification(rule):
+    return {
+        'awsAccountId': '123456789012',
+        'configRuleName': rule,
+        'messageType': 'ComplianceChangeNotification',
+        'newEvaluationResult': {'complianceType': 'NON_COMPLIANT', 'annotation': 'x' * 500},
+        'oldEvaluationResult': {'complianceType': 'COMPLIANT', 'annotation': 'x' * 500},
+    }
+
+
+def sqs_body(message):
+    return json.dumps({'Type': 'Notification', 'MessageId': 'abc', 'Message': json.dumps(message)})
+
+
+def decode_all(body, loads):
+    '''How lambda_handler_sqs and process_single_message decided before'''
+    message = loads(loads(body)['Message'])
+    if message['messageType'] in SKIP_MESSAGE_TYPES:
+        return None
+    if message['configurationItem']['resourceType'] not in ACCEPT_RESOURCES:
+        return None
+    return message
+
+
+def prefilter_then_decode(body, loads):
+    if skip_reason(body, SKIP_MESSAGE_TYPES, ACCEPT_RESOURCES) is not None:
+        return None
+    return decode_all(body, loads)
+
+
+def rate(fn, bodies, loads, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for body in bodies:
+            fn(body, loads)
+    return len(bodies) * repeat / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the SQS message pre-filter')
+    parser.add_argument('--messages', type=int, default=2000, help='Messages per traffic kind')
+    parser.add_argument('--repeat', type=int, default=5, help='Repetitions per measurement')
+    options = parser.parse_args()
+
+    traffic = {
+        'skipped message type': [sqs_body(compliance_notification('rule-%s' % i)) for i in range(options.messages)],
+        'skipped resource type': [sqs_body(change_notification('AWS::EC2::NetworkInterface', 'eni-%s' % i)) for i in range(options.messages)],
+        'accepted': [sqs_body(change_notification('AWS::EC2::Instance', 'i-%s' % i)) for i in range(options.messages)],
+    }
+    backends = [('json', json.loads)]
+    if orjson is not None:
+        backends.append(('orjson', orjson.loads))
+
+    print("%-22s %-8s %16s %16s" % ('traffic', 'backend', 'decode all msg/s', 'pre-filter msg/s'))
+    for kind, bodies in traffic.items():
+        for backend, loads in backends:
+            print("%-22s %-8s %16.0f %16.0f" % (kind, backend, rate(decode_all, bodies, loads, options.repeat), rate(prefilter_then_decode, bodies, loads, options.repeat)))
+
+
+if __name__ == "__main__":
+    main()
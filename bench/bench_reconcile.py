@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+# Full snapshot submission vs. reconciliation (reconcile-cmdb.py)
+# Puts a synthetic snapshot of EC2 instances into the S3 stand-in and
+# reconciles it against the CMDB of the SNOW stand-in: once into the empty
+# CMDB, which submits everything, then after drifting the CMDB (changed,
+# missing and stale records) and once more, which should submit nothing.
+# Every run gets a snapshot taken after the CMDB writes of the one before,
+# records updated since a snapshot are left alone:
+#   bench_reconcile.py --items 100000 --drift 100
+import argparse
+import datetime
+import importlib.util
+import os
+import sys
+import time
+import uuid
+
+import generator
+from aws_stubs import AwsStubs
+from harness import DEFAULT_LAMBDA_DIR, load_lambda
+from snow_stub import start_snow_stub
+
+BUCKET = 'config-bucket'
+CMDB_TABLE = 'cmdb_ci_ec2_instance'
+
+
+def snapshot_key(taken):
+    '''Where AWS Config delivers the snapshot taken at taken'''
+    return 'AWSLogs/{account}/Config/{region}/{year}/{month}/{day}/ConfigSnapshot/{account}_Config_{region}_ConfigSnapshot_{time}_bench.json.gz'.format(
+        account=generator.ACCOUNT_ID, region=generator.REGION, year=taken.year, month=taken.month, day=taken.day,
+        time=taken.strftime('%Y%m%dT%H%M%SZ'))
+
+
+def drift(snow, count):
+    '''Changes, removes and adds count CMDB records each'''
+    records = snow.cmdb.tables[CMDB_TABLE]
+    keys = sorted(records)
+    for key in keys[:count]:
+        records[key]['state'] = 'stopped' if records[key]['state'] != 'stopped' else 'running'
+    for key in keys[count:2 * count]:
+        del records[key]
+    for index in range(count):
+        records['i-stale%08d' % index] = {'asset_tag': 'i-stale%08d' % index, 'u_account_id': generator.ACCOUNT_ID,
+                                          'u_region': generator.REGION, 'state': 'running', 'sys_id': uuid.uuid4().hex,
+                                          'sys_updated_on': '2020-01-01 00:00:00'}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Full snapshot submission vs. reconciliation')
+    parser.add_argument('--items', type=int, default=20000, help='EC2 instances in the snapshot')
+    parser.add_argument('--drift', type=int, default=100, help='CMDB records changed, removed and added each')
+    parser.add_argument('--latency', type=float, default=20, help='Mean SNOW response time in milliseconds')
+    parser.add_argument('--map-processes', type=int, default=0, help='Map the snapshot on this many processes')
+    parser.add_argument('--lambda-dir', default=DEFAULT_LAMBDA_DIR, help='Directory with reconcile-cmdb.py')
+    options = parser.parse_args()
+
+    stubs = AwsStubs()
+    stubs.install()
+    snow = start_snow_stub(options.latency)
+    items = [generator.ec2_item(index) for index in range(options.items)]
+    snapshot = generator.gzip_json(generator.snapshot_file(items))
+
+    load_lambda(options.lambda_dir)
+    sys.modules['aws_pipeline.metrics'].metrics.output = open(os.devnull, 'w')
+    spec = importlib.util.spec_from_file_location('reconcile_cmdb', os.path.join(options.lambda_dir, 'reconcile-cmdb.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    args = {'config_bucket': BUCKET, 'accounts': [generator.ACCOUNT_ID], 'regions': [generator.REGION], 'snapshot_days': 1,
+            'max_delete_share': 0.5, 'page_size': 5000, 'reconcile_workers': 4, 'map_processes': options.map_processes,
+            'snow_scheme': 'http', 'snow_hostname': snow.hostname, 'snow_user': 'bench', 'snow_password': 'bench',
+            'snow_batch_size': 100, 'snow_workers': 8, 'snow_rate_limit': 0}
+
+    for run in ['empty CMDB', 'drifted', 'reconciled']:
+        if run == 'drifted':
+            drift(snow, options.drift)
+        # sys_updated_on has seconds
+        time.sleep(1.1)
+        stubs.put_object(BUCKET, snapshot_key(datetime.datetime.utcnow()), snapshot)
+        before = snow.stats.snapshot()
+        start = time.perf_counter()
+        failed = module.reconcile(args)
+        seconds = time.perf_counter() - start
+        after = snow.stats.snapshot()
+        print("%-12s %6.1fs %6s SNOW calls %8s rows %s failed" % (run, seconds, after['calls'] - before['calls'], after['rows'] - before['rows'], failed))
+    sys.modules['aws_pipeline.parallel_map'].close_mapping_pools()
+    snow.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+# Memory and serialization benchmark of the SNOW objects
+# Maps the EC2 instances of a synthetic snapshot, keeps the objects alive and
+# reports memory per object, mapping time and the time and payload size of
+# serializing them for SNOW. --lambda-dir allows to compare against another
+# checkout, e.g. a git worktree of an older commit
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+DEFAULT_LAMBDA_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'lambda')
+
+
+def ec2_configuration_item(index):
+    return {
+        'configurationItemCaptureTime': '2019-03-01T10:00:00.123Z',
+        'configurationItemStatus': 'OK',
+        'awsAccountId': '123456789012',
+        'awsRegion': 'us-east-1',
+        'availabilityZone': 'us-east-1a',
+        'resourceType': 'AWS::EC2::Instance',
+        'resourceId': 'i-%017x' % index,
+        'resourceCreationTime': '2019-01-01T10:00:00.000Z',
+        'tags': {'Name': 'host-%s' % index, 'CostCenter': '1234', 'Environment': 'prod', 'Team': 'core'},
+        'configuration': {
+            'imageId': 'ami-12345678', 'instanceType': 'm5.large', 'state': {'name': 'running'},
+            'placement': {'tenancy': 'default'}, 'monitoring': {'state': 'disabled'},
+            'subnetId': 'subnet-1', 'vpcId': 'vpc-1', 'cpuOptions': {'threadsPerCore': 2, 'coreCount': 1},
+            'stateTransitionReason': '', 'privateIpAddress': '10.0.%s.%s' % (index // 250 % 250, index % 250),
+            'networkInterfaces': [
+                {'association': None, 'privateIpAddresses': [{'privateIpAddress': '10.1.%s.%s' % (eni, index % 250)}]}
+                for eni in range(2)
+            ],
+        },
+    }
+
+
+def snow_data(snow_object):
+    '''What add_to_snow sends, vars() before the objects got a schema'''
+    if hasattr(snow_object, 'snow_data'):
+        return snow_object.snow_data()
+    return vars(snow_object)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Memory and serialization benchmark of the SNOW objects')
+    parser.add_argument('--items', type=int, default=100000, help='EC2 instances in the snapshot')
+    parser.add_argument('--lambda-dir', default=DEFAULT_LAMBDA_DIR, help='Directory with the snow_objects package')
+    options = parser.parse_args()
+
+    sys.path.insert(0, os.path.realpath(options.lambda_dir))
+    from snow_objects import jsonlib
+    from snow_objects.ec2 import SnowEc2Object
+
+    messages = [{'configurationItem': ec2_configuration_item(index)} for index in range(options.items)]
+    gc.collect()
+
+    start = time.perf_counter()
+    snow_objects = [SnowEc2Object(message) for message in messages]
+    mapping_seconds = time.perf_counter() - start
+
+    # Tracing slows down the mapping, so the objects are mapped a second time
+    del snow_objects
+    gc.collect()
+    tracemalloc.start()
+    snow_objects = [SnowEc2Object(message) for message in messages]
+    object_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    payload_bytes = 0
+    for snow_object in snow_objects:
+        payload_bytes += len(jsonlib.dumps(snow_data(snow_object)))
+    serialize_seconds = time.perf_counter() - start
+
+    print("lambda dir: %s, json backend: %s, items: %s" % (os.path.realpath(options.lambda_dir), jsonlib.BACKEND, options.items))
+    print("memory per object:     %8.0f bytes" % (object_bytes / options.items))
+    print("mapping:               %8.0f objects/s" % (options.items / mapping_seconds))
+    print("serialization:         %8.0f objects/s" % (options.items / serialize_seconds))
+    print("payload per object:    %8.0f bytes" % (payload_bytes / options.items))
+
+
+if __name__ == "__main__":
+    main()
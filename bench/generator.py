@@ -0,0 +1,437 @@
+#!/usr/bin/env python3
+
+# Synthetic AWS Config payloads for benchmarks and load tests
+# Produces configuration items shaped like the ones AWS Config delivers, and
+# the SNS messages around them: ConfigurationItemChangeNotification,
+# OversizedConfigurationItemChangeNotification and
+# ConfigurationSnapshotDeliveryCompleted plus the gzipped snapshot file. The
+# output only depends on the arguments, so runs can be compared
+#
+# Used as module by the benchmarks, or on the command line to write
+# payloads to disk:
+#   generator.py --out /tmp/payloads --items 10000 --packages 2000
+import argparse
+import gzip
+import json
+import os
+import random
+import zlib
+
+ACCOUNT_ID = '123456789012'
+REGION = 'us-east-1'
+
+# Default scale of a single item
+DEFAULT_ENIS = 4
+DEFAULT_SECONDARY_IPS = 3
+DEFAULT_PACKAGES = 1500
+DEFAULT_GRANTS = 4
+
+RESOURCE_TYPES = [
+    'AWS::EC2::Instance',
+    'AWS::ElasticLoadBalancing::LoadBalancer',
+    'AWS::ElasticLoadBalancingV2::LoadBalancer',
+    'AWS::RDS::DBInstance',
+    'AWS::S3::Bucket',
+    'AWS::SSM::ManagedInstanceInventory',
+]
+
+
+def timestamp(index, offset=0):
+    '''AWS Config timestamp, unique per index'''
+    seconds = index + offset
+    return '2019-%02d-%02dT%02d:%02d:%02d.%03dZ' % (
+        1 + seconds // 2419200 % 12, 1 + seconds // 86400 % 28, seconds // 3600 % 24, seconds // 60 % 60, seconds % 60, index % 1000)
+
+
+def tags(index, extra=4):
+    result = {
+        'Name': 'resource-%s' % index,
+        'CostCenter': str(1000 + index % 50),
+        'Environment': ['prod', 'staging', 'dev'][index % 3],
+        'Service': 'service-%s' % (index % 20),
+        'POC': 'team-%s@example.com' % (index % 10),
+    }
+    for number in range(extra):
+        result['custom-tag-%s' % number] = 'value-%s-%s' % (number, index)
+    return result
+
+
+def relationships(index, count):
+    return [{'resourceId': 'sg-%08x' % (index * 10 + number), 'resourceType': 'AWS::EC2::SecurityGroup',
+             'name': 'Is associated with SecurityGroup'} for number in range(count)]
+
+
+def base_item(resource_type, index, resource_id, configuration, supplementary=None, resource_name=None, arn=None, status='OK'):
+    return {
+        'version': '1.3',
+        'accountId': ACCOUNT_ID,
+        'configurationItemCaptureTime': timestamp(index),
+        'configurationItemStatus': status,
+        'configurationStateId': 1500000000000 + index,
+        'configurationItemMD5Hash': '',
+        'ARN': arn or 'arn:aws:%s:%s:%s:%s' % (resource_type.split('::')[1].lower(), REGION, ACCOUNT_ID, resource_id),
+        'resourceType': resource_type,
+        'resourceId': resource_id,
+        'resourceName': resource_name,
+        'awsAccountId': ACCOUNT_ID,
+        'awsRegion': REGION,
+        'availabilityZone': 'us-east-1%s' % 'abc'[index % 3],
+        'resourceCreationTime': timestamp(index, offset=-86400 * 30),
+        'tags': tags(index),
+        'relatedEvents': [],
+        'relationships': relationships(index, 3),
+        'configuration': configuration,
+        'supplementaryConfiguration': supplementary or {},
+    }
+
+
+def ec2_item(index, enis=DEFAULT_ENIS, secondary_ips=DEFAULT_SECONDARY_IPS):
+    '''EC2 instance with enis network interfaces of 1 + secondary_ips private IPs each'''
+    instance_id = 'i-%017x' % index
+    interfaces = []
+    for eni in range(enis):
+        private_ips = [{
+            'association': {'ipOwnerId': 'amazon', 'publicDnsName': '', 'publicIp': '52.%s.%s.%s' % (eni, index // 250 % 250, index % 250)} if number == 0 and eni == 0 else None,
+            'primary': number == 0,
+            'privateDnsName': 'ip-10-%s-%s-%s.ec2.internal' % (eni, index % 250, number),
+            'privateIpAddress': '10.%s.%s.%s' % (eni, index % 250, number + 10),
+        } for number in range(1 + secondary_ips)]
+        interfaces.append({
+            'association': private_ips[0]['association'],
+            'attachment': {'attachTime': timestamp(index, offset=-3600), 'attachmentId': 'eni-attach-%08x' % (index * 16 + eni),
+                           'deleteOnTermination': True, 'deviceIndex': eni, 'status': 'attached'},
+            'description': '',
+            'groups': [{'groupName': 'default', 'groupId': 'sg-%08x' % index}],
+            'ipv6Addresses': [],
+            'macAddress': '0a:%02x:%02x:%02x:%02x:01' % (eni, index // 65536 % 256, index // 256 % 256, index % 256),
+            'networkInterfaceId': 'eni-%08x' % (index * 16 + eni),
+            'ownerId': ACCOUNT_ID,
+            'privateDnsName': private_ips[0]['privateDnsName'],
+            'privateIpAddress': private_ips[0]['privateIpAddress'],
+            'privateIpAddresses': private_ips,
+            'sourceDestCheck': True,
+            'status': 'in-use',
+            'subnetId': 'subnet-%08x' % (index % 8),
+            'vpcId': 'vpc-%08x' % (index % 2),
+        })
+
+    configuration = {
+        'amiLaunchIndex': 0,
+        'imageId': 'ami-%08x' % (index % 30),
+        'instanceId': instance_id,
+        'instanceType': ['t3.micro', 'm5.large', 'c5.xlarge', 'r5.2xlarge'][index % 4],
+        'kernelId': None,
+        'keyName': 'key-%s' % (index % 5),
+        'launchTime': timestamp(index, offset=-7200),
+        'monitoring': {'state': 'disabled'},
+        'placement': {'availabilityZone': 'us-east-1%s' % 'abc'[index % 3], 'groupName': '', 'tenancy': 'default'},
+        'platform': 'windows' if index % 10 == 0 else None,
+        'privateDnsName': interfaces[0]['privateDnsName'] if interfaces else '',
+        'privateIpAddress': interfaces[0]['privateIpAddress'] if interfaces else '10.255.%s.%s' % (index // 250 % 250, index % 250),
+        'productCodes': [],
+        'publicDnsName': '',
+        'publicIpAddress': interfaces[0]['association']['publicIp'] if interfaces else None,
+        'ramdiskId': None,
+        'state': {'code': 16, 'name': 'running'},
+        'stateTransitionReason': '',
+        'subnetId': 'subnet-%08x' % (index % 8),
+        'vpcId': 'vpc-%08x' % (index % 2),
+        'architecture': 'x86_64',
+        'blockDeviceMappings': [{'deviceName': '/dev/xvda', 'ebs': {'attachTime': timestamp(index, offset=-7200), 'deleteOnTermination': True,
+                                                                   'status': 'attached', 'volumeId': 'vol-%017x' % index}}],
+        'clientToken': '',
+        'ebsOptimized': False,
+        'enaSupport': True,
+        'hypervisor': 'xen',
+        'iamInstanceProfile': {'arn': 'arn:aws:iam::%s:instance-profile/app' % ACCOUNT_ID, 'id': 'AIPA%016d' % index},
+        'instanceLifecycle': None,
+        'networkInterfaces': interfaces,
+        'rootDeviceName': '/dev/xvda',
+        'rootDeviceType': 'ebs',
+        'securityGroups': [{'groupName': 'default', 'groupId': 'sg-%08x' % index}],
+        'sourceDestCheck': True,
+        'spotInstanceRequestId': 'sir-%08x' % index if index % 7 == 0 else None,
+        'sriovNetSupport': None,
+        'tags': [{'key': key, 'value': value} for key, value in tags(index).items()],
+        'virtualizationType': 'hvm',
+        'cpuOptions': {'coreCount': 2, 'threadsPerCore': 2},
+        'hibernationOptions': {'configured': False},
+    }
+    return base_item('AWS::EC2::Instance', index, instance_id, configuration, {}, None,
+                     'arn:aws:ec2:%s:%s:instance/%s' % (REGION, ACCOUNT_ID, instance_id))
+
+
+def elb_classic_item(index, zones=3):
+    name = 'classic-%s' % index
+    configuration = {
+        'loadBalancerName': name,
+        'dNSName': '%s-%s.%s.elb.amazonaws.com' % (name, index, REGION),
+        'listenerDescriptions': [{'listener': {'protocol': 'HTTP', 'loadBalancerPort': 80, 'instanceProtocol': 'HTTP', 'instancePort': 8080}, 'policyNames': []}],
+        'availabilityZones': ['us-east-1%s' % zone for zone in 'abcdef'[:zones]],
+        'subnets': ['subnet-%08x' % zone for zone in range(zones)],
+        'vpcid': 'vpc-%08x' % (index % 2),
+        'instances': [{'instanceId': 'i-%017x' % (index * 10 + number)} for number in range(5)],
+        'healthCheck': {'target': 'HTTP:8080/health', 'interval': 30, 'timeout': 5, 'unhealthyThreshold': 2, 'healthyThreshold': 10},
+        'sourceSecurityGroup': {'ownerAlias': ACCOUNT_ID, 'groupName': 'default'},
+        'securityGroups': ['sg-%08x' % index],
+        'createdTime': timestamp(index, offset=-86400),
+        'scheme': 'internet-facing' if index % 2 else 'internal',
+    }
+    return base_item('AWS::ElasticLoadBalancing::LoadBalancer', index, name, configuration, {}, name,
+                     'arn:aws:elasticloadbalancing:%s:%s:loadbalancer/%s' % (REGION, ACCOUNT_ID, name))
+
+
+def elb_v2_item(index, zones=3):
+    name = 'alb-%s' % index
+    arn = 'arn:aws:elasticloadbalancing:%s:%s:loadbalancer/app/%s/%016x' % (REGION, ACCOUNT_ID, name, index)
+    configuration = {
+        'loadBalancerArn': arn,
+        'dNSName': '%s-%s.%s.elb.amazonaws.com' % (name, index, REGION),
+        'canonicalHostedZoneId': 'Z35SXDOTRQ7X7K',
+        'createdTime': timestamp(index, offset=-86400),
+        'loadBalancerName': name,
+        'scheme': 'internet-facing' if index % 2 else 'internal',
+        'vpcId': 'vpc-%08x' % (index % 2),
+        'state': {'code': 'active'},
+        'type': 'network' if index % 5 == 0 else 'application',
+        'availabilityZones': [{'zoneName': 'us-east-1%s' % zone, 'subnetId': 'subnet-%08x' % number, 'loadBalancerAddresses': []}
+                              for number, zone in enumerate('abcdef'[:zones])],
+        'securityGroups': ['sg-%08x' % index],
+        'ipAddressType': 'ipv4',
+    }
+    supplementary = {'LoadBalancerAttributes': [
+        {'key': 'access_logs.s3.enabled', 'value': 'false'},
+        {'key': 'idle_timeout.timeout_seconds', 'value': '60'},
+        {'key': 'deletion_protection.enabled', 'value': 'true' if index % 3 else 'false'},
+        {'key': 'routing.http2.enabled', 'value': 'true'},
+        {'key': 'load_balancing.cross_zone.enabled', 'value': 'true'},
+    ]}
+    return base_item('AWS::ElasticLoadBalancingV2::LoadBalancer', index, arn, configuration, supplementary, name, arn)
+
+
+def rds_item(index):
+    identifier = 'db-%s' % index
+    resource_id = 'db-%026X' % index
+    configuration = {
+        'dBInstanceIdentifier': identifier,
+        'dBInstanceClass': ['db.t3.medium', 'db.r5.large', 'db.r5.2xlarge'][index % 3],
+        'engine': ['mysql', 'postgres', 'aurora-mysql'][index % 3],
+        'dBInstanceStatus': 'available',
+        'masterUsername': 'admin',
+        'endpoint': {'address': '%s.abcdefghijkl.%s.rds.amazonaws.com' % (identifier, REGION), 'port': 3306, 'hostedZoneId': 'Z2R2ITUGPM61AM'},
+        'allocatedStorage': 100,
+        'instanceCreateTime': timestamp(index, offset=-86400 * 30),
+        'preferredBackupWindow': '07:00-07:30',
+        'backupRetentionPeriod': 7,
+        'dBSecurityGroups': [],
+        'vpcSecurityGroups': [{'vpcSecurityGroupId': 'sg-%08x' % index, 'status': 'active'}],
+        'dBParameterGroups': [{'dBParameterGroupName': 'default.mysql5.7', 'parameterApplyStatus': 'in-sync'}],
+        'availabilityZone': 'us-east-1%s' % 'abc'[index % 3],
+        'dBSubnetGroup': {'dBSubnetGroupName': 'default', 'vpcId': 'vpc-%08x' % (index % 2), 'subnetGroupStatus': 'Complete',
+                          'subnets': [{'subnetIdentifier': 'subnet-%08x' % number, 'subnetStatus': 'Active'} for number in range(3)]},
+        'multiAZ': index % 2 == 0,
+        'engineVersion': '5.7.%s' % (index % 30),
+        'autoMinorVersionUpgrade': True,
+        'licenseModel': 'general-public-license',
+        'publiclyAccessible': False,
+        'storageType': 'gp2',
+        'dbInstancePort': 0,
+        'storageEncrypted': True,
+        'dbiResourceId': resource_id,
+        'caCertificateIdentifier': 'rds-ca-2019',
+        'copyTagsToSnapshot': False,
+        'dBInstanceArn': 'arn:aws:rds:%s:%s:db:%s' % (REGION, ACCOUNT_ID, identifier),
+    }
+    return base_item('AWS::RDS::DBInstance', index, resource_id, configuration, {}, identifier,
+                     'arn:aws:rds:%s:%s:db:%s' % (REGION, ACCOUNT_ID, identifier))
+
+
+def s3_item(index, grants=DEFAULT_GRANTS):
+    name = 'bucket-%s' % index
+    grant_list = [{'grantee': 'AllUsers' if number == 0 and index % 4 == 0 else {'id': '%064x' % (index * 8 + number), 'displayName': None},
+                   'permission': ['Read', 'FullControl', 'Write', 'ReadAcp'][number % 4]} for number in range(grants)]
+    supplementary = {
+        'AccessControlList': json.dumps({'grantSet': None, 'grantList': grant_list, 'owner': {'displayName': None, 'id': '%064x' % index}, 'isRequesterCharged': False}),
+        'BucketAccelerateConfiguration': {'status': None},
+        'BucketLoggingConfiguration': {'destinationBucketName': 'logs-%s' % (index % 3), 'logFilePrefix': name} if index % 2 else {},
+        'BucketNotificationConfiguration': {'configurations': {}},
+        'BucketPolicy': {'policyText': None},
+        'BucketVersioningConfiguration': {'status': 'Enabled' if index % 2 else 'Off', 'isMfaDeleteEnabled': None},
+        'IsRequesterPaysEnabled': False,
+    }
+    if index % 3 == 0:
+        supplementary['BucketLifecycleConfiguration'] = {'rules': [{'id': 'expire', 'status': 'Enabled', 'expirationInDays': 30}]}
+    configuration = {'name': name, 'owner': {'displayName': None, 'id': '%064x' % index}, 'creationDate': timestamp(index, offset=-86400)}
+    return base_item('AWS::S3::Bucket', index, name, configuration, supplementary, name, 'arn:aws:s3:::%s' % name)
+
+
+def ssm_item(index, packages=DEFAULT_PACKAGES):
+    '''SSM inventory of an instance with packages installed packages'''
+    instance_id = 'i-%017x' % index
+    content = {}
+    for number in range(packages):
+        name = 'package-%s' % number
+        package = {
+            'Name': name,
+            'Version': '%s.%s.%s' % (number % 7, number % 13, (number + index) % 5),
+            'Release': '%s.el7' % (number % 3 + 1),
+            'Architecture': 'x86_64',
+            'Publisher': 'Vendor %s' % (number % 9),
+            'InstalledTime': timestamp(number, offset=-86400 * 60),
+            'ApplicationType': 'System Environment/Base',
+            'Summary': 'Synthetic package number %s' % number,
+            'URL': 'https://example.com/%s' % name,
+            'PackageId': '%s-%s.rpm' % (name, number),
+        }
+        if number % 500 == 0:
+            # Rare but possible, e.g. kernels: several versions of a package
+            content[name] = [package, dict(package, Version=package['Version'] + '.1')]
+        else:
+            content[name] = package
+
+    configuration = {
+        'AWS:InstanceInformation': {'Content': {instance_id: {'AgentType': 'amazon-ssm-agent', 'AgentVersion': '2.3.444.0', 'ComputerName': 'ip-10-0-0-1',
+                                                               'InstanceId': instance_id, 'IpAddress': '10.0.0.1', 'PlatformName': 'Amazon Linux',
+                                                               'PlatformType': 'Linux', 'PlatformVersion': '2', 'ResourceType': 'EC2Instance'}}},
+        'AWS:Application': {'Content': content},
+    }
+    item = base_item('AWS::SSM::ManagedInstanceInventory', index, instance_id, configuration, {}, None,
+                     'arn:aws:ssm:%s:%s:managed-instance-inventory/%s' % (REGION, ACCOUNT_ID, instance_id))
+    # Inventory items have no creation time
+    del item['resourceCreationTime']
+    return item
+
+
+def configuration_item(resource_type, index, enis=DEFAULT_ENIS, secondary_ips=DEFAULT_SECONDARY_IPS, packages=DEFAULT_PACKAGES):
+    '''Configuration item of resource_type with the given scale'''
+    if resource_type == 'AWS::EC2::Instance':
+        return ec2_item(index, enis, secondary_ips)
+    if resource_type == 'AWS::ElasticLoadBalancing::LoadBalancer':
+        return elb_classic_item(index)
+    if resource_type == 'AWS::ElasticLoadBalancingV2::LoadBalancer':
+        return elb_v2_item(index)
+    if resource_type == 'AWS::RDS::DBInstance':
+        return rds_item(index)
+    if resource_type == 'AWS::S3::Bucket':
+        return s3_item(index)
+    if resource_type == 'AWS::SSM::ManagedInstanceInventory':
+        return ssm_item(index, packages)
+    raise ValueError("No generator for %s" % resource_type)
+
+
+def mixed_items(count, resource_types=None, seed=0, **scale):
+    '''Yields count items of resource_types in a reproducible random order'''
+    resource_types = resource_types or RESOURCE_TYPES
+    generator = random.Random(seed)
+    for index in range(count):
+        yield configuration_item(generator.choice(resource_types), index, **scale)
+
+
+def updated_item(item, step):
+    '''item as AWS Config records it step changes later, with a new tag'''
+    capture_time = item['configurationItemCaptureTime']
+    return dict(item, configurationStateId=item['configurationStateId'] + step,
+                configurationItemCaptureTime='%s%s' % (int(capture_time[:4]) + step, capture_time[4:]),
+                tags=dict(item['tags'], Revision=str(step)))
+
+
+def change_notification(item, change_type='UPDATE'):
+    '''ConfigurationItemChangeNotification of item'''
+    if change_type == 'DELETE':
+        item = dict(item, configuration=None, supplementaryConfiguration={}, configurationItemStatus='ResourceDeleted')
+    return {
+        'configurationItemDiff': {
+            'changedProperties': {'Configuration.State.Name': {'previousValue': 'pending', 'updatedValue': 'running', 'changeType': 'UPDATE'}} if change_type == 'UPDATE' else {},
+            'changeType': change_type,
+        },
+        'configurationItem': item,
+        'notificationCreationTime': item['configurationItemCaptureTime'],
+        'messageType': 'ConfigurationItemChangeNotification',
+        'recordVersion': '1.3',
+    }
+
+
+def oversized_notification(item, bucket, key):
+    '''OversizedConfigurationItemChangeNotification pointing to s3://bucket/key,
+    which has to contain the gzipped change_notification(item)'''
+    return {
+        'configurationItemSummary': {
+            'changeType': 'UPDATE',
+            'configurationItemVersion': '1.3',
+            'configurationItemCaptureTime': item['configurationItemCaptureTime'],
+            'configurationStateId': item['configurationStateId'],
+            'awsAccountId': item['awsAccountId'],
+            'configurationItemStatus': item['configurationItemStatus'],
+            'resourceType': item['resourceType'],
+            'resourceId': item['resourceId'],
+            'resourceName': item['resourceName'],
+            'ARN': item['ARN'],
+            'awsRegion': item['awsRegion'],
+            'availabilityZone': item['availabilityZone'],
+            'configurationStateMd5Hash': '',
+            'resourceCreationTime': item.get('resourceCreationTime'),
+        },
+        's3DeliverySummary': {'s3BucketLocation': '%s/%s' % (bucket, key), 'errorCode': None, 'errorMessage': None},
+        'notificationCreationTime': item['configurationItemCaptureTime'],
+        'messageType': 'OversizedConfigurationItemChangeNotification',
+        'recordVersion': '1.0',
+    }
+
+
+def snapshot_delivery(bucket, key):
+    '''ConfigurationSnapshotDeliveryCompleted for the snapshot file at s3://bucket/key'''
+    return {
+        'configSnapshotId': 'snapshot-%08x' % zlib.crc32(key.encode('utf-8')),
+        's3ObjectKey': key,
+        's3Bucket': bucket,
+        'notificationCreationTime': '2019-03-01T10:00:00.000Z',
+        'messageType': 'ConfigurationSnapshotDeliveryCompleted',
+        'recordVersion': '1.1',
+    }
+
+
+def snapshot_file(items):
+    '''Content of a snapshot file in S3'''
+    return {'fileVersion': '1.0', 'configSnapshotId': 'snapshot', 'configurationItems': list(items)}
+
+
+def gzip_json(document):
+    return gzip.compress(json.dumps(document).encode('utf-8'))
+
+
+def sqs_body(message):
+    '''SQS body of an AWS Config message delivered via SNS'''
+    return json.dumps({
+        'Type': 'Notification',
+        'MessageId': 'generated',
+        'TopicArn': 'arn:aws:sns:%s:%s:config-topic' % (REGION, ACCOUNT_ID),
+        'Subject': '[AWS Config:%s] AWS Config notification' % REGION,
+        'Message': json.dumps(message),
+        'Timestamp': '2019-03-01T10:00:01.000Z',
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Writes synthetic AWS Config payloads to a directory')
+    parser.add_argument('--out', required=True, help='Output directory')
+    parser.add_argument('--items', type=int, default=1000, help='Number of configuration items')
+    parser.add_argument('--enis', type=int, default=DEFAULT_ENIS, help='Network interfaces per EC2 instance')
+    parser.add_argument('--secondary-ips', type=int, default=DEFAULT_SECONDARY_IPS, help='Secondary private IPs per network interface')
+    parser.add_argument('--packages', type=int, default=DEFAULT_PACKAGES, help='Packages per SSM inventory')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the resource type order')
+    options = parser.parse_args()
+
+    scale = {'enis': options.enis, 'secondary_ips': options.secondary_ips, 'packages': options.packages}
+    items = list(mixed_items(options.items, seed=options.seed, **scale))
+    os.makedirs(options.out, exist_ok=True)
+
+    with open(os.path.join(options.out, 'change-notifications.jsonl'), 'w') as output:
+        for item in items:
+            output.write(sqs_body(change_notification(item)) + '\n')
+    with open(os.path.join(options.out, 'snapshot.json.gz'), 'wb') as output:
+        output.write(gzip_json(snapshot_file(items)))
+    print("Wrote %s items to %s" % (len(items), options.out))
+
+
+if __name__ == "__main__":
+    main()
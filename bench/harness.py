@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+
+# Per stage benchmark of the AWS Config to SNOW pipeline
+# Runs synthetic payloads from generator.py through the stages of the lambda:
+#   decompress  iter_gunzip of a gzipped snapshot file
+#   parse       JsonStreamReader over the snapshot and jsonlib.loads of
+#               change notifications
+#   map         config_change_notification of the lambda script, per
+#               resource type, with a submitter that only collects rows
+#   serialize   jsonlib.dumps of what goes to SNOW
+# Every stage runs once for time and once under tracemalloc for the
+# allocation peak. Results are stored in bench/results/<commit>.json so
+# commits can be compared with --compare:
+#   harness.py --items 2000
+#   harness.py --items 2000 --compare bench/results/6c1061c.json
+import argparse
+import gc
+import importlib.util
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import generator
+
+BENCH_DIR = os.path.dirname(os.path.realpath(__file__))
+DEFAULT_LAMBDA_DIR = os.path.join(BENCH_DIR, '..', 'lambda')
+DEFAULT_RESULTS_DIR = os.path.join(BENCH_DIR, 'results')
+
+# Bytes handed to the decompressor at once, like iter_s3_object
+CHUNK_SIZE = 1024 * 1024
+
+
+class CollectingSubmitter():
+    '''Stands in for SnowBatchSubmitter, keeps the rows instead of sending them'''
+    def __init__(self):
+        self.rows = []
+
+    def add(self, table, data, tag=None):
+        self.rows.append((table, data))
+
+
+def load_lambda(lambda_dir):
+    '''Imports aws-config-sns-to-snow.py like the lambda runtime does'''
+    lambda_dir = os.path.realpath(lambda_dir)
+    os.environ.setdefault('LAMBDA_TASK_ROOT', lambda_dir)
+    os.environ.setdefault('SNOW_SECRET', 'bench')
+    # Every run downloads, unless a benchmark asks for the S3 cache
+    os.environ.setdefault('SNOW_S3_CACHE', 'off')
+    sys.path.insert(0, lambda_dir)
+    spec = importlib.util.spec_from_file_location('snow_lambda', os.path.join(lambda_dir, 'aws-config-sns-to-snow.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def git_commit():
+    '''Short hash of HEAD, with -dirty if the tree has local changes'''
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_DIR).decode('utf-8').strip()
+        status = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=BENCH_DIR).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return commit + '-dirty' if status else commit
+
+
+def measure(function, items):
+    '''Runs function twice, untraced for the time and traced for the
+    allocation peak. Returns the stage result'''
+    gc.collect()
+    start = time.perf_counter()
+    function()
+    seconds = time.perf_counter() - start
+
+    gc.collect()
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        'items': items,
+        'seconds': round(seconds, 6),
+        'items_per_second': round(items / seconds, 1) if seconds else None,
+        'peak_bytes': peak,
+        'peak_bytes_per_item': round(peak / items, 1) if items else None,
+    }
+
+
+def chunked(data, size=CHUNK_SIZE):
+    return [data[offset:offset + size] for offset in range(0, len(data), size)]
+
+
+def run(options):
+    module = load_lambda(options.lambda_dir)
+    from aws_pipeline.s3_stream import JsonStreamReader, iter_gunzip, iter_text
+    from snow_objects import jsonlib
+    from snow_objects.mapping import snow_time
+    from snow_objects.registry import get_handler_class
+    from aws_pipeline.metrics import metrics
+    metrics.output = open(os.devnull, 'w')
+
+    scale = {'enis': options.enis, 'secondary_ips': options.secondary_ips, 'packages': options.packages}
+    stages = {}
+
+    # One snapshot with every resource type
+    items = [generator.configuration_item(resource_type, index, **scale)
+             for resource_type in generator.RESOURCE_TYPES
+             for index in range(options.items if resource_type != 'AWS::SSM::ManagedInstanceInventory' else options.ssm_items)]
+    snapshot = generator.gzip_json(generator.snapshot_file(items))
+    chunks = chunked(snapshot)
+    uncompressed = sum([len(chunk) for chunk in iter_gunzip(chunks)])
+
+    def decompress():
+        for _ in iter_gunzip(chunks):
+            pass
+    stages['decompress'] = measure(decompress, len(items))
+    stages['decompress']['megabytes_per_second'] = round(uncompressed / 1e6 / stages['decompress']['seconds'], 1)
+
+    def parse_snapshot():
+        for _ in JsonStreamReader(iter_text(iter_gunzip(chunks))).iter_array('configurationItems'):
+            pass
+    stages['parse_snapshot'] = measure(parse_snapshot, len(items))
+
+    bodies = [jsonlib.dumps(generator.change_notification(item)) for item in items]
+
+    def parse_notifications():
+        for body in bodies:
+            jsonlib.loads(body)
+    stages['parse_notifications'] = measure(parse_notifications, len(bodies))
+    del bodies
+
+    # Mapping and serialization per resource type
+    for resource_type in generator.RESOURCE_TYPES:
+        name = resource_type.split('::', 1)[1].replace('::', '_')
+        messages = [generator.change_notification(item) for item in items if item['resourceType'] == resource_type]
+
+        def map_messages():
+            # Cold timestamp cache, every run maps like a fresh container
+            snow_time.cache_clear()
+            args = {'snow_submitter': CollectingSubmitter()}
+            for message in messages:
+                module.config_change_notification(message, args)
+            # Once per invocation in the lambda
+            metrics.flush()
+        stages['map_' + name] = measure(map_messages, len(messages))
+
+        cls = get_handler_class(resource_type)
+        rows = [cls(message).snow_data() for message in messages]
+
+        def serialize():
+            for row in rows:
+                jsonlib.dumps(row)
+        stages['serialize_' + name] = measure(serialize, len(rows))
+        stages['serialize_' + name]['bytes_per_item'] = round(sum([len(jsonlib.dumps(row)) for row in rows]) / len(rows), 1)
+
+    return {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'json_backend': jsonlib.BACKEND,
+        'scale': dict(scale, items=options.items, ssm_items=options.ssm_items),
+        'snapshot': {'compressed_bytes': len(snapshot), 'uncompressed_bytes': uncompressed},
+        'stages': stages,
+    }
+
+
+def print_results(results, baseline=None):
+    print("commit: %s, python: %s, json backend: %s, scale: %s" % (results['commit'], results['python'], results['json_backend'], results['scale']))
+    if baseline is not None:
+        print("baseline: %s, json backend: %s, scale: %s" % (baseline['commit'], baseline['json_backend'], baseline['scale']))
+    for name, stage in results['stages'].items():
+        line = "%-46s %10.0f items/s %10.0f peak bytes/item" % (name, stage['items_per_second'], stage['peak_bytes_per_item'])
+        base = (baseline or {}).get('stages', {}).get(name)
+        if base is not None:
+            line += "   %5.2fx speed %5.2fx memory" % (stage['items_per_second'] / base['items_per_second'],
+                                                        stage['peak_bytes_per_item'] / base['peak_bytes_per_item'] if base['peak_bytes_per_item'] else 0)
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Per stage benchmark of the AWS Config to SNOW pipeline')
+    parser.add_argument('--items', type=int, default=2000, help='Items per resource type')
+    parser.add_argument('--ssm-items', type=int, default=20, help='SSM inventories, they are much larger than the other items')
+    parser.add_argument('--enis', type=int, default=generator.DEFAULT_ENIS, help='Network interfaces per EC2 instance')
+    parser.add_argument('--secondary-ips', type=int, default=generator.DEFAULT_SECONDARY_IPS, help='Secondary private IPs per network interface')
+    parser.add_argument('--packages', type=int, default=generator.DEFAULT_PACKAGES, help='Packages per SSM inventory')
+    parser.add_argument('--lambda-dir', default=DEFAULT_LAMBDA_DIR, help='Directory with aws-config-sns-to-snow.py')
+    parser.add_argument('--results-dir', default=DEFAULT_RESULTS_DIR, help='Where the results are stored')
+    parser.add_argument('--no-save', action='store_true', help="Don't store the results")
+    parser.add_argument('--compare', help='Results file to compare against')
+    options = parser.parse_args()
+
+    results = run(options)
+
+    baseline = None
+    if options.compare:
+        with open(options.compare) as input_file:
+            baseline = json.load(input_file)
+    print_results(results, baseline)
+
+    if not options.no_save:
+        os.makedirs(options.results_dir, exist_ok=True)
+        path = os.path.join(options.results_dir, '%s.json' % results['commit'])
+        with open(path, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+            output.write('\n')
+        print("Stored results in %s" % path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+
+# End to end load test of the AWS Config to SNOW pipeline
+# Pushes generated AWS Config messages through the real lambda code, with
+# local stand-ins instead of SNOW (snow_stub.py) and S3, SQS and Secrets
+# Manager (aws_stubs.py). Nothing leaves the machine.
+#
+# --path lambda invokes lambda_handler_sqs with batches from the queue, like
+# the SQS event source mapping: failed records (batchItemFailures) become
+# visible again and are dropped after --max-receives attempts.
+# --path cli runs process_sqs against the queue, like the script in a
+# container: failed records become visible again after the visibility
+# timeout, those left on the queue at the end count as dropped.
+# --path both runs each in its own interpreter, so they don't share caches.
+#
+# Reports records per second, p50/p99 latency per record (the duration of the
+# invocation, or process_messages call, the record was part of) and SNOW calls
+# per CI, e.g.
+#   loadtest.py --events 5000 --latency 50 --throttle-rate 0.02 --error-rate 0.01
+# With --spill the rows go to a S3 spill buffer while SNOW is degraded,
+# --replay sends them with replay-spilled-rows.py afterwards, e.g.
+#   loadtest.py --path lambda --outage 5 40 --spill --replay
+import argparse
+import gzip
+import importlib.util
+import json
+import logging
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+
+import generator
+from aws_stubs import AwsStubs
+from harness import DEFAULT_LAMBDA_DIR, load_lambda
+from snow_stub import add_stub_arguments, start_snow_stub
+
+QUEUE_NAME = 'aws-config-events'
+BUCKET = 'aws-config-delivery'
+SPILL_URL = 's3://snow-spill/loadtest'
+SECRET_NAME = 'snow-integration'
+
+# Messages AWS Config sends that the pipeline skips
+SKIPPED_MESSAGES = [
+    {'messageType': 'ComplianceChangeNotification', 'configRuleName': 'required-tags', 'recordVersion': '1.0'},
+    {'messageType': 'ConfigurationSnapshotDeliveryStarted', 'configSnapshotId': 'snapshot', 'recordVersion': '1.0'},
+]
+
+
+def percentile(values, share):
+    '''Nearest rank percentile of a list of values'''
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(share * (len(values) - 1))))]
+
+
+def build_workload(options, stubs):
+    '''Returns the AWS Config messages to send and the set of CIs they should
+    end up as in SNOW. Oversized and snapshot payloads are stored in S3'''
+    from snow_objects.registry import get_handler
+
+    scale = {'enis': options.enis, 'secondary_ips': options.secondary_ips, 'packages': options.packages}
+    generator_random = random.Random(options.seed)
+    messages = []
+    cis = set()
+
+    def remember(item):
+        handler = get_handler(item['resourceType'])
+        if handler is not None and handler.submit:
+            cis.add((item['resourceType'], item['resourceId']))
+
+    for index, item in enumerate(generator.mixed_items(options.events, seed=options.seed, **scale)):
+        roll = generator_random.random()
+        if roll < options.skip_rate:
+            messages.append([SKIPPED_MESSAGES[index % len(SKIPPED_MESSAGES)]])
+            continue
+
+        remember(item)
+        notification = generator.change_notification(item, 'CREATE' if index % 10 == 0 else 'UPDATE')
+        if roll < options.skip_rate + options.oversized_rate:
+            key = 'AWSLogs/%s/Config/%s/OversizedChangeNotification/%s.json.gz' % (generator.ACCOUNT_ID, generator.REGION, index)
+            stubs.put_object(BUCKET, key, gzip.compress(json.dumps(notification).encode('utf-8')))
+            notification = generator.oversized_notification(item, BUCKET, key)
+        # A busy resource, its newer versions follow right after
+        messages.append([notification] + [generator.change_notification(generator.updated_item(item, step)) for step in range(1, options.repeats)])
+
+    for snapshot in range(options.snapshots):
+        offset = options.events + snapshot * options.snapshot_items
+        items = [generator.configuration_item(generator.RESOURCE_TYPES[index % len(generator.RESOURCE_TYPES)], offset + index, **scale)
+                 for index in range(options.snapshot_items)]
+        for item in items:
+            remember(item)
+        key = 'AWSLogs/%s/Config/%s/ConfigSnapshot/%s.json.gz' % (generator.ACCOUNT_ID, generator.REGION, snapshot)
+        stubs.put_object(BUCKET, key, generator.gzip_json(generator.snapshot_file(items)))
+        messages.append([generator.snapshot_delivery(BUCKET, key)])
+
+    generator_random.shuffle(messages)
+    return [message for burst in messages for message in burst], cis
+
+
+def configure_environment(options, stubs, snow):
+    '''What the lambda configuration would set'''
+    stubs.put_secret(SECRET_NAME, {'snow_user': 'loadtest', 'snow_password': 'loadtest', 'snow_hostname': snow.hostname})
+    os.environ['SNOW_SECRET'] = SECRET_NAME
+    os.environ['SNOW_SCHEME'] = 'http'
+    os.environ['SNOW_WORKERS'] = str(options.workers)
+    os.environ['SNOW_BATCH_SIZE'] = str(options.batch_rows)
+    if options.rate_limit:
+        os.environ['SNOW_RATE_LIMIT'] = str(options.rate_limit)
+    if options.fanout:
+        os.environ['SNOW_FANOUT_QUEUE_URL'] = stubs.queue(QUEUE_NAME).url
+    if options.state_store:
+        os.environ['SNOW_STATE_STORE'] = options.state_store
+    if options.async_mode:
+        os.environ['SNOW_ASYNC'] = 'on'
+    if options.no_coalesce:
+        os.environ['SNOW_COALESCE'] = 'off'
+    if options.s3_cache:
+        os.environ['SNOW_S3_CACHE'] = 'on'
+        os.environ['SNOW_S3_CACHE_DIR'] = options.s3_cache
+    if options.spill:
+        os.environ['SNOW_SPILL_URL'] = SPILL_URL
+        os.environ['SNOW_SPILL'] = options.spill_mode
+
+
+def run_lambda_path(module, queue, options):
+    '''Invokes lambda_handler_sqs until the queue is empty. Returns the latency
+    of every processed record and the number of dropped records'''
+    latencies = []
+    dropped = 0
+    while True:
+        received = queue.receive_messages(MaxNumberOfMessages=options.batch_size, VisibilityTimeout=3600)
+        if not received:
+            if not queue.messages:
+                break
+            # Failed records wait out their visibility timeout
+            time.sleep(0.1)
+            continue
+
+        event = {'Records': [{
+            'messageId': message.message_id,
+            'receiptHandle': message.message_id,
+            'body': message.body,
+            'attributes': {'ApproximateReceiveCount': str(message.receive_count)},
+            'eventSource': 'aws:sqs',
+        } for message in received]}
+
+        start = time.perf_counter()
+        response = module.lambda_handler_sqs(event, None)
+        seconds = time.perf_counter() - start
+        latencies.extend([seconds] * len(received))
+
+        # What the event source mapping does with a partial batch response
+        failed = set([failure['itemIdentifier'] for failure in response['batchItemFailures']])
+        for message in received:
+            if message.message_id not in failed:
+                message.delete()
+            elif message.receive_count >= options.max_receives:
+                # Would go to the dead letter queue
+                dropped += 1
+                message.delete()
+            else:
+                message.visible_at = time.time() + options.visibility_timeout
+    return latencies, dropped
+
+
+def run_cli_path(module, queue, options, snow):
+    '''Runs process_sqs like the script does, until the queue was empty for
+    2 seconds. Returns the latency of every processed record, taken around
+    process_messages, and the number of records still on the queue'''
+    latencies = []
+    name = 'process_messages_async' if options.async_mode else 'process_messages'
+    process_messages = getattr(module, name)
+
+    def timed_process_messages(messages, args):
+        messages = list(messages)
+        start = time.perf_counter()
+        try:
+            return process_messages(messages, args)
+        finally:
+            latencies.extend([time.perf_counter() - start] * len(messages))
+    setattr(module, name, timed_process_messages)
+
+    argv = ['aws-config-sns-to-snow.py', '--source-sqs-name', QUEUE_NAME, '--region-sqs', generator.REGION,
+            '--snow-scheme', 'http', '--snow-hostname', snow.hostname, '--snow-user', 'loadtest', '--snow-password', 'loadtest',
+            '--snow-workers', str(options.workers), '--snow-batch-size', str(options.batch_rows),
+            '--snow-rate-limit', str(options.rate_limit), '--idle-exit', '2']
+    if options.fanout:
+        argv += ['--fanout-queue-url', queue.url]
+    if options.state_store:
+        argv += ['--state-store', options.state_store]
+    if options.async_mode:
+        argv += ['--async']
+    if options.no_coalesce:
+        argv += ['--no-coalesce']
+    if options.spill:
+        argv += ['--spill-url', SPILL_URL, '--spill-mode', options.spill_mode]
+
+    saved_argv = sys.argv
+    sys.argv = argv
+    try:
+        args = module.parse_arguments()
+    finally:
+        sys.argv = saved_argv
+
+    module.process_sqs(QUEUE_NAME, generator.REGION, args)
+    return latencies, len(queue.messages)
+
+
+def run(options):
+    stubs = AwsStubs()
+    stubs.install()
+    snow = start_snow_stub(options.latency, options.error_rate, options.throttle_rate, options.unauthorized_rate, options.retry_after,
+                           outage_start=options.outage[0], outage_seconds=options.outage[1])
+    configure_environment(options, stubs, snow)
+    module = load_lambda(options.lambda_dir)
+    # The EMF lines would end up between the results
+    sys.modules['aws_pipeline.metrics'].metrics.output = open(os.devnull, 'w')
+
+    # The lambda runtime has a handler on the root logger
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger().handlers[0].setLevel(getattr(logging, options.log_level))
+
+    messages, cis = build_workload(options, stubs)
+    queue = stubs.queue(QUEUE_NAME)
+    for message in messages:
+        queue.send(generator.sqs_body(message) if options.path == 'lambda' else json.dumps(message))
+    sent = len(messages)
+
+    start = time.perf_counter()
+    if options.path == 'lambda':
+        latencies, dropped = run_lambda_path(module, queue, options)
+    else:
+        latencies, dropped = run_cli_path(module, queue, options, snow)
+    seconds = time.perf_counter() - start
+
+    snow_stats = snow.stats.snapshot()
+    replay = run_replay(options, stubs, snow) if options.replay else None
+    snow.shutdown()
+    return {
+        'path': options.path,
+        'json_backend': sys.modules['snow_objects.jsonlib'].BACKEND,
+        'messages_sent': sent,
+        # Fan-out chunks are records as well
+        'records_processed': len(latencies),
+        'records_dropped': dropped,
+        'seconds': round(seconds, 3),
+        'records_per_second': round(len(latencies) / seconds, 1) if seconds else None,
+        'latency_p50_ms': round(percentile(latencies, 0.5) * 1000, 1),
+        'latency_p99_ms': round(percentile(latencies, 0.99) * 1000, 1),
+        'latency_mean_ms': round(statistics.mean(latencies) * 1000, 1) if latencies else 0,
+        'cis': len(cis),
+        'snow': snow_stats,
+        'snow_calls_per_ci': round(snow_stats['calls'] / len(cis), 3) if cis else None,
+        'aws_calls': stubs.counters.snapshot(),
+        'replay': replay,
+    }
+
+
+def run_replay(options, stubs, snow):
+    '''Sends the spilled rows to SNOW with replay-spilled-rows.py, once the
+    outage is over. Returns what it took'''
+    wait = snow.started + options.outage[0] + options.outage[1] - time.monotonic()
+    if wait > 0:
+        time.sleep(wait)
+
+    spec = importlib.util.spec_from_file_location('replay_spilled_rows', os.path.join(options.lambda_dir, 'replay-spilled-rows.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    args = {'spill_url': SPILL_URL, 'snow_scheme': 'http', 'snow_hostname': snow.hostname, 'snow_user': 'loadtest',
+            'snow_password': 'loadtest', 'snow_workers': options.replay_workers, 'snow_batch_size': options.batch_rows,
+            'snow_rate_limit': 0, 'delete': True, 'state_store_url': options.state_store}
+    # The replay shares the SNOW client of the run, wait for its circuit
+    # breaker like a replay started later would
+    while sys.modules['snow_objects.client'].snow_unavailable(args):
+        time.sleep(0.5)
+
+    spilled = sum([len(gzip.decompress(data).splitlines()) for (bucket, key), data in list(stubs.objects.items()) if bucket == 'snow-spill'])
+    before = snow.stats.snapshot()
+    start = time.perf_counter()
+    done = module.replay(args)
+    after = snow.stats.snapshot()
+    return {
+        'done': done,
+        'rows_spilled': spilled,
+        'seconds': round(time.perf_counter() - start, 3),
+        'snow_calls': after['calls'] - before['calls'],
+        'snow_rows': after['rows'] - before['rows'],
+    }
+
+
+def print_result(result):
+    print("path: %s, json backend: %s" % (result['path'], result['json_backend']))
+    print("  messages sent:      %8s" % result['messages_sent'])
+    print("  records processed:  %8s in %.1fs, %s dropped" % (result['records_processed'], result['seconds'], result['records_dropped']))
+    print("  records per second: %8.0f" % result['records_per_second'])
+    print("  latency per record: p50 %.1f ms, p99 %.1f ms, mean %.1f ms" % (result['latency_p50_ms'], result['latency_p99_ms'], result['latency_mean_ms']))
+    print("  SNOW:               %s calls, %s rows, statuses %s" % (result['snow']['calls'], result['snow']['rows'], result['snow']['statuses']))
+    print("  SNOW calls per CI:  %8s (%s CIs)" % (result['snow_calls_per_ci'], result['cis']))
+    print("  AWS calls:          %s" % result['aws_calls'])
+    if result.get('replay'):
+        replay = result['replay']
+        print("  replay:             %s spilled rows as %s rows in %s SNOW calls, %.1fs, %s" % (
+            replay['rows_spilled'], replay['snow_rows'], replay['snow_calls'], replay['seconds'], 'done' if replay['done'] else 'stopped'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End to end load test with local SNOW, S3, SQS and Secrets Manager stand-ins')
+    parser.add_argument('--path', choices=['lambda', 'cli', 'both'], default='both', help='Entry point to drive')
+    parser.add_argument('--events', type=int, default=5000, help='AWS Config messages to send, besides the snapshot deliveries')
+    parser.add_argument('--skip-rate', type=float, default=0.05, help='Share of messages the pipeline skips')
+    parser.add_argument('--oversized-rate', type=float, default=0.02, help='Share of change notifications delivered via S3')
+    parser.add_argument('--snapshots', type=int, default=1, help='Snapshot deliveries')
+    parser.add_argument('--snapshot-items', type=int, default=1000, help='Configuration items per snapshot')
+    parser.add_argument('--enis', type=int, default=2, help='Network interfaces per EC2 instance')
+    parser.add_argument('--secondary-ips', type=int, default=1, help='Secondary private IPs per network interface')
+    parser.add_argument('--packages', type=int, default=200, help='Packages per SSM inventory')
+    parser.add_argument('--repeats', type=int, default=1, help='Change notifications per resource, the newer versions are sent right after each other')
+    parser.add_argument('--no-coalesce', action='store_true', help='SNOW_COALESCE=off, process superseded notifications as well')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the workload')
+    parser.add_argument('--batch-size', type=int, default=10, help='Records per lambda invocation')
+    parser.add_argument('--visibility-timeout', type=float, default=0, help='Seconds until a failed record is delivered again on the lambda path')
+    parser.add_argument('--max-receives', type=int, default=3, help='Attempts before a record goes to the dead letter queue')
+    parser.add_argument('--workers', type=int, default=4, help='SNOW_WORKERS')
+    parser.add_argument('--batch-rows', type=int, default=100, help='SNOW_BATCH_SIZE, rows per insertMultiple call')
+    parser.add_argument('--rate-limit', type=float, default=0, help='SNOW_RATE_LIMIT, 0 for no limit')
+    parser.add_argument('--async', dest='async_mode', action='store_true', help='SNOW_ASYNC, the asyncio pipeline')
+    parser.add_argument('--s3-cache', default='', help='SNOW_S3_CACHE_DIR, cache S3 files in this directory')
+    parser.add_argument('--spill', action='store_true', help='SNOW_SPILL_URL, spill the rows to S3 while SNOW is degraded')
+    parser.add_argument('--spill-mode', choices=['degraded', 'always'], default='degraded', help='SNOW_SPILL, always spills every row')
+    parser.add_argument('--replay', action='store_true', help='Replay the spilled rows after the run, once the outage is over')
+    parser.add_argument('--replay-workers', type=int, default=16, help='SNOW workers of the replay')
+    parser.add_argument('--fanout', action='store_true', help='Fan snapshots out to the queue')
+    parser.add_argument('--state-store', default='', help='SNOW_STATE_STORE, e.g. sqlite:///tmp/loadtest.db')
+    parser.add_argument('--log-level', default='WARNING', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'], help='Log output of the pipeline')
+    parser.add_argument('--lambda-dir', default=DEFAULT_LAMBDA_DIR, help='Directory with aws-config-sns-to-snow.py')
+    parser.add_argument('--output', help='Also write the results as json to this file')
+    parser.add_argument('--json', action='store_true', help='Print the result as a single json line, only with a single --path')
+    add_stub_arguments(parser)
+    options = parser.parse_args()
+
+    if options.path == 'both':
+        # A fresh interpreter per path, no shared clients, caches or stand-ins
+        results = []
+        for path in ['lambda', 'cli']:
+            argv = _without_options(sys.argv[1:], ['--path', '--output']) + ['--path', path, '--json']
+            output = subprocess.check_output([sys.executable, os.path.realpath(__file__)] + argv)
+            results.append(json.loads(output.decode('utf-8').splitlines()[-1]))
+    else:
+        results = [run(options)]
+
+    if options.json:
+        print(json.dumps(results[0]))
+        return
+
+    for result in results:
+        print_result(result)
+    if options.output:
+        with open(options.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2, sort_keys=True)
+            output_file.write('\n')
+
+
+def _without_options(argv, names):
+    '''Drops the options in names and their values from argv'''
+    result = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg in names:
+            skip = True
+        elif arg.split('=', 1)[0] not in names:
+            result.append(arg)
+    return result
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+
+# Local stand-in for the SNOW import set and Table API
+# Accepts POST /api/now/import/<table> and /api/now/import/<table>/insertMultiple
+# like SNOW does and answers after a configurable latency. A share of the
+# requests can be answered with 500, 429 (with Retry-After) or 401, to see how
+# the pipeline copes with an unhealthy instance. An outage answers every
+# request with 503 for a while, like a brownout. Counts calls and rows.
+#
+# Rows of the import set tables in TRANSFORMS end up in their CMDB table, by
+# asset_tag and with the same field names plus sys_id and sys_updated_on, and
+# GET /api/now/table/<table> answers the queries reconcile-cmdb.py and
+# sync-cmdb-mirror.py send: field=value, fieldISNOTEMPTY, field>value (also
+# >=, <, <=) and ORDERBYfield, also more than one, case insensitive like SNOW.
+#
+# Used by loadtest.py, or on its own to point a dev run of the script at it:
+#   snow_stub.py --port 8080 --latency 50 --throttle-rate 0.05
+#   aws-config-sns-to-snow.py ... --snow-scheme http --snow-hostname 127.0.0.1:8080
+import argparse
+import collections
+import http.server
+import json
+import operator
+import random
+import socketserver
+import threading
+import time
+import urllib.parse
+import uuid
+
+IMPORT_PATH = '/api/now/import/'
+TABLE_PATH = '/api/now/table/'
+
+# Import set table: the CMDB table its transform writes to
+TRANSFORMS = {
+    'u_imp_cmdb_ci_ec2_instance': 'cmdb_ci_ec2_instance',
+}
+
+
+class StubCmdb():
+    '''Records per CMDB table by lower cased asset_tag'''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tables = collections.defaultdict(dict)
+
+    def transform(self, import_table, rows):
+        table = TRANSFORMS.get(import_table)
+        if table is None:
+            return
+        with self.lock:
+            for row in rows:
+                if row.get('asset_tag'):
+                    record = self.tables[table].setdefault(row['asset_tag'].lower(), {'sys_id': uuid.uuid4().hex})
+                    record.update(dict([(field, _snow_value(field_value)) for field, field_value in row.items()]))
+                    record['sys_updated_on'] = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+
+    def query(self, table, query, fields, limit):
+        '''Records matching an encoded query, with the fields asked for'''
+        conditions = [condition for condition in query.split('^') if condition]
+        order_by = [condition[len('ORDERBY'):] for condition in conditions if condition.startswith('ORDERBY')]
+        with self.lock:
+            records = [dict(record) for record in self.tables.get(table, {}).values()
+                       if all([_matches(record, condition) for condition in conditions if not condition.startswith('ORDERBY')])]
+        if order_by:
+            records.sort(key=lambda record: [record.get(field, '').lower() for field in order_by])
+        return [dict([(field, record[field]) for field in fields if field in record]) for record in records[:limit]]
+
+
+def _snow_value(value):
+    '''What the Table API returns for a value'''
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value)
+
+
+# Two character operators first, >= isn't >
+RANGE_OPERATORS = [('>=', operator.ge), ('<=', operator.le), ('>', operator.gt), ('<', operator.lt)]
+
+
+def _matches(record, condition):
+    if condition.endswith('ISNOTEMPTY'):
+        return bool(record.get(condition[:-len('ISNOTEMPTY')]))
+    for symbol, compare in RANGE_OPERATORS:
+        if symbol in condition:
+            field, _, bound = condition.partition(symbol)
+            return compare(record.get(field, '').lower(), bound.replace('^^', '^').lower())
+    field, _, expected = condition.partition('=')
+    return record.get(field, '').lower() == expected.replace('^^', '^').lower()
+
+
+class SnowStubStats():
+    '''Counters of a stub server, safe to update from the handler threads'''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = collections.Counter()
+        self.rows = collections.Counter()
+        self.statuses = collections.Counter()
+
+    def record(self, kind, table, rows, status):
+        with self.lock:
+            self.calls[kind] += 1
+            self.statuses[status] += 1
+            if status in [200, 201]:
+                self.rows[table] += rows
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'calls': sum(self.calls.values()),
+                'calls_by_kind': dict(self.calls),
+                'statuses': dict([(str(status), count) for status, count in self.statuses.items()]),
+                'rows': sum(self.rows.values()),
+                'rows_by_table': dict(self.rows),
+            }
+
+
+class SnowStubHandler(http.server.BaseHTTPRequestHandler):
+    # Keep-alive, like SNOW
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        config = self.server.config
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        if not self.path.startswith(IMPORT_PATH):
+            return self._answer(404, {'error': {'message': 'Invalid path %s' % self.path}})
+        table = self.path[len(IMPORT_PATH):].split('/')[0]
+        kind = 'insertMultiple' if self.path.endswith('/insertMultiple') else 'single'
+
+        if config.latency:
+            time.sleep(random.uniform(config.latency * 0.5, config.latency * 1.5) / 1000.0)
+
+        if config.outage_seconds and 0 <= time.monotonic() - self.server.started - config.outage_start < config.outage_seconds:
+            self.server.stats.record(kind, table, 0, 503)
+            return self._answer(503, {'error': {'message': 'Service unavailable'}})
+
+        # Failures are decided per request, in the order SNOW would check
+        roll = random.random()
+        if roll < config.unauthorized_rate:
+            self.server.stats.record(kind, table, 0, 401)
+            return self._answer(401, {'error': {'message': 'User Not Authenticated'}})
+        roll -= config.unauthorized_rate
+        if roll < config.throttle_rate:
+            self.server.stats.record(kind, table, 0, 429)
+            return self._answer(429, {'error': {'message': 'Too many requests'}}, {'Retry-After': str(config.retry_after)})
+        roll -= config.throttle_rate
+        if roll < config.error_rate:
+            self.server.stats.record(kind, table, 0, 500)
+            return self._answer(500, {'error': {'message': 'Internal server error'}})
+
+        try:
+            data = json.loads(body)
+        except ValueError:
+            self.server.stats.record(kind, table, 0, 400)
+            return self._answer(400, {'error': {'message': 'Invalid json'}})
+
+        if kind == 'insertMultiple':
+            records = data.get('records', [])
+            self.server.cmdb.transform(table, records)
+            self.server.stats.record(kind, table, len(records), 200)
+            return self._answer(200, {'result': [self._row(table) for _ in records]})
+
+        self.server.cmdb.transform(table, [data])
+        self.server.stats.record(kind, table, 1, 201)
+        return self._answer(201, {'result': [self._row(table)]})
+
+    def do_GET(self):
+        config = self.server.config
+        url = urllib.parse.urlsplit(self.path)
+        if not url.path.startswith(TABLE_PATH):
+            return self._answer(404, {'error': {'message': 'Invalid path %s' % self.path}})
+        table = url.path[len(TABLE_PATH):].split('/')[0]
+
+        if config.latency:
+            time.sleep(random.uniform(config.latency * 0.5, config.latency * 1.5) / 1000.0)
+        if config.outage_seconds and 0 <= time.monotonic() - self.server.started - config.outage_start < config.outage_seconds:
+            self.server.stats.record('table', table, 0, 503)
+            return self._answer(503, {'error': {'message': 'Service unavailable'}})
+
+        params = dict(urllib.parse.parse_qsl(url.query))
+        fields = [field for field in params.get('sysparm_fields', '').split(',') if field]
+        records = self.server.cmdb.query(table, params.get('sysparm_query', ''), fields, int(params.get('sysparm_limit', 10000)))
+        self.server.stats.record('table', table, 0, 200)
+        return self._answer(200, {'result': records})
+
+    def _row(self, table):
+        return {'status': 'inserted', 'table': table, 'sys_id': '%032x' % random.getrandbits(128)}
+
+    def _answer(self, status, document, headers=None):
+        body = json.dumps(document).encode('utf-8')
+        self.send_response(status)
+        for name, header_value in (headers or {}).items():
+            self.send_header(name, header_value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class SnowStubServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, config):
+        http.server.HTTPServer.__init__(self, address, SnowStubHandler)
+        self.config = config
+        self.stats = SnowStubStats()
+        self.cmdb = StubCmdb()
+        self.started = time.monotonic()
+
+    @property
+    def hostname(self):
+        '''HOSTNAME:PORT to use as snow_hostname with the http scheme'''
+        return '%s:%s' % self.server_address[:2]
+
+
+# latency is in milliseconds, the rates are shares of all requests. The
+# outage starts outage_start seconds after the server
+SnowStubConfig = collections.namedtuple('SnowStubConfig', ['latency', 'error_rate', 'throttle_rate', 'unauthorized_rate', 'retry_after',
+                                                           'outage_start', 'outage_seconds'])
+
+
+def start_snow_stub(latency=0, error_rate=0, throttle_rate=0, unauthorized_rate=0, retry_after=1, host='127.0.0.1', port=0,
+                    outage_start=0, outage_seconds=0):
+    '''Starts a stub server in a background thread and returns it'''
+    config = SnowStubConfig(latency, error_rate, throttle_rate, unauthorized_rate, retry_after, outage_start, outage_seconds)
+    server = SnowStubServer((host, port), config)
+    thread = threading.Thread(target=server.serve_forever, name='snow-stub')
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def add_stub_arguments(parser):
+    '''The stub options, shared with loadtest.py'''
+    parser.add_argument('--latency', type=float, default=20, help='Mean SNOW response time in milliseconds')
+    parser.add_argument('--error-rate', type=float, default=0, help='Share of requests answered with 500')
+    parser.add_argument('--throttle-rate', type=float, default=0, help='Share of requests answered with 429')
+    parser.add_argument('--unauthorized-rate', type=float, default=0, help='Share of requests answered with 401')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After of the 429 responses in seconds')
+    parser.add_argument('--outage', type=float, nargs=2, default=[0, 0], metavar=('START', 'SECONDS'), help='Answer every request with 503 for SECONDS, START seconds after the stub started')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the SNOW import set API')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8080, help='Port to listen on')
+    add_stub_arguments(parser)
+    options = parser.parse_args()
+
+    server = start_snow_stub(options.latency, options.error_rate, options.throttle_rate, options.unauthorized_rate,
+                             options.retry_after, options.host, options.port, *options.outage)
+    print("SNOW stub listening on http://%s" % server.hostname)
+    try:
+        while True:
+            time.sleep(10)
+            print(json.dumps(server.stats.snapshot()))
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -4,16 +4,16 @@
 # for what we need and to change the datastructure so we can easier push it
 # to SNOW
 import argparse
+import asyncio
 import os
 import os.path
 import sys
+import threading
+import time
 
 root = os.environ["LAMBDA_TASK_ROOT"]
 sys.path.insert(0, root)
-import boto3
-from botocore.exceptions import ClientError, ParamValidationError
 import logging
-import json
 import pprint
 import zlib
 
@@ -23,22 +23,31 @@ if 'LAMBDA_TASK_ROOT' in os.environ:
     sys.path.insert(0, os.path.join(CWD, "lib"))
 
 # For AWS Config to SNOW object conversation
-#  These require the requests library, hence its after the CWD config
-from snow_objects.ec2 import SnowEc2Object  # noqa: E402
-from snow_objects.elb import SnowElbObject  # noqa: E402
-from snow_objects.s3 import SnowS3Object  # noqa: E402
-from snow_objects.rds import SnowRDSObject  # noqa: E402
-from snow_objects.ssm_inventory import SnowSSMInventoryObject  # noqa: E402
-
-
-# List of resources we accept. We skip all other ones
-ACCEPT_RESOURCES = [
-    'AWS::EC2::Instance',
-    'AWS::ElasticLoadBalancingV2::LoadBalancer',
-    'AWS::ElasticLoadBalancing::LoadBalancer',
-    'AWS::S3::Bucket',
-    'AWS::SSM::ManagedInstanceInventory'
-]
+#  These require the requests library, hence its after the CWD config. The
+#  SNOW object classes are imported by the registry on first use, boto3 and
+#  requests once we talk to AWS or SNOW. Keeps the lambda cold start short
+from snow_objects.registry import ACCEPT_RESOURCES, get_handler, map_configuration_item  # noqa: E402
+from snow_objects.client import log_pool_stats, snow_unavailable  # noqa: E402
+from snow_objects.batch import SnowBatchSubmitter  # noqa: E402
+from snow_objects.async_batch import DEFAULT_CONCURRENCY, AsyncSnowBatchSubmitter  # noqa: E402
+from snow_objects.executor import SnowSubmissionExecutor  # noqa: E402
+from snow_objects.errors import InvalidMessageError, S3DownloadError  # noqa: E402
+from snow_objects import jsonlib  # noqa: E402
+from aws_pipeline.credentials import DEFAULT_SECRET_TTL, get_cached_secret  # noqa: E402
+from aws_pipeline.s3_cache import get_s3_client, log_cache_stats  # noqa: E402
+from aws_pipeline.s3_stream import iter_gunzip_json_array, iter_gunzip_json_array_blocks, load_gunzip_json  # noqa: E402
+from aws_pipeline.state_store import open_state_store, resource_key  # noqa: E402
+from aws_pipeline.cmdb_mirror import TERMINATED, UNCHANGED, open_cmdb_mirror  # noqa: E402
+from aws_pipeline.prefilter import skip_reason  # noqa: E402
+from aws_pipeline.coalesce import coalesce_messages  # noqa: E402
+from aws_pipeline.spill import SPILL_MODES, SpillSubmitter  # noqa: E402
+from aws_pipeline.fanout import CHUNK_MESSAGE_TYPE, DEFAULT_CHUNK_BYTES, fan_out_configuration_items  # noqa: E402
+from aws_pipeline.metrics import metrics  # noqa: E402
+from aws_pipeline import aio  # noqa: E402
+from aws_pipeline.aio import DEFAULT_S3_CONCURRENCY, BlockingCalls  # noqa: E402
+from aws_pipeline.parallel_map import DEFAULT_BLOCK_SIZE, close_mapping_pools, map_blocks_parallel  # noqa: E402
+from aws_pipeline.worker import DEFAULT_BATCH_MESSAGES, DEFAULT_PROCESSORS, DEFAULT_RECEIVERS, DEFAULT_VISIBILITY_TIMEOUT, SqsWorker  # noqa: E402
+
 
 # ConfigurationHistoryDeliveryCompleted is just a bundle of
 # ConfigurationItemChangeNotification which we process separately.
@@ -49,16 +58,17 @@ SKIP_MESSAGE_TYPES = [
     'ConfigurationSnapshotDeliveryStarted'
 ]
 
+# Objects the CMDB mirror finds unchanged, or terminated already, aren't sent
+SKIPPED_MIRROR_OUTCOMES = [UNCHANGED, TERMINATED]
+
 
 def get_file_from_s3(bucket, key):
     '''Returns a key/file from S3 as object'''
     logging.debug("Function start")
-    s3 = boto3.client('s3')
     try:
-        obj = s3.get_object(Bucket=bucket, Key=key)
+        obj = get_s3_client().get_object(Bucket=bucket, Key=key)
     except Exception as e:
-        logging.fatal("Failed to download file from s3://%s/%s: %s" % (bucket, key, e))
-        sys.exit(1)
+        raise S3DownloadError("Failed to download file from s3://%s/%s: %s" % (bucket, key, e))
 
     return obj['Body'].read()
 
@@ -71,55 +81,64 @@ def gunzip_object(obj):
 def get_file_from_s3_and_return_as_gunzip_json(bucket, key):
     '''Downloads the file from S3 and return it as gunziped json'''
     logging.debug("Function start")
-    obj = get_file_from_s3(bucket, key)
-    if key.endswith('.gz'):
-        obj = gunzip_object(obj)
-    if key.endswith('.json.gz'):
-        message = json.loads(obj)
-    else:
-        logging.fatal("File in S3 didn't end in .json.gz: %s" % key)
-        sys.exit(1)
+    _check_json_gz_key(key)
+    return load_gunzip_json(bucket, key)
 
-    return message
+
+def get_configuration_items_from_s3(bucket, key):
+    '''Yields the configurationItems of a snapshot file in S3 one by one,
+    without loading the entire file into memory'''
+    logging.debug("Function start")
+    _check_json_gz_key(key)
+    return iter_gunzip_json_array(bucket, key, 'configurationItems')
+
+
+def get_configuration_item_blocks_from_s3(bucket, key):
+    '''Yields the configurationItems of a snapshot file in S3 as blocks of
+    json text, for map_blocks_parallel'''
+    logging.debug("Function start")
+    _check_json_gz_key(key)
+    return iter_gunzip_json_array_blocks(bucket, key, 'configurationItems', DEFAULT_BLOCK_SIZE)
+
+
+def _check_json_gz_key(key):
+    if not key.endswith('.json.gz'):
+        raise InvalidMessageError("File in S3 didn't end in .json.gz: %s" % key)
 
 
 def config_change_notification(message, args):
     '''Process ConfigurationItemChangeNotification & "adjusted" ConfigurationSnapshotDeliveryCompleted messages'''
     logging.debug("Function start")
-    resource_type = message['configurationItem']['resourceType']
+    handler, snowObject = map_configuration_item(message)
+    if handler is not None and handler.submit:
+        submit_to_snow(message, snowObject, args)
+
 
-    # Resources to skip right away
-    if resource_type not in ACCEPT_RESOURCES:
-        logging.debug("Skipping %s" % resource_type)
+def submit_to_snow(message, snowObject, args):
+    '''Adds the object to SNOW unless the CMDB mirror or the state store
+    know that SNOW has this or newer data already'''
+    resource_type = message['configurationItem']['resourceType']
+    cmdb_mirror = args.get('cmdb_mirror')
+    lookup = cmdb_mirror.lookup(resource_type, snowObject.snow_data()) if cmdb_mirror is not None else None
+    if lookup is not None and lookup.outcome in SKIPPED_MIRROR_OUTCOMES:
+        logging.debug("Skipping %s %s, the CMDB has it %s" % (resource_type, message['configurationItem']['resourceId'], lookup.outcome))
         return
 
-    if resource_type == 'AWS::EC2::Instance':
-        snowObject = SnowEc2Object(message)
-        snowObject.add_to_snow(args)
-    elif resource_type == 'AWS::ElasticLoadBalancingV2::LoadBalancer':
-        snowObject = SnowElbObject(message)
-        #snowObject.add_to_snow(args)
-    elif resource_type == 'AWS::ElasticLoadBalancing::LoadBalancer':
-        snowObject = SnowElbObject(message)
-        #snowObject.add_to_snow(args)
-    elif resource_type == 'AWS::S3::Bucket':
-        snowObject = SnowS3Object(message)
-    elif resource_type == 'AWS::SSM::ManagedInstanceInventory':
-        snowObject = SnowSSMInventoryObject(message)
-        #snowObject.add_to_snow(args)
-    elif resource_type == 'AWS::RDS::DBInstance':
-        snowObject = SnowRDSObject(message)
-    else:
-        logging.warning("NEW ConfigurationItemChangeNotification kind: %s" % resource_type)
+    state_store = args.get('state_store')
+    if state_store is not None and not state_store.should_submit(message['configurationItem'], snowObject.state_data(), args.get('message_id')):
         return
 
+    snowObject.add_to_snow(args)
+    if lookup is not None:
+        cmdb_mirror.forget(resource_type, snowObject.snow_data())
+
 
 def process_single_message(message, args):
     '''Processes a single message'''
     if 'messageType' not in message:
         logging.fatal("Unknown and unsupported message that doesn't contain messageType")
         pprint.pprint(message)
-        sys.exit(1)
+        raise InvalidMessageError("Message doesn't contain messageType")
 
     message_type = message['messageType']
     logging.info("Processing %s" % message_type)
@@ -127,43 +146,50 @@ def process_single_message(message, args):
     # Skip messages we don't want based on the message type
     if message_type in SKIP_MESSAGE_TYPES:
         logging.debug("Skipping message type %s" % message_type)
+        metrics.count('SkippedMessages', messageType=message_type)
         return
 
+    with metrics.timer('MessageTime', messageType=message_type):
+        _process_message(message, message_type, args)
+
+
+def _process_message(message, message_type, args):
+    '''Processes a single message of message_type'''
     # All notification kinds see
     # https://docs.aws.amazon.com/config/latest/developerguide/notifications-for-AWS-Config.html
     if message_type == 'ConfigurationItemChangeNotification':
         config_change_notification(message, args)
 
     elif message_type == 'OversizedConfigurationItemChangeNotification':
-        # Skipping messages we don't care about. Saves a S3 download step
-        if 'configurationItemSummary' in message and 'resourceType' in message['configurationItemSummary']:
-            s3_resource_type = message['configurationItemSummary']['resourceType']
-            if s3_resource_type not in ACCEPT_RESOURCES:
-                logging.debug("Skipping in S3 hidden resource type %s" % s3_resource_type)
-                return
-
-        # Checking for S3 error
-        if message['s3DeliverySummary']['errorCode'] is not None or message['s3DeliverySummary']['errorMessage'] is not None:
-            logging.fatal("S3 delivery failed: %s - %s" % (message['s3DeliverySummary']['errorCode'], message['s3DeliverySummary']['errorMessage']))
-            sys.exit(1)
+        location = _oversized_location(message)
+        if location is None:
+            return
 
         # Download & process
-        bucket, key = message['s3DeliverySummary']['s3BucketLocation'].split("/", 1)
-        s3_message = get_file_from_s3_and_return_as_gunzip_json(bucket, key)
+        s3_message = get_file_from_s3_and_return_as_gunzip_json(*location)
         logging.debug("Reprocessing message we retrieved from S3")
         process_single_message(s3_message, args)
 
-    elif message_type == 'ConfigurationSnapshotDeliveryCompleted':
-        s3_message = get_file_from_s3_and_return_as_gunzip_json(message['s3Bucket'], message['s3ObjectKey'])
+    elif message_type == 'ConfigurationSnapshotDeliveryCompleted' and args.get('map_processes') and not args.get('fanout_queue_url'):
+        # Backfill: the items are mapped on all cores, submitted from here
+        blocks = get_configuration_item_blocks_from_s3(message['s3Bucket'], message['s3ObjectKey'])
+        for item_keys, snowObject in map_blocks_parallel(blocks, args['map_processes']):
+            submit_to_snow({'configurationItem': item_keys}, snowObject, args)
 
-        for item in s3_message['configurationItems']:
+    elif message_type == 'ConfigurationSnapshotDeliveryCompleted':
+        for item in _snapshot_items(message, args):
             # Simulate a change_message so we only need one function to
             # process the data
             simulated_change_message = {
                 'configurationItem': item,
             }
-            # TODO: add to SQS to reduce runtime.
             config_change_notification(simulated_change_message, args)
+
+    elif message_type == CHUNK_MESSAGE_TYPE:
+        # Chunk of a snapshot we fanned out ourselves
+        logging.debug("Processing %s items from %s" % (len(message['configurationItems']), message['source']))
+        for item in message['configurationItems']:
+            config_change_notification({'configurationItem': item}, args)
     else:
         logging.warning("NEW resource messageType: %s" % message_type)
         return
@@ -172,29 +198,326 @@ def process_single_message(message, args):
     # "messageType": "OversizedConfigurationItemChangeDeliveryFailed",
 
 
+def _oversized_location(message):
+    '''Returns (bucket, key) of the item of an
+    OversizedConfigurationItemChangeNotification, None to skip it'''
+    # Skipping messages we don't care about. Saves a S3 download step
+    if 'configurationItemSummary' in message and 'resourceType' in message['configurationItemSummary']:
+        s3_resource_type = message['configurationItemSummary']['resourceType']
+        if s3_resource_type not in ACCEPT_RESOURCES:
+            logging.debug("Skipping in S3 hidden resource type %s" % s3_resource_type)
+            metrics.count('SkippedConfigurationItems')
+            return None
+
+    # Checking for S3 error
+    if message['s3DeliverySummary']['errorCode'] is not None or message['s3DeliverySummary']['errorMessage'] is not None:
+        raise S3DownloadError("S3 delivery failed: %s - %s" % (message['s3DeliverySummary']['errorCode'], message['s3DeliverySummary']['errorMessage']))
+
+    bucket, key = message['s3DeliverySummary']['s3BucketLocation'].split("/", 1)
+    return bucket, key
+
+
+def _snapshot_items(message, args):
+    '''Returns a lazy iterator over the items of a
+    ConfigurationSnapshotDeliveryCompleted we process ourselves'''
+    items = get_configuration_items_from_s3(message['s3Bucket'], message['s3ObjectKey'])
+
+    # Send the items back to SQS in chunks so they get processed in
+    # parallel. Only items too big for a SQS message are processed here
+    if args.get('fanout_queue_url'):
+        source = "s3://{}/{}".format(message['s3Bucket'], message['s3ObjectKey'])
+        items = fan_out_configuration_items(items, ACCEPT_RESOURCES, args['fanout_queue_url'], source,
+                                            chunk_bytes=int(args.get('fanout_chunk_bytes') or DEFAULT_CHUNK_BYTES))
+    return items
+
+
+async def process_single_message_async(message, args, blocking):
+    '''process_single_message for the asyncio pipeline. S3 downloads,
+    mapping and the lookups in the CMDB mirror and the state store run on
+    blocking, args['snow_submitter'] posts the rows in the background'''
+    # The rows go back to the submitter on the loop
+    args = dict(args, snow_submitter=args['snow_submitter'].threadsafe())
+    message_type = message.get('messageType')
+    if message_type == 'OversizedConfigurationItemChangeNotification':
+        logging.info("Processing %s" % message_type)
+        with metrics.timer('MessageTime', messageType=message_type):
+            location = _oversized_location(message)
+            if location is None:
+                return
+            s3_message = await blocking.call(get_file_from_s3_and_return_as_gunzip_json, *location)
+            logging.debug("Reprocessing message we retrieved from S3")
+            await blocking.call(process_single_message, s3_message, args)
+
+    elif message_type == 'ConfigurationSnapshotDeliveryCompleted':
+        logging.info("Processing %s" % message_type)
+        with metrics.timer('MessageTime', messageType=message_type):
+            async for items in blocking.iterate(_snapshot_items(message, args)):
+                await blocking.call(_process_items, items, args)
+
+    else:
+        await blocking.call(process_single_message, message, args)
+
+
+def _process_items(items, args):
+    '''Processes configurationItems like change notifications'''
+    for item in items:
+        config_change_notification({'configurationItem': item}, args)
+
+
+def coalesce_batch(messages, args):
+    '''Drops the change notifications of the batch a newer one of the same
+    resource supersedes. Returns the (message_id, message) tuples to process
+    and the ids of the dropped messages, they count as processed'''
+    messages = list(messages)
+    if not args.get('coalesce'):
+        return messages, []
+    # With the package index of the state store the SSM inventory rows no
+    # longer depend on the configurationItemDiff
+    return coalesce_messages(messages, coalesce_diffs=args.get('state_store') is not None)
+
+
+def flush_snow_submitter(args):
+    '''Sends everything still buffered for SNOW. Returns the message ids
+    with failed rows, the other rows of a chunk are submitted nonetheless'''
+    return _failed_snow_rows(args['snow_submitter'].flush())
+
+
+def _failed_snow_rows(results):
+    '''Logs the SNOW row results, returns the message ids with failed rows'''
+    failed = [result for result in results if not result.ok]
+    logging.info("Submitted %s rows to SNOW, %s failed" % (len(results), len(failed)))
+
+    for result in failed:
+        logging.fatal("Failed to submit row of message %s to SNOW table %s. Status: %s, Error: %s" % (result.tag, result.table, result.status, result.message))
+    return set([result.tag for result in failed])
+
+
+def prefetch_state(messages, args):
+    '''Reads the stored state of every resource of the batch up front, in
+    batches instead of a read per resource'''
+    state_store = args.get('state_store')
+    if state_store is None:
+        return
+
+    keys = []
+    for message_id, message in messages:
+        items = [message['configurationItem']] if message.get('configurationItem') else message.get('configurationItems') or []
+        for item in items:
+            if item.get('resourceType') in ACCEPT_RESOURCES and item.get('resourceId') and get_handler(item['resourceType']).submit:
+                keys.extend(_state_keys(item))
+    state_store.prefetch(keys)
+
+
+def _state_keys(item):
+    '''State store keys processing item reads'''
+    keys = [resource_key(item)]
+    if item['resourceType'] == 'AWS::SSM::ManagedInstanceInventory':
+        from snow_objects.ssm_inventory import PACKAGE_INDEX_KEY
+        keys.append(PACKAGE_INDEX_KEY.format(account=item['awsAccountId'], region=item.get('awsRegion') or None, instance=item['resourceId']))
+    return keys
+
+
+def _discard_staged(messages, args):
+    '''Drops the state store records the messages staged, unless
+    _finish_messages committed them already. A warm container must not
+    commit them with a later batch'''
+    state_store = args.get('state_store')
+    if state_store is not None:
+        state_store.discard([message_id for message_id, message in messages])
+
+
+def process_messages(messages, args):
+    '''Processes (message_id, message) tuples in parallel on
+    args['snow_workers'] threads. Returns the message ids that failed'''
+    messages, superseded = coalesce_batch(messages, args)
+    try:
+        if _snow_degraded(args):
+            return _spill_or_hand_back(messages, superseded, args)
+        return _process_messages(messages, superseded, args)
+    finally:
+        _discard_staged(messages, args)
+
+
+def _process_messages(messages, superseded, args):
+    prefetch_state(messages, args)
+    message_ids = list(superseded)
+    executor = SnowSubmissionExecutor(args.get('snow_workers'))
+    for message_id, message in messages:
+        # Remember the origin of every SNOW row
+        executor.submit(message_id, process_single_message, message, dict(args, message_id=message_id))
+        message_ids.append(message_id)
+
+    failed = set()
+    for outcome in executor.wait():
+        if not outcome.ok:
+            logging.fatal("Failed to process message %s: %r" % (outcome.tag, outcome.error), exc_info=outcome.error)
+            failed.add(outcome.tag)
+    executor.shutdown()
+
+    failed.update(flush_snow_submitter(args))
+    return _finish_messages(message_ids, failed, args)
+
+
+def process_messages_async(messages, args):
+    '''process_messages on an asyncio event loop. Every message is in flight
+    at once, up to args['s3_concurrency'] blocking calls (S3 downloads,
+    mapping, state store and CMDB mirror lookups) and args['snow_concurrency']
+    SNOW POSTs. Returns the message ids that failed'''
+    messages, superseded = coalesce_batch(messages, args)
+    try:
+        if _snow_degraded(args):
+            return _spill_or_hand_back(messages, superseded, args)
+        return aio.run(_process_messages_async(messages, superseded, args))
+    finally:
+        _discard_staged(messages, args)
+
+
+async def _process_messages_async(messages, superseded, args):
+    blocking = BlockingCalls(args.get('s3_concurrency') or DEFAULT_S3_CONCURRENCY)
+    args = dict(args, snow_submitter=AsyncSnowBatchSubmitter(args))
+    failed = set()
+
+    async def process(message_id, message):
+        try:
+            # Remember the origin of every SNOW row
+            await process_single_message_async(message, dict(args, message_id=message_id), blocking)
+        except Exception as e:
+            logging.fatal("Failed to process message %s: %r" % (message_id, e), exc_info=e)
+            failed.add(message_id)
+
+    try:
+        await blocking.call(prefetch_state, messages, args)
+        await asyncio.gather(*[process(message_id, message) for message_id, message in messages])
+        failed.update(_failed_snow_rows(await args['snow_submitter'].flush()))
+    finally:
+        blocking.shutdown()
+    return _finish_messages(superseded + [message_id for message_id, message in messages], failed, args)
+
+
+def _snow_degraded(args):
+    '''Whether the rows go to the spill buffer instead of SNOW'''
+    return args.get('spill_mode') == 'always' or snow_unavailable(args)
+
+
+def _spill_or_hand_back(messages, superseded, args):
+    '''Processes the messages into the spill buffer in S3 while SNOW is
+    degraded, replay-spilled-rows.py sends them to SNOW later. Without spill
+    buffer the messages go back to SQS'''
+    if not args.get('spill_url'):
+        return _hand_back(messages, superseded, args)
+
+    logging.warning("SNOW is degraded, spilling the rows of %s messages to %s" % (len(messages), args['spill_url']))
+    metrics.count('SpilledMessages', len(messages))
+    # Mapping is cheap compared to waiting for SNOW, the sync path will do
+    return _process_messages(messages, superseded, dict(args, snow_submitter=SpillSubmitter(args['spill_url'])))
+
+
+def _hand_back(messages, superseded, args):
+    '''Fails the messages without processing them, while the SNOW circuit
+    breaker is open. SQS delivers them again later'''
+    message_ids = [message_id for message_id, message in messages]
+    logging.error("SNOW is degraded, handing %s messages back to SQS" % len(message_ids))
+    metrics.count('HandedBackMessages', len(message_ids))
+    return _finish_messages(superseded + message_ids, set(message_ids), args)
+
+
+def _open_cmdb_mirror(args, full_sync=True):
+    '''Sets args['cmdb_mirror'] and syncs it if it is due. Without a mirror
+    that opens, the messages are processed without one'''
+    try:
+        args['cmdb_mirror'] = open_cmdb_mirror(args.get('cmdb_mirror_url'), args, seed_url=args.get('cmdb_mirror_seed'),
+                                               sync_seconds=args.get('cmdb_mirror_sync'), full_sync=full_sync)
+    except Exception as e:
+        logging.error("Failed to open the CMDB mirror, going on without it: %s" % e)
+        metrics.count('CmdbMirrorSyncErrors')
+        args['cmdb_mirror'] = None
+    if args['cmdb_mirror'] is not None:
+        args['cmdb_mirror'].maybe_sync(args)
+
+
+def _finish_messages(message_ids, failed, args):
+    '''Commits the state store and counts the processed messages'''
+    # Only now we know which submissions made it to SNOW
+    state_store = args.get('state_store')
+    if state_store is not None:
+        state_store.commit(failed, tags=message_ids)
+        logging.info("State store skipped %s unchanged and %s stale objects so far" % (state_store.skipped_unchanged, state_store.skipped_stale))
+
+    metrics.count('Messages', len(message_ids) - len(failed), outcome='ok')
+    metrics.count('Messages', len(failed), outcome='error')
+    return failed
+
+
 #
 # Lambda specific function
 #
 def lambda_handler_sqs(event, context):
-    args = lambda_arguments()
-    _logger_config(args)
-
-    records = event.get("Records", [])
-
+    try:
+        with metrics.timer('InvocationTime', handler='sqs'):
+            args = lambda_arguments()
+            _logger_config(args)
+            args['state_store'] = open_state_store(args.get('state_store_url'))
+            if context is not None:
+                # SNOW retries give up in time to return the batch response
+                args['deadline'] = time.monotonic() + context.get_remaining_time_in_millis() / 1000.0
+            # Full loads take longer than a batch may, sync-cmdb-mirror.py
+            # does them and uploads the seed
+            _open_cmdb_mirror(args, full_sync=False)
+
+            records = event.get("Records", [])
+            if args.get('async_mode'):
+                failed = process_messages_async(_decode_sqs_records(records), args)
+            else:
+                # Bound to the args of this invocation, its threads must not
+                # pile up in a warm container
+                args['snow_submitter'] = SnowBatchSubmitter(args)
+                try:
+                    failed = process_messages(_decode_sqs_records(records), args)
+                finally:
+                    args['snow_submitter'].shutdown()
+            log_pool_stats()
+            log_cache_stats()
+    finally:
+        # One set of EMF lines per invocation
+        metrics.flush()
+
+    # Partial batch response, SQS only redelivers the failed messages. Needs
+    # ReportBatchItemFailures on the event source mapping
+    if failed:
+        logging.fatal("Failed to process %s of %s messages" % (len(failed), len(records)))
+    return {'batchItemFailures': [{'itemIdentifier': message_id} for message_id in sorted(failed)]}
+
+
+def _decode_sqs_records(records):
+    '''Yields (message_id, message) of the AWS Config messages in SQS records'''
     for record in records:
-        try:
-            core_message = json.loads(record['body'])
-        except Exception as e:
-            logging.fatal("SQS message doesn't seem to be a valid json. Error: %s, message: %s" % (e, record['body']))
+        # Skip what we don't want before paying for decoding it
+        reason = skip_reason(record['body'], SKIP_MESSAGE_TYPES, ACCEPT_RESOURCES)
+        if reason is not None:
+            logging.debug("Skipping %s without decoding it" % reason)
+            metrics.count('SkippedRecords')
             continue
 
         try:
-            message = json.loads(core_message['Message'])
+            core_message = jsonlib.loads(record['body'])
         except Exception as e:
-            logging.fatal("SQS extracted message doesn't seem to contain 'Message' or isn't a valid json. Error %s: %s, message: %s" % (e, core_message))
+            logging.fatal("SQS message doesn't seem to be a valid json. Error: %s, message: %s" % (e, record['body']))
+            metrics.count('InvalidRecords')
             continue
 
-        process_single_message(message, args)
+        # Our own fan-out chunks are sent raw, like everything on a queue with
+        # SNS raw message delivery. Everything else comes in the SNS envelope
+        if 'messageType' in core_message:
+            message = core_message
+        else:
+            try:
+                message = jsonlib.loads(core_message['Message'])
+            except Exception as e:
+                logging.fatal("SQS extracted message doesn't seem to contain 'Message' or isn't a valid json. Error: %s, message: %s" % (e, core_message))
+                metrics.count('InvalidRecords')
+                continue
+
+        yield record.get('messageId'), message
 
 
 #
@@ -220,80 +543,38 @@ def lambda_handler_sns(event, context):
             continue
 
         try:
-            message = json.loads(record['Sns']['Message'])
+            message = jsonlib.loads(record['Sns']['Message'])
         except Exception as e:
             logging.fatal("SNS message doesn't seem to be a valid json. Error: %s, message: %s" % (e, record['Sns']['Message']))
             continue
 
         process_single_message(message, args)
+    metrics.flush()
 
 
 
-def get_secret_prod():
-    #secret = []
+def get_secret_prod(force_refresh=False):
+    '''Returns the SNOW credentials from Secrets Manager. The secret is cached
+    for SNOW_SECRET_TTL seconds within the lambda container'''
     secret_name = "snow-integration"
-    endpoint_url = "https://secretsmanager.us-east-1.amazonaws.com"
     region_name = "us-east-1"
-    session = boto3.session.Session()
-    client = session.client(
-        service_name='secretsmanager',
-        region_name=region_name
-        #endpoint_url=endpoint_url
-    )
-    try:
-        get_secret_value_response = client.get_secret_value(
-            SecretId=secret_name
-        )
-    except ClientError as e:
-        if e.response['Error']['Code'] == 'DecryptionFailureException':
-            # Secrets Manager can't decrypt the protected secret text using the provided KMS key.
-            # Deal with the exception here, and/or rethrow at your discretion.
-            raise e
-        elif e.response['Error']['Code'] == 'InternalServiceErrorException':
-            # An error occurred on the server side.
-            # Deal with the exception here, and/or rethrow at your discretion.
-            raise e
-        elif e.response['Error']['Code'] == 'InvalidParameterException':
-            # You provided an invalid value for a parameter.
-            # Deal with the exception here, and/or rethrow at your discretion.
-            raise e
-        elif e.response['Error']['Code'] == 'InvalidRequestException':
-            # You provided a parameter value that is not valid for the current state of the resource.
-            # Deal with the exception here, and/or rethrow at your discretion.
-            raise e
-        elif e.response['Error']['Code'] == 'ResourceNotFoundException':
-            # We can't find the resource that you asked for.
-            # Deal with the exception here, and/or rethrow at your discretion.
-            raise e
-    else:
-        # Decrypted secret using the associated KMS CMK
-        # Depending on whether the secret was a string or binary, one of these fields will be populated
-        logging.fatal("Eric Hello")
-        if 'SecretString' in get_secret_value_response:
-            secret = json.loads(get_secret_value_response['SecretString'])
-        else:
-            secret = base64.b64decode(get_secret_value_response['SecretBinary'])
-        
-    #Data is returned as a JSON string. used json.loads to parse out the credentials and hostname for the DB.
-    #logging.info("secret is ==>> "+secret[0])
-    #logging.info("get_secret_value_response is ==>" + get_secret_value_response['SecretString'][0])
-    
+    ttl = int(os.environ.get('SNOW_SECRET_TTL', DEFAULT_SECRET_TTL))
+
+    secret = get_cached_secret(secret_name, region_name, ttl=ttl, force_refresh=force_refresh)
+
     snow_username = secret['snow_user']
     snow_password = secret['snow_password']
     snow_hostname = secret['snow_hostname']
-    
-
 
-   # data = json.loads(secret[0])
-    #logging.info("data is ==> "+data)
-    #snow_username = data['snow_username']
-    #snow_password = data['snow_password']
-    #snow_hostname = data['snow_hostname']
-    
-    
-    
     return snow_username, snow_password, snow_hostname
 
+
+def refresh_snow_credentials():
+    '''Fetches the secret again, used by the SNOW client on a 401 in case the
+    password got rotated'''
+    snow_username, snow_password, snow_hostname = get_secret_prod(force_refresh=True)
+    return snow_username, snow_password
+
 #
 # Functions related to running it from a dev machine and not via lambda
 #
@@ -301,63 +582,134 @@ def get_secret_prod():
 #snow_username, snow_password, snow_hostname = get_secret_prod()
 def lambda_arguments():
     snow_username,snow_password,snow_hostname = get_secret_prod()
-    return {
+    args = {
         
         'snow_secret': os.environ['SNOW_SECRET'],
         'snow_hostname': snow_hostname,
+        'snow_scheme': os.environ.get('SNOW_SCHEME'),
         'snow_user': snow_username,
-        'snow_password': snow_password
+        'snow_password': snow_password,
+        'snow_credentials_refresh': refresh_snow_credentials,
+        'snow_pool_size': os.environ.get('SNOW_POOL_SIZE'),
+        'snow_batch_size': os.environ.get('SNOW_BATCH_SIZE'),
+        'snow_batch_bytes': os.environ.get('SNOW_BATCH_BYTES'),
+        'snow_workers': os.environ.get('SNOW_WORKERS'),
+        'snow_rate_limit': os.environ.get('SNOW_RATE_LIMIT'),
+        'fanout_queue_url': os.environ.get('SNOW_FANOUT_QUEUE_URL'),
+        'fanout_chunk_bytes': os.environ.get('SNOW_FANOUT_CHUNK_BYTES'),
+        'state_store_url': os.environ.get('SNOW_STATE_STORE'),
+        'async_mode': os.environ.get('SNOW_ASYNC', 'off').lower() in ['on', '1', 'true', 'yes'],
+        'snow_concurrency': os.environ.get('SNOW_CONCURRENCY'),
+        's3_concurrency': os.environ.get('SNOW_S3_CONCURRENCY'),
+        'coalesce': os.environ.get('SNOW_COALESCE', 'on').lower() in ['on', '1', 'true', 'yes'],
+        'spill_url': os.environ.get('SNOW_SPILL_URL'),
+        'spill_mode': os.environ.get('SNOW_SPILL', 'degraded'),
+        'cmdb_mirror_url': os.environ.get('SNOW_CMDB_MIRROR'),
+        'cmdb_mirror_seed': os.environ.get('SNOW_CMDB_MIRROR_SEED'),
+        'cmdb_mirror_sync': os.environ.get('SNOW_CMDB_MIRROR_SYNC'),
 #        'snow_hostname': os.environ['SNOW_HOSTNAME'],
 #        'snow_user': os.environ['SNOW_USER'],
 #        'snow_password': os.environ['SNOW_PASSWORD'],
 #        'debug': False
     }
+    error = spill_arguments_error(args)
+    if error is not None:
+        raise ValueError(error)
+    return args
+
+
+def spill_arguments_error(args):
+    '''Returns what is wrong with the spill arguments, None if nothing'''
+    if args.get('spill_mode') not in SPILL_MODES:
+        return "Unknown spill mode %s, expected one of %s" % (args.get('spill_mode'), ", ".join(SPILL_MODES))
+    if args.get('spill_mode') == 'always' and not args.get('spill_url'):
+        # Every batch would go back to SQS until it ends up in the DLQ
+        return "Spill mode always needs a spill URL"
+    return None
+
+
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Get minimum information required')
     parser.add_argument('--debug', '-d', dest='debug', action='store_true', required=False, help='Enable debugging output')
     parser.add_argument('--source-sqs-name', '-s', dest='source_sqs_name', default='', required=True, help='SQS queue name to take the data from')
     parser.add_argument('--region-sqs', '-r', dest='aws_region_sqs', default='', required=True, help='AWS Region of the SQS queue')
     parser.add_argument('--snow-hostname', '-n', dest='snow_hostname', default='', required=True, help='SNOW hostname, HOSTNAME in https://HOSTNAME/, no https etc.')
+    parser.add_argument('--snow-scheme', dest='snow_scheme', default='https', required=False, help='https, or http for a local SNOW stand-in')
     parser.add_argument('--snow-user', '-u', dest='snow_user', default='', required=True, help='SNOW API User')
     parser.add_argument('--snow-password', '-p', dest='snow_password', default='', required=True, help='SNOW API Password')
+    parser.add_argument('--snow-pool-size', dest='snow_pool_size', type=int, default=10, required=False, help='Max. number of kept alive connections to SNOW')
+    parser.add_argument('--snow-batch-size', dest='snow_batch_size', type=int, default=100, required=False, help='Max. number of rows per SNOW insertMultiple call')
+    parser.add_argument('--snow-batch-bytes', dest='snow_batch_bytes', type=int, default=1024 * 1024, required=False, help='Max. body size in bytes of a SNOW insertMultiple call')
+    parser.add_argument('--snow-workers', dest='snow_workers', type=int, default=4, required=False, help='Number of threads processing messages and submitting to SNOW')
+    parser.add_argument('--snow-rate-limit', dest='snow_rate_limit', type=float, default=0, required=False, help='Max. SNOW requests per second, 0 for no limit')
+    parser.add_argument('--async', dest='async_mode', action='store_true', required=False, help='Process the messages of a batch on an asyncio event loop, all at once')
+    parser.add_argument('--snow-concurrency', dest='snow_concurrency', type=int, default=DEFAULT_CONCURRENCY, required=False, help='Max. SNOW requests in flight with --async')
+    parser.add_argument('--s3-concurrency', dest='s3_concurrency', type=int, default=DEFAULT_S3_CONCURRENCY, required=False, help='Max. S3 downloads in flight with --async')
+    parser.add_argument('--map-processes', dest='map_processes', type=int, default=0, required=False, help='Map snapshot items on this many processes, e.g. the number of cores. 0 maps them on the processing threads')
+    parser.add_argument('--no-coalesce', dest='coalesce', action='store_false', required=False, help='Process every change notification of a batch, also those a newer one of the same resource supersedes')
+    parser.add_argument('--spill-url', dest='spill_url', default='', required=False, help='While SNOW is degraded write its rows to s3://bucket/prefix instead of handing the messages back to SQS')
+    parser.add_argument('--spill-mode', dest='spill_mode', choices=SPILL_MODES, default='degraded', required=False, help='degraded spills while the SNOW circuit breaker is open, always spills every row, e.g. during a SNOW maintenance')
+    parser.add_argument('--cmdb-mirror', dest='cmdb_mirror_url', default='', required=False, help='Skip objects the CMDB has already, mirrored in sqlite:///path/to/file.db')
+    parser.add_argument('--cmdb-mirror-seed', dest='cmdb_mirror_seed', default='', required=False, help='s3://bucket/key to start a new CMDB mirror from, see sync-cmdb-mirror.py')
+    parser.add_argument('--cmdb-mirror-sync', dest='cmdb_mirror_sync', type=int, default=60, required=False, help='Seconds between two fetches of the CMDB records updated meanwhile')
+    parser.add_argument('--state-store', dest='state_store_url', default='', required=False, help='Skip unchanged/stale objects, sqlite:///path/to/file.db or dynamodb://table-name')
+    parser.add_argument('--sqs-receivers', dest='sqs_receivers', type=int, default=DEFAULT_RECEIVERS, required=False, help='Number of threads long polling the SQS queue')
+    parser.add_argument('--sqs-processors', dest='sqs_processors', type=int, default=DEFAULT_PROCESSORS, required=False, help='Number of threads processing batches of SQS messages')
+    parser.add_argument('--sqs-batch-messages', dest='sqs_batch_messages', type=int, default=DEFAULT_BATCH_MESSAGES, required=False, help='Max. number of SQS messages processed as one batch')
+    parser.add_argument('--sqs-visibility-timeout', dest='sqs_visibility_timeout', type=int, default=DEFAULT_VISIBILITY_TIMEOUT, required=False, help='Visibility timeout of received messages, extended while they are processed')
+    parser.add_argument('--idle-exit', dest='sqs_idle_exit', type=int, default=20, required=False, help='Exit once the queue was empty for this many seconds, 0 to run until SIGTERM')
+    parser.add_argument('--fanout-queue-url', dest='fanout_queue_url', default='', required=False, help='SQS queue URL to fan out snapshot items to, processed inline if not set')
 
     args = parser.parse_args()
     # Make it a dictionary so we can simulate it in lambda
     args = vars(args)
+    error = spill_arguments_error(args)
+    if error is not None:
+        parser.error(error)
     return args
 
 
 def process_sqs(source_sqs_name, aws_region_sqs, args):
-    '''Takes the messages from the SQS queue and processes it'''
-    sqs_resource = boto3.resource('sqs', region_name=aws_region_sqs)
-
-    queue = sqs_resource.get_queue_by_name(QueueName=source_sqs_name)
-
-    # During dev work we hide messages for 30 seconds. To not end up in an
-    # endless loop lets check the count and exit when done.
-    logging.info("SQS queue length visible: %s, not visible: %s" % (queue.attributes['ApproximateNumberOfMessages'], queue.attributes['ApproximateNumberOfMessagesNotVisible']))
-    while int(queue.attributes['ApproximateNumberOfMessages']) > 0:
-        for raw_message in queue.receive_messages(MaxNumberOfMessages=10,
-                                                  VisibilityTimeout=30,
-                                                  WaitTimeSeconds=5):
-            message = json.loads(raw_message.body)
-            process_single_message(message, args)
-
-            # Cleanup everything we skip, saves processing time on multiple runs
-            if message['messageType'] in SKIP_MESSAGE_TYPES:
-                raw_message.delete()
-                logging.debug("Deleted message from SQS queue: %s" % message['messageType'])
-                continue
-
-            if 'configurationItemSummary' in message and message['configurationItemSummary']['resourceType'] not in ACCEPT_RESOURCES:
-                raw_message.delete()
-                logging.debug("Deleted message from SQS queue: %s" % message['configurationItemSummary']['resourceType'])
-                continue
-
-            if 'configurationItem' in message and message['configurationItem']['resourceType'] not in ACCEPT_RESOURCES:
-                raw_message.delete()
-                logging.debug("Deleted message from SQS queue: %s" % message['configurationItem']['resourceType'])
-                continue
+    '''Takes the messages from the SQS queue and processes them. Runs until
+    SIGTERM, or until the queue was empty for args['sqs_idle_exit'] seconds'''
+    import boto3
+    sqs_client = boto3.client('sqs', region_name=aws_region_sqs)
+    queue_url = sqs_client.get_queue_url(QueueName=source_sqs_name)['QueueUrl']
+    args['state_store'] = open_state_store(args.get('state_store_url'))
+    _open_cmdb_mirror(args)
+
+    # Batches are processed in parallel. Every processor thread needs its own
+    # submitter, flushing it must only return the rows of its own batch
+    processor = threading.local()
+
+    def process_batch(records):
+        if not hasattr(processor, 'args'):
+            processor.args = dict(args)
+            processor.args['snow_submitter'] = SnowBatchSubmitter(processor.args)
+        if args['cmdb_mirror'] is not None:
+            args['cmdb_mirror'].maybe_sync()
+
+        messages = _decode_sqs_records([{'messageId': message_id, 'body': body} for message_id, body in records])
+        if args.get('async_mode'):
+            # Every processor thread runs its own event loop
+            failed = process_messages_async(messages, processor.args)
+        else:
+            failed = process_messages(messages, processor.args)
+        if failed:
+            # They become visible again after the visibility timeout
+            logging.fatal("Failed to process messages %s" % ", ".join(sorted(failed)))
+        return failed
+
+    worker = SqsWorker(queue_url, process_batch, sqs_client,
+                       receivers=args.get('sqs_receivers') or DEFAULT_RECEIVERS,
+                       processors=args.get('sqs_processors') or DEFAULT_PROCESSORS,
+                       visibility_timeout=args.get('sqs_visibility_timeout') or DEFAULT_VISIBILITY_TIMEOUT,
+                       batch_messages=args.get('sqs_batch_messages') or DEFAULT_BATCH_MESSAGES,
+                       idle_exit=args.get('sqs_idle_exit') or 0)
+    worker.run()
+    close_mapping_pools()
+    log_pool_stats()
+    log_cache_stats()
 
 
 def _logger_config(args):
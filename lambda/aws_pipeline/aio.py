@@ -0,0 +1,54 @@
+# Event loop and blocking calls for the asyncio pipeline
+# The lambda runtime is python3.6, no asyncio.run. Every thread gets one
+# event loop that lives as long as the process, what is bound to the loop,
+# like the aiohttp session to SNOW, survives between warm invocations.
+# boto3, the streaming gunzip/json parser and the state store and CMDB mirror
+# lookups block, they run on a bounded thread pool so at most that many S3
+# downloads and lookups are in flight
+import asyncio
+import concurrent.futures
+import functools
+import itertools
+import threading
+
+DEFAULT_S3_CONCURRENCY = 8
+# Snapshot items taken from the streaming parser per executor call
+DEFAULT_ITEMS_PER_CALL = 100
+
+_local = threading.local()
+
+
+def run(coroutine):
+    '''Runs coroutine to completion on the event loop of this thread'''
+    loop = getattr(_local, 'loop', None)
+    if loop is None or loop.is_closed():
+        loop = _local.loop = asyncio.new_event_loop()
+    return loop.run_until_complete(coroutine)
+
+
+def _take(iterator, count):
+    return list(itertools.islice(iterator, count))
+
+
+class BlockingCalls():
+    '''Runs blocking functions on up to workers threads'''
+    def __init__(self, workers=DEFAULT_S3_CONCURRENCY):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, int(workers)))
+
+    async def call(self, fn, *fn_args):
+        return await asyncio.get_event_loop().run_in_executor(self.executor, functools.partial(fn, *fn_args))
+
+    async def iterate(self, iterable, chunk_size=DEFAULT_ITEMS_PER_CALL):
+        '''Yields lists of up to chunk_size items of a blocking iterable. The
+        next list is read while the caller works on the current one'''
+        iterator = iter(iterable)
+        pending = asyncio.ensure_future(self.call(_take, iterator, chunk_size))
+        while True:
+            chunk = await pending
+            if not chunk:
+                return
+            pending = asyncio.ensure_future(self.call(_take, iterator, chunk_size))
+            yield chunk
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
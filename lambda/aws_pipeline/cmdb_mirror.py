@@ -0,0 +1,333 @@
+# Local mirror of the CMDB tables the pipeline writes to
+# A sqlite file with the records of every table in RECONCILE_TARGETS, keyed by
+# the lower cased resourceId (asset_tag). Lookups are a local point query
+# instead of a Table API round trip per CI, submit_to_snow uses them to skip
+# rows that wouldn't change the CMDB record and late updates of instances
+# that are terminated already.
+#
+# The first sync loads the tables with paged Table API reads, in parallel
+# partitions by sys_id range. Later syncs only fetch the records with a
+# sys_updated_on since the last one. Deltas don't see records deleted in
+# SNOW, a full load every DEFAULT_FULL_SYNC_SECONDS drops them.
+#
+# A lambda container would start with an empty /tmp. The mirror file can be
+# seeded from S3, sync-cmdb-mirror.py keeps the copy there current. Lambdas
+# leave the full loads to it: without a seed their lookups find every record
+# missing, and their deltas stop after a share of the time the invocation
+# has. Deltas go by sys_updated_on, the next one goes on from there.
+import collections
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from snow_objects.executor import SnowSubmissionExecutor
+from snow_objects.table import DEFAULT_PAGE_SIZE, iter_table_records, query_value
+from .metrics import metrics
+from .reconcile import RECONCILE_TARGETS, changed_fields, cmdb_fields
+from .s3_cache import get_s3_client
+from .s3_stream import parse_s3_url
+
+# Seconds between two delta fetches
+DEFAULT_SYNC_SECONDS = 60
+# Seconds between two full loads
+DEFAULT_FULL_SYNC_SECONDS = 24 * 3600
+# Full loads read this many sys_id ranges at once
+DEFAULT_PARTITIONS = 8
+# Records written per transaction
+WRITE_BATCH_SIZE = 1000
+# Share of the time left until args['deadline'] a sync may take, the rest is
+# for the messages
+SYNC_DEADLINE_SHARE = 0.25
+
+# Every record has them, the watermark of the deltas is the latest
+# sys_updated_on seen
+SYSTEM_FIELDS = ('sys_id', 'sys_updated_on')
+
+# Lookup outcomes
+MISSING = 'missing'
+CHANGED = 'changed'
+UNCHANGED = 'unchanged'
+TERMINATED = 'terminated'
+
+# What a lookup found. record is None if the CMDB doesn't have the resource
+MirrorLookup = collections.namedtuple('MirrorLookup', ['outcome', 'record'])
+
+_mirrors = {}
+_mirrors_lock = threading.Lock()
+
+
+def mirror_fields(resource_type):
+    '''CMDB fields the mirror keeps for resource_type'''
+    target = RECONCILE_TARGETS[resource_type]
+    return cmdb_fields(target) + [field for field in SYSTEM_FIELDS if field not in target.fields.values()]
+
+
+def sys_id_partitions(count):
+    '''Encoded query conditions of count sys_id ranges that cover all
+    records. sys_ids are random hex, the ranges get about the same share'''
+    count = max(1, min(256, count))
+    bounds = ['%02x' % (index * 256 // count) for index in range(1, count)]
+    partitions = []
+    for index in range(count):
+        conditions = []
+        if index > 0:
+            conditions.append('sys_id>={}'.format(bounds[index - 1]))
+        if index < count - 1:
+            conditions.append('sys_id<{}'.format(bounds[index]))
+        partitions.append(conditions)
+    return partitions
+
+
+class CmdbMirror():
+    '''CMDB records in a sqlite file. args has the SNOW credentials. Without
+    full_sync only sync(full=True) loads a table completely, other syncs
+    only fetch deltas, of the tables the mirror has already'''
+    def __init__(self, path, args, partitions=DEFAULT_PARTITIONS, sync_seconds=DEFAULT_SYNC_SECONDS,
+                 full_sync_seconds=DEFAULT_FULL_SYNC_SECONDS, page_size=DEFAULT_PAGE_SIZE, full_sync=True):
+        self.path = path
+        # Args only here to not accidently expose the credentials
+        self.args = args
+        self.partitions = partitions
+        self.sync_seconds = sync_seconds
+        self.full_sync_seconds = full_sync_seconds
+        self.full_sync = full_sync
+        self.page_size = page_size
+        self._last_sync = 0
+        self._sync_lock = threading.Lock()
+
+        self._db_lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS cmdb_record (cmdb_table TEXT NOT NULL, record_key TEXT NOT NULL, "
+                         "sys_id TEXT, sys_updated_on TEXT, generation INTEGER NOT NULL, record TEXT NOT NULL, "
+                         "PRIMARY KEY (cmdb_table, record_key))")
+        self._db.execute("CREATE TABLE IF NOT EXISTS cmdb_sync (cmdb_table TEXT PRIMARY KEY, generation INTEGER NOT NULL, "
+                         "watermark TEXT, full_sync_at REAL NOT NULL)")
+        self._db.commit()
+
+    def get(self, cmdb_table, key):
+        '''Returns the record of key in cmdb_table, None if the CMDB doesn't have it'''
+        with self._db_lock:
+            row = self._db.execute("SELECT record FROM cmdb_record WHERE cmdb_table = ? AND record_key = ?",
+                                   (cmdb_table, key.lower())).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def lookup(self, resource_type, data):
+        '''Compares the mapped SNOW data of resource_type with the CMDB
+        record. None if the mirror doesn't keep resource_type'''
+        target = RECONCILE_TARGETS.get(resource_type)
+        if target is None or not data.get(target.key_field):
+            return None
+
+        record = self.get(target.cmdb_table, data[target.key_field])
+        if record is None:
+            outcome = MISSING
+        elif record.get(target.fields[target.deleted_field]) == target.deleted_value and data.get(target.deleted_field) != target.deleted_value:
+            # Resources don't come back, this is an update from before the DELETE
+            outcome = TERMINATED
+        elif changed_fields(data, record, target.fields):
+            outcome = CHANGED
+        else:
+            outcome = UNCHANGED
+        metrics.count('CmdbMirrorLookups', resourceType=resource_type, outcome=outcome)
+        return MirrorLookup(outcome, record)
+
+    def forget(self, resource_type, data):
+        '''Drops the record of a resource that is submitted to SNOW. Until the
+        next sync fetches it again its lookups find it missing, a change back
+        to what the mirror had isn't mistaken for a no-op'''
+        target = RECONCILE_TARGETS.get(resource_type)
+        if target is None or not data.get(target.key_field):
+            return
+        with self._db_lock:
+            with self._db:
+                self._db.execute("DELETE FROM cmdb_record WHERE cmdb_table = ? AND record_key = ?",
+                                 (target.cmdb_table, data[target.key_field].lower()))
+
+    def sys_id(self, resource_type, resource_id):
+        '''Returns the sys_id of the CMDB record of a resource, None if unknown'''
+        target = RECONCILE_TARGETS.get(resource_type)
+        record = self.get(target.cmdb_table, resource_id) if target is not None else None
+        return record.get('sys_id') if record is not None else None
+
+    def maybe_sync(self, args=None):
+        '''Syncs unless the last sync was less than sync_seconds ago. While one
+        thread syncs the others go on with what the mirror has, also if the
+        sync fails. args replaces the args of the mirror, e.g. with the
+        deadline of this lambda invocation'''
+        if time.monotonic() - self._last_sync < self.sync_seconds or not self._sync_lock.acquire(blocking=False):
+            return
+        try:
+            if args is not None:
+                self.args = args
+            if time.monotonic() - self._last_sync >= self.sync_seconds:
+                self.sync(deadline=self._sync_deadline())
+        except Exception as e:
+            logging.error("Failed to sync the CMDB mirror, going on with what it has: %s" % e)
+            metrics.count('CmdbMirrorSyncErrors')
+            self._last_sync = time.monotonic()
+        finally:
+            self._sync_lock.release()
+
+    def _sync_deadline(self):
+        deadline = self.args.get('deadline')
+        if deadline is None:
+            return None
+        now = time.monotonic()
+        return now + max(0, deadline - now) * SYNC_DEADLINE_SHARE
+
+    def sync(self, full=False, deadline=None):
+        '''Brings every mirrored table up to date. Deltas stop at deadline, a
+        time.monotonic(). Returns {table: records fetched}'''
+        fetched = {}
+        for resource_type, target in sorted(RECONCILE_TARGETS.items()):
+            state = self._sync_state(target.cmdb_table)
+            fields = mirror_fields(resource_type)
+            start = time.perf_counter()
+            due = state is None or time.time() - state['full_sync_at'] >= self.full_sync_seconds
+            if full or (due and self.full_sync):
+                fetched[target.cmdb_table] = self._full_load(target, fields, state)
+                kind = 'full'
+            elif state is None:
+                logging.warning("CMDB mirror has no %s, not seeded? Leaving the full load to sync-cmdb-mirror.py" % target.cmdb_table)
+                metrics.count('CmdbMirrorSkippedSyncs', table=target.cmdb_table)
+                continue
+            else:
+                fetched[target.cmdb_table] = self._delta(target, fields, state, deadline)
+                kind = 'delta'
+            seconds = time.perf_counter() - start
+            metrics.count('CmdbMirrorRecords', fetched[target.cmdb_table], table=target.cmdb_table, sync=kind)
+            logging.info("CMDB mirror %s sync of %s: %s records in %.1fs" % (kind, target.cmdb_table, fetched[target.cmdb_table], seconds))
+        self._last_sync = time.monotonic()
+        return fetched
+
+    def _full_load(self, target, fields, state):
+        '''Reads the whole table, in parallel sys_id ranges. Records the load
+        didn't see are gone from the CMDB'''
+        generation = state['generation'] + 1 if state is not None else 1
+        started = time.time()
+        executor = SnowSubmissionExecutor(self.partitions)
+        for conditions in sys_id_partitions(self.partitions):
+            executor.submit(conditions, self._fetch, target, fields, conditions, generation)
+        outcomes = executor.wait()
+        executor.shutdown()
+        for outcome in outcomes:
+            if not outcome.ok:
+                # The previous generation stays, deltas go on from its watermark
+                raise outcome.error
+
+        watermarks = [outcome.result[1] for outcome in outcomes if outcome.result[1]]
+        with self._db_lock:
+            with self._db:
+                self._db.execute("DELETE FROM cmdb_record WHERE cmdb_table = ? AND generation != ?", (target.cmdb_table, generation))
+                self._db.execute("INSERT OR REPLACE INTO cmdb_sync (cmdb_table, generation, watermark, full_sync_at) VALUES (?, ?, ?, ?)",
+                                 (target.cmdb_table, generation, max(watermarks) if watermarks else None, started))
+        return sum([outcome.result[0] for outcome in outcomes])
+
+    def _delta(self, target, fields, state, deadline=None):
+        '''Fetches the records updated since the watermark, those updated in
+        the second of the watermark again. In the order they were updated, a
+        delta stopped at deadline moved the watermark as far as it got'''
+        conditions = ['sys_updated_on>={}'.format(query_value(state['watermark']))] if state['watermark'] else []
+        count, watermark = self._fetch(target, fields, conditions, state['generation'], 'sys_updated_on', deadline)
+        if watermark and watermark > (state['watermark'] or ''):
+            with self._db_lock:
+                with self._db:
+                    self._db.execute("UPDATE cmdb_sync SET watermark = ? WHERE cmdb_table = ?", (watermark, target.cmdb_table))
+        return count
+
+    def _fetch(self, target, fields, conditions, generation, order_field='sys_id', deadline=None):
+        '''Stores the records matching conditions, sorted by order_field,
+        until deadline. Returns how many there were and their latest
+        sys_updated_on'''
+        count = 0
+        watermark = ''
+        rows = []
+        for record in iter_table_records(self.args, target.cmdb_table, conditions, fields, order_field, page_size=self.page_size):
+            if deadline is not None and time.monotonic() >= deadline:
+                logging.info("CMDB mirror sync of %s stopped at the deadline, at %s" % (target.cmdb_table, watermark))
+                metrics.count('CmdbMirrorPartialSyncs', table=target.cmdb_table)
+                break
+            count += 1
+            watermark = max(watermark, record.get('sys_updated_on') or '')
+            key = record.get(target.fields[target.key_field])
+            if key:
+                rows.append((target.cmdb_table, key.lower(), record.get('sys_id'), record.get('sys_updated_on'),
+                             generation, json.dumps(record)))
+            if len(rows) >= WRITE_BATCH_SIZE:
+                self._write(rows)
+                rows = []
+        self._write(rows)
+        return count, watermark
+
+    def _write(self, rows):
+        if not rows:
+            return
+        with self._db_lock:
+            with self._db:
+                self._db.executemany("INSERT OR REPLACE INTO cmdb_record (cmdb_table, record_key, sys_id, sys_updated_on, generation, record) "
+                                     "VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+    def _sync_state(self, cmdb_table):
+        with self._db_lock:
+            row = self._db.execute("SELECT generation, watermark, full_sync_at FROM cmdb_sync WHERE cmdb_table = ?", (cmdb_table,)).fetchone()
+        if row is None:
+            return None
+        return {'generation': row[0], 'watermark': row[1], 'full_sync_at': row[2]}
+
+    def upload(self, seed_url):
+        '''Copies the mirror file to S3, for lambdas to start from'''
+        bucket, key = parse_s3_url(seed_url)
+        # Every write commits under the lock, the file is consistent meanwhile
+        with self._db_lock:
+            with open(self.path, 'rb') as mirror_file:
+                body = mirror_file.read()
+        get_s3_client().put_object(Bucket=bucket, Key=key, Body=body)
+        logging.info("Uploaded the CMDB mirror to %s, %s bytes" % (seed_url, len(body)))
+
+    def close(self):
+        with self._db_lock:
+            self._db.close()
+
+
+def download_seed(seed_url, path):
+    '''Copies the mirror file from S3 to path, unless path exists already.
+    Returns if it did'''
+    if os.path.exists(path):
+        return False
+    bucket, key = parse_s3_url(seed_url)
+    try:
+        body = get_s3_client().get_object(Bucket=bucket, Key=key)['Body']
+    except Exception as e:
+        logging.warning("No CMDB mirror seed at %s, loading it from SNOW: %s" % (seed_url, e))
+        return False
+
+    partial = path + '.partial'
+    with open(partial, 'wb') as seed_file:
+        for chunk in iter(lambda: body.read(1024 * 1024), b''):
+            seed_file.write(chunk)
+    os.replace(partial, path)
+    logging.info("Seeded the CMDB mirror from %s" % seed_url)
+    return True
+
+
+def open_cmdb_mirror(url, args, seed_url=None, sync_seconds=None, full_sync=True):
+    '''Returns the process wide mirror for url, sqlite:///path/to/file.db.
+    A missing file is seeded from seed_url, s3://bucket/key, if given. See
+    CmdbMirror for full_sync'''
+    if not url:
+        return None
+    if not url.startswith('sqlite://'):
+        raise ValueError("Unsupported CMDB mirror %s" % url)
+
+    with _mirrors_lock:
+        if url not in _mirrors:
+            path = url[len('sqlite://'):]
+            if seed_url:
+                download_seed(seed_url, path)
+            _mirrors[url] = CmdbMirror(path, args, sync_seconds=int(sync_seconds or DEFAULT_SYNC_SECONDS), full_sync=full_sync)
+        return _mirrors[url]
@@ -0,0 +1,103 @@
+# Coalescing of change notifications per resource within a batch
+# A busy EC2 instance produces several ConfigurationItemChangeNotifications in
+# one SQS batch. The messages of a batch are processed in parallel, every one
+# of them would be mapped and posted to SNOW in no particular order, while
+# only the newest matters. coalesce_messages keeps the newest notification of
+# every resource, by capture time and configurationStateId, and drops the
+# older ones before they are mapped. Oversized notifications take part with
+# their configurationItemSummary, a dropped one isn't even downloaded.
+#
+# DELETEs always go through, an update older than a DELETE of the batch is
+# dropped. The SSM inventory rows of a notification come from its
+# configurationItemDiff unless the state store keeps the package index, so
+# without state store SSM inventories aren't coalesced.
+import logging
+
+from .metrics import metrics
+from .state_store import resource_key
+
+# Message type: where it keeps the resource
+COALESCED_MESSAGE_TYPES = {
+    'ConfigurationItemChangeNotification': 'configurationItem',
+    'OversizedConfigurationItemChangeNotification': 'configurationItemSummary',
+}
+
+# Resource types whose rows are built from the configurationItemDiff
+DIFF_RESOURCE_TYPES = ['AWS::SSM::ManagedInstanceInventory']
+
+DELETED_STATUSES = ['ResourceDeleted', 'ResourceDeletedNotRecorded']
+
+
+def _configuration_item(message):
+    '''Returns the configurationItem or its summary of a change notification,
+    None for other messages'''
+    field = COALESCED_MESSAGE_TYPES.get(message.get('messageType'))
+    if field is None:
+        return None
+    item = message.get(field)
+    if not isinstance(item, dict) or not item.get('resourceId') or not item.get('resourceType') or 'awsAccountId' not in item:
+        return None
+    return item
+
+
+def is_delete(message, item):
+    if item.get('configurationItemStatus') in DELETED_STATUSES:
+        return True
+    # The summary of an oversized notification has the changeType itself
+    return ((message.get('configurationItemDiff') or {}).get('changeType') or item.get('changeType')) == 'DELETE'
+
+
+def item_version(item):
+    '''Orders the notifications of a resource, the newest is the largest.
+    The capture time is formatted as %Y-%m-%dT%H:%M:%S.%fZ, the state id
+    grows with every change'''
+    try:
+        state_id = int(item.get('configurationStateId'))
+    except (TypeError, ValueError):
+        state_id = -1
+    return (item.get('configurationItemCaptureTime') or '', state_id)
+
+
+def coalesce_messages(messages, coalesce_diffs=False):
+    '''Takes a list of (message_id, message) and returns the ones to process,
+    in their order, and the message ids of the superseded ones.
+    coalesce_diffs also coalesces DIFF_RESOURCE_TYPES, only do that when
+    their rows don't depend on the diff'''
+    # {resource key: (version, index)} of the newest update and DELETE
+    newest = {}
+    deleted = {}
+    superseded = set()
+    for index, (message_id, message) in enumerate(messages):
+        item = _configuration_item(message)
+        if item is None or (not coalesce_diffs and item['resourceType'] in DIFF_RESOURCE_TYPES):
+            continue
+
+        key = resource_key(item)
+        version = item_version(item)
+        if is_delete(message, item):
+            if key not in deleted or version > deleted[key]:
+                deleted[key] = version
+            continue
+
+        current = newest.get(key)
+        if current is None:
+            newest[key] = (version, index)
+        elif version >= current[0]:
+            # Equal versions are redeliveries, the last one wins
+            superseded.add(current[1])
+            newest[key] = (version, index)
+        else:
+            superseded.add(index)
+
+    for key, (version, index) in newest.items():
+        if key in deleted and version < deleted[key]:
+            superseded.add(index)
+
+    if not superseded:
+        return messages, []
+
+    for index in superseded:
+        metrics.count('CoalescedNotifications', resourceType=_configuration_item(messages[index][1])['resourceType'])
+    logging.info("Coalesced %s of %s messages into newer notifications of the same resource, saved their SNOW writes" % (len(superseded), len(messages)))
+    return ([message for index, message in enumerate(messages) if index not in superseded],
+            [messages[index][0] for index in sorted(superseded)])
@@ -0,0 +1,71 @@
+# Process wide cache for secrets from AWS Secrets Manager
+# A warm lambda container keeps the secret and the boto3 client, so we don't
+# call Secrets Manager before every SQS batch
+import base64
+import json
+import logging
+import threading
+import time
+
+# Seconds a fetched secret is used before we fetch it again
+DEFAULT_SECRET_TTL = 300
+# A forced refresh (e.g. after a 401 from SNOW) is skipped if the secret was
+# fetched this many seconds ago. Avoids a refresh per thread on rotation
+MIN_REFRESH_INTERVAL = 5
+
+_clients = {}
+_secrets = {}
+_lock = threading.Lock()
+
+
+def get_secrets_manager_client(region_name):
+    '''Returns the process wide Secrets Manager client for the region'''
+    client = _clients.get(region_name)
+    if client is None:
+        import boto3
+        session = boto3.session.Session()
+        client = session.client(service_name='secretsmanager', region_name=region_name)
+        _clients[region_name] = client
+    return client
+
+
+def fetch_secret(secret_name, region_name):
+    '''Downloads and decodes a secret from Secrets Manager'''
+    from botocore.exceptions import ClientError
+    client = get_secrets_manager_client(region_name)
+    try:
+        get_secret_value_response = client.get_secret_value(SecretId=secret_name)
+    except ClientError as e:
+        # DecryptionFailureException, InternalServiceErrorException,
+        # InvalidParameterException, InvalidRequestException,
+        # ResourceNotFoundException... nothing we can fix here
+        logging.fatal("Failed to get secret %s: %s" % (secret_name, e.response['Error']['Code']))
+        raise e
+
+    # Depending on whether the secret was a string or binary, one of these
+    # fields will be populated
+    if 'SecretString' in get_secret_value_response:
+        return json.loads(get_secret_value_response['SecretString'])
+    return json.loads(base64.b64decode(get_secret_value_response['SecretBinary']))
+
+
+def get_cached_secret(secret_name, region_name, ttl=DEFAULT_SECRET_TTL, force_refresh=False):
+    '''Returns the secret, fetches it only if the cached one is older than ttl
+    or a refresh is forced'''
+    with _lock:
+        now = time.time()
+        cached = _secrets.get((secret_name, region_name))
+
+        if cached is not None:
+            fetched_at, secret = cached
+            age = now - fetched_at
+            if force_refresh and age < MIN_REFRESH_INTERVAL:
+                logging.debug("Secret %s was just refreshed, reusing it" % secret_name)
+                return secret
+            if not force_refresh and age < ttl:
+                return secret
+
+        logging.debug("Fetching secret %s from Secrets Manager" % secret_name)
+        secret = fetch_secret(secret_name, region_name)
+        _secrets[(secret_name, region_name)] = (now, secret)
+        return secret
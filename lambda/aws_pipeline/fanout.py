@@ -0,0 +1,119 @@
+# Fan-out of ConfigurationSnapshotDeliveryCompleted messages
+# Instead of walking a snapshot with thousands of configuration items in a
+# single lambda invocation, the accepted items are packed into chunks and
+# sent back to SQS, so many lambda instances can process them in parallel
+import json
+import logging
+
+from snow_objects import jsonlib
+from snow_objects.errors import FanoutError
+
+# Internal message type understood by process_single_message. Not an AWS
+# Config message type, so it can't clash with one
+CHUNK_MESSAGE_TYPE = 'SnowConfigurationItemsChunk'
+
+# SQS limits: 256KB per message and per SendMessageBatch call, 10 entries
+# per SendMessageBatch call
+SQS_MAX_BYTES = 256 * 1024
+SQS_MAX_BATCH_ENTRIES = 10
+
+# Chunk size defaults. Small enough that several chunks fit into one
+# SendMessageBatch call, big enough to not end up with a message per item
+DEFAULT_CHUNK_BYTES = 64 * 1024
+DEFAULT_CHUNK_ITEMS = 50
+
+# Room for the json around the items
+_ENVELOPE_BYTES = 1024
+
+
+def iter_chunks(items, accept_resources, chunk_bytes=DEFAULT_CHUNK_BYTES, chunk_items=DEFAULT_CHUNK_ITEMS):
+    '''Filters items by resourceType and packs the serialized survivors into
+    lists that stay below chunk_bytes. Items that are too big for a SQS
+    message on their own are yielded as (None, item)'''
+    chunk = []
+    size = 0
+    for item in items:
+        if item['resourceType'] not in accept_resources:
+            continue
+
+        serialized = jsonlib.dumps(item)
+        if len(serialized) + _ENVELOPE_BYTES > SQS_MAX_BYTES:
+            yield None, item
+            continue
+
+        if chunk and (size + len(serialized) > chunk_bytes or len(chunk) >= chunk_items):
+            yield chunk, None
+            chunk = []
+            size = 0
+
+        chunk.append(serialized)
+        size += len(serialized) + 1
+
+    if chunk:
+        yield chunk, None
+
+
+def chunk_message(chunk, source):
+    '''Builds the SQS message body for a chunk of serialized items'''
+    return '{"messageType":%s,"source":%s,"configurationItems":[%s]}' % (
+        json.dumps(CHUNK_MESSAGE_TYPE), json.dumps(source), b','.join(chunk).decode('utf-8'))
+
+
+class SqsFanout():
+    '''Sends message bodies to a SQS queue with SendMessageBatch'''
+    def __init__(self, queue_url, sqs_client=None):
+        self.queue_url = queue_url
+        if sqs_client is None:
+            import boto3
+            sqs_client = boto3.client('sqs')
+        self.sqs_client = sqs_client
+        self._entries = []
+        self._entries_bytes = 0
+        self.messages_sent = 0
+        self.batches_sent = 0
+
+    def add(self, body):
+        # SQS limits are in bytes, not characters
+        size = len(body.encode('utf-8'))
+        if self._entries and (len(self._entries) >= SQS_MAX_BATCH_ENTRIES or self._entries_bytes + size > SQS_MAX_BYTES):
+            self.flush()
+
+        self._entries.append({'Id': str(len(self._entries)), 'MessageBody': body})
+        self._entries_bytes += size
+
+    def flush(self):
+        entries = self._entries
+        self._entries = []
+        self._entries_bytes = 0
+        if not entries:
+            return
+
+        # Failed entries are retried once, e.g. on throttling
+        for attempt in range(2):
+            response = self.sqs_client.send_message_batch(QueueUrl=self.queue_url, Entries=entries)
+            self.batches_sent += 1
+            self.messages_sent += len(response.get('Successful', []))
+
+            failed_ids = set([failed['Id'] for failed in response.get('Failed', [])])
+            entries = [entry for entry in entries if entry['Id'] in failed_ids]
+            if not entries:
+                return
+            logging.warning("Failed to send %s messages to %s: %s" % (len(entries), self.queue_url, response['Failed']))
+
+        raise FanoutError("Giving up sending %s messages to %s" % (len(entries), self.queue_url))
+
+
+def fan_out_configuration_items(items, accept_resources, queue_url, source, sqs_client=None,
+                                chunk_bytes=DEFAULT_CHUNK_BYTES, chunk_items=DEFAULT_CHUNK_ITEMS):
+    '''Sends the accepted items as CHUNK_MESSAGE_TYPE messages to the queue.
+    Yields the items that don't fit into a SQS message, the caller has to
+    process them itself'''
+    fanout = SqsFanout(queue_url, sqs_client)
+    for chunk, oversized_item in iter_chunks(items, accept_resources, chunk_bytes, chunk_items):
+        if chunk is None:
+            yield oversized_item
+            continue
+        fanout.add(chunk_message(chunk, source))
+    fanout.flush()
+
+    logging.info("Fanned out %s from %s in %s messages, %s SendMessageBatch calls" % (CHUNK_MESSAGE_TYPE, source, fanout.messages_sent, fanout.batches_sent))
@@ -0,0 +1,177 @@
+# Per stage timings and counters, written as CloudWatch Embedded Metric Format
+# The stages record into a process wide recorder, flush() writes one EMF json
+# line per dimension set to stdout. CloudWatch Logs extracts the metrics from
+# the lambda log, so there are no PutMetricData calls.
+#
+# SNOW_METRICS=off turns it off, every call is a no-op then.
+# SNOW_METRICS_NAMESPACE sets the CloudWatch namespace.
+import json
+import os
+import sys
+import threading
+import time
+
+DEFAULT_NAMESPACE = 'SnowIntegration'
+
+# EMF allows at most 100 values per metric and document, more values are
+# written to additional documents
+MAX_VALUES_PER_DOCUMENT = 100
+
+SECONDS_TO_MILLISECONDS = 1000.0
+
+
+class _NullTimer():
+    '''Timer of a disabled recorder'''
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer():
+    '''Records the duration of the with block in milliseconds, with
+    outcome "error" if it raised and "ok" otherwise'''
+    __slots__ = ('recorder', 'name', 'keys', 'start')
+
+    def __init__(self, recorder, name, keys):
+        self.recorder = recorder
+        self.name = name
+        # Dimension keys for ok and error
+        self.keys = keys
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        milliseconds = (time.perf_counter() - self.start) * SECONDS_TO_MILLISECONDS
+        self.recorder._add(self.keys[exc_type is not None], self.name, 'Milliseconds', milliseconds)
+        return False
+
+
+class MetricsRecorder():
+    '''Collects metric values per dimension set until they are flushed'''
+    def __init__(self, namespace=DEFAULT_NAMESPACE, enabled=True, output=None):
+        self.namespace = namespace
+        self.enabled = enabled
+        # Resolved on flush, tests and benchmarks swap sys.stdout
+        self.output = output
+        # {dimensions: {(name, unit): [values]}}, dimensions as sorted tuple
+        self._values = {}
+        self._lock = threading.Lock()
+        # Timers are hot, their dimension keys are only built once
+        self._timer_keys = {}
+
+    def record(self, name, value, unit='Count', dimensions=None):
+        '''Adds a value of the metric name with the given dimensions'''
+        if not self.enabled:
+            return
+        self._add(tuple(sorted(dimensions.items())) if dimensions else (), name, unit, value)
+
+    def _add(self, key, name, unit, value):
+        with self._lock:
+            metrics = self._values.get(key)
+            if metrics is None:
+                metrics = self._values[key] = {}
+            values = metrics.get((name, unit))
+            if values is None:
+                metrics[(name, unit)] = [value]
+            else:
+                values.append(value)
+
+    def count(self, name, value=1, **dimensions):
+        self.record(name, value, 'Count', dimensions)
+
+    def timer(self, name, **dimensions):
+        '''Context manager that records the duration of the block'''
+        if not self.enabled:
+            return _NULL_TIMER
+        cache_key = tuple(dimensions.items())
+        keys = self._timer_keys.get(cache_key)
+        if keys is None:
+            keys = self._timer_keys[cache_key] = (
+                tuple(sorted(dict(dimensions, outcome='ok').items())),
+                tuple(sorted(dict(dimensions, outcome='error').items())),
+            )
+        return _Timer(self, name, keys)
+
+    def drain(self):
+        '''Takes the collected values, e.g. to hand them to another process'''
+        with self._lock:
+            collected = self._values
+            self._values = {}
+        return collected
+
+    def merge(self, collected):
+        '''Adds the values another recorder drained'''
+        if not self.enabled:
+            return
+        with self._lock:
+            for key, metrics in collected.items():
+                for (name, unit), values in metrics.items():
+                    self._values.setdefault(key, {}).setdefault((name, unit), []).extend(values)
+
+    def documents(self, timestamp=None):
+        '''Takes the collected values and returns them as EMF documents'''
+        collected = self.drain()
+        timestamp = int((timestamp or time.time()) * 1000)
+        documents = []
+        for key, metrics in collected.items():
+            dimensions = dict(key)
+            offset = 0
+            while True:
+                document = dict(dimensions)
+                definitions = []
+                for (name, unit), values in metrics.items():
+                    chunk = values[offset:offset + MAX_VALUES_PER_DOCUMENT]
+                    if not chunk:
+                        continue
+                    # Counters are summed up, nobody needs every single 1
+                    if unit == 'Count':
+                        if offset:
+                            continue
+                        chunk = sum(values)
+                    elif len(chunk) == 1:
+                        chunk = round(chunk[0], 3)
+                    else:
+                        chunk = [round(chunk_value, 3) for chunk_value in chunk]
+                    document[name] = chunk
+                    definitions.append({'Name': name, 'Unit': unit})
+                if not definitions:
+                    break
+
+                document['_aws'] = {
+                    'Timestamp': timestamp,
+                    'CloudWatchMetrics': [{
+                        'Namespace': self.namespace,
+                        'Dimensions': [sorted(dimensions)],
+                        'Metrics': definitions,
+                    }],
+                }
+                documents.append(document)
+                offset += MAX_VALUES_PER_DOCUMENT
+        return documents
+
+    def flush(self):
+        '''Writes the collected values as EMF, one json document per line'''
+        if not self.enabled:
+            return
+        documents = self.documents()
+        if not documents:
+            return
+        output = self.output or sys.stdout
+        output.write(''.join([json.dumps(document, separators=(',', ':')) + '\n' for document in documents]))
+        output.flush()
+
+
+# The recorder of this process, configured by the lambda environment
+metrics = MetricsRecorder(
+    namespace=os.environ.get('SNOW_METRICS_NAMESPACE', DEFAULT_NAMESPACE),
+    enabled=os.environ.get('SNOW_METRICS', 'on').lower() not in ['off', '0', 'false', 'no'],
+)
@@ -0,0 +1,96 @@
+# Multi-core mapping of snapshot items for backfills
+# Mapping the configurationItems of a big snapshot through the SNOW object
+# classes is CPU bound (json, strptime, tags) and with threads runs on one
+# core. map_blocks_parallel shards the items over a process pool in blocks
+# of json text, split from the decompressed snapshot without parsing it, see
+# JsonStreamReader.iter_array_blocks. The workers parse and map their block
+# and send back the mapped SNOW objects with the few configurationItem keys
+# the state store needs. Results come back in snapshot order, the caller
+# submits them with its one submitter.
+#
+# The pool uses spawn: the CLI has receiver and SNOW threads running when the
+# pool starts, fork would copy their locks in whatever state they are
+import collections
+import logging
+import multiprocessing
+import threading
+
+from snow_objects import jsonlib
+from snow_objects.registry import map_configuration_item
+from .metrics import metrics
+
+# Characters of json per block, a few hundred EC2 instances or a few SSM
+# inventories
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+# Blocks in flight per process. Keeps every process busy, without reading
+# far ahead of the submitter
+BLOCKS_PER_PROCESS = 2
+
+# What submit_to_snow and the state store look at of a configurationItem
+ITEM_KEYS = ('awsAccountId', 'awsRegion', 'resourceType', 'resourceId', 'configurationItemCaptureTime')
+
+# {processes: pool}, shared by every thread of the process
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def map_block(block):
+    '''Runs in a worker process. Maps the configurationItems of a json text
+    block and returns (item keys, SNOW object) of every object to submit,
+    plus the metrics recorded meanwhile'''
+    try:
+        items = jsonlib.loads('[' + block + ']')
+    except ValueError as e:
+        # Only if objects nested in the items start with the same key as the
+        # items themselves, AWS Config items don't
+        raise ValueError("Block of %s characters isn't a list of configurationItems, process the snapshot without map processes: %s" % (len(block), e))
+
+    mapped = []
+    for item in items:
+        handler, snow_object = map_configuration_item({'configurationItem': item})
+        if handler is None or not handler.submit:
+            continue
+        mapped.append((dict([(key, item.get(key)) for key in ITEM_KEYS]), snow_object))
+
+    # Flushed by the main process, with everything else
+    return mapped, metrics.drain()
+
+
+def get_mapping_pool(processes):
+    '''Returns the process wide pool with processes workers'''
+    with _pools_lock:
+        if processes not in _pools:
+            logging.info("Starting %s mapping processes" % processes)
+            _pools[processes] = multiprocessing.get_context('spawn').Pool(processes)
+        return _pools[processes]
+
+
+def close_mapping_pools():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+            pool.join()
+        _pools.clear()
+
+
+def _results(result):
+    mapped, collected = result.get()
+    metrics.merge(collected)
+    return mapped
+
+
+def map_blocks_parallel(blocks, processes):
+    '''Yields (item keys, SNOW object) for the configurationItems in the json
+    text blocks, in their order. blocks is read as the workers make
+    progress, not all at once'''
+    pool = get_mapping_pool(processes)
+    pending = collections.deque()
+    for block in blocks:
+        pending.append(pool.apply_async(map_block, (block,)))
+        if len(pending) >= processes * BLOCKS_PER_PROCESS:
+            for mapped in _results(pending.popleft()):
+                yield mapped
+
+    while pending:
+        for mapped in _results(pending.popleft()):
+            yield mapped
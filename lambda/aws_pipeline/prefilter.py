@@ -0,0 +1,51 @@
+# Cheap classification of raw SQS message bodies
+# Most of the AWS Config traffic is message or resource types we skip. Instead
+# of decoding the SNS envelope and the embedded message just to find out, we
+# look at the raw body. The embedded message is an escaped json string, hence
+# the optional backslashes. The patterns start with a literal so the regex
+# engine can search for it quickly
+import re
+
+_MESSAGE_TYPE_RE = re.compile(r'messageType\\*"\s*:\s*\\*"(\w+)')
+_RESOURCE_TYPE_RE = re.compile(r'resourceType\\*"\s*:\s*\\*"([\w:]+)')
+
+# Message types that carry a single configuration item (or its summary)
+ITEM_MESSAGE_TYPES = [
+    'ConfigurationItemChangeNotification',
+    'OversizedConfigurationItemChangeNotification',
+]
+
+
+def message_type(body):
+    '''Returns the messageType in body, None if there is none'''
+    match = _MESSAGE_TYPE_RE.search(body)
+    if match is None:
+        return None
+    return match.group(1)
+
+
+def skip_reason(body, skip_message_types, accept_resources):
+    '''Returns why the raw body can be skipped without decoding it, None if
+    it needs to be processed'''
+    found_type = message_type(body)
+    if found_type is None:
+        return None
+
+    if found_type in skip_message_types:
+        return found_type
+
+    if found_type not in ITEM_MESSAGE_TYPES:
+        return None
+
+    # The resourceType of the item is somewhere in the body, next to the ones
+    # of relationships and diffs. If no accepted type shows up anywhere, the
+    # item can't be one we want. A plain substring search is way faster than
+    # finding every resourceType
+    for resource_type in accept_resources:
+        if resource_type in body:
+            return None
+
+    match = _RESOURCE_TYPE_RE.search(body)
+    if match is None:
+        return None
+    return match.group(1)
@@ -0,0 +1,354 @@
+# Reconciliation of the CMDB with the latest AWS Config snapshot
+# The pipeline is event driven, a lost or failed notification leaves the CMDB
+# wrong until the resource changes again. Reconciling compares the latest
+# snapshot of an account/region with the CMDB records of the same
+# account/region and only submits the difference:
+#   create  in the snapshot, not in the CMDB
+#   update  in both, a field of the mapped item differs in the CMDB
+#   delete  in the CMDB, not in the snapshot, submitted as DELETE
+#
+# Both sides are sorted by the resource key and joined in a single pass: the
+# mapped snapshot items are sorted in memory, the CMDB records are paged
+# through the Table API in key order. The key is compared lower cased, the
+# SNOW database sorts case insensitive.
+#
+# Volatile fields like u_last_change_* are not compared. A resource type is
+# only reconciled with an entry in RECONCILE_TARGETS, the table its import set
+# transforms into and which CMDB field the transform writes every compared
+# import set field to. SNOW ignores query conditions on fields a table
+# doesn't have, a CMDB record outside of the scope fails the scope.
+#
+# A snapshot can be days old. Only CMDB records last updated before it was
+# taken are created, updated or deleted, and only resources the state store
+# has nothing newer for, anything else came from a later change notification.
+import collections
+import datetime
+import logging
+import threading
+
+from snow_objects.errors import SnowQueryError
+from snow_objects.mapping import snow_time
+from snow_objects.registry import get_handler, get_handler_class, map_configuration_item
+from snow_objects.table import DEFAULT_PAGE_SIZE, iter_table_records, query_value
+from .metrics import metrics
+from .parallel_map import DEFAULT_BLOCK_SIZE, map_blocks_parallel
+from .s3_stream import iter_gunzip_json_array, iter_gunzip_json_array_blocks, list_s3_keys
+from .state_store import VOLATILE_FIELDS, resource_key
+
+# cmdb_table is the target of the import set transform, fields maps the
+# import set fields to the CMDB fields the transform writes them to, only
+# those are compared. key_field has the resourceId, a record with
+# deleted_field set to deleted_value is deleted already, both are import set
+# fields
+ReconcileTarget = collections.namedtuple('ReconcileTarget', ['cmdb_table', 'fields', 'key_field', 'deleted_field', 'deleted_value'])
+
+# model_id is a reference in the CMDB, its raw value is a sys_id
+EC2_INSTANCE_FIELDS = dict([(field, field) for field in [
+    'asset_tag', 'name', 'cost_center', 'state', 'install_date', 'u_region', 'u_account_id', 'u_used_for', 'used_for',
+    'u_client', 'u_service_tag', 'u_availability_zone', 'u_group', 'u_backup_group', 'u_pod', 'u_poc', 'u_classification',
+    'u_additional_tags', 'u_expiration', 'u_ami', 'u_instance_id', 'u_platform', 'u_monitoring_state', 'u_private_ip_address',
+    'u_public_ip_address', 'u_tenancy', 'u_host_id', 'u_pricing_type', 'u_cpu_threads_total_count', 'u_cpu_threads_per_core',
+    'u_cpu_core_count', 'u_vpc_id', 'u_termination_stopped_reason', 'u_subnet_id',
+]])
+
+# SSM inventories write a row per package, nothing to compare a
+# configurationItem with
+RECONCILE_TARGETS = {
+    'AWS::EC2::Instance': ReconcileTarget('cmdb_ci_ec2_instance', EC2_INSTANCE_FIELDS, 'asset_tag', 'state', 'terminated'),
+}
+
+# Import set fields the CMDB records of an account/region are selected by
+SCOPE_FIELDS = ('u_account_id', 'u_region')
+
+# Days we look back for the latest snapshot, AWS Config delivers one a day at
+# most
+DEFAULT_SNAPSHOT_DAYS = 7
+# A scope where more than this share of the CMDB records would be deleted is
+# reconciled without the deletes, the snapshot is more likely incomplete than
+# most resources gone
+DEFAULT_MAX_DELETE_SHARE = 0.5
+
+CREATE = 'create'
+UPDATE = 'update'
+DELETE = 'delete'
+UNCHANGED = 'unchanged'
+# Deletes left out because of max_delete_share
+SKIPPED_DELETE = 'skipped_delete'
+# Left out, the CMDB or the state store has data from after the snapshot
+NEWER = 'newer'
+
+# A snapshot item as the join sees it
+SnapshotRow = collections.namedtuple('SnapshotRow', ['sort_key', 'resource_id', 'data'])
+
+
+def snapshot_prefix(prefix, account, region, day):
+    '''Where AWS Config delivers the snapshots of a day. Month and day are not
+    zero padded'''
+    parts = [prefix.strip('/')] if prefix else []
+    parts += ['AWSLogs', account, 'Config', region, str(day.year), str(day.month), str(day.day), 'ConfigSnapshot', '']
+    return '/'.join(parts)
+
+
+def latest_snapshot_key(bucket, prefix, account, region, days=DEFAULT_SNAPSHOT_DAYS, today=None):
+    '''Returns the key of the newest snapshot of account/region within the
+    last days, None if there is none. Lists a day at a time, starting today'''
+    today = today or datetime.datetime.utcnow().date()
+    for back in range(days):
+        keys = [key for key in list_s3_keys(bucket, snapshot_prefix(prefix, account, region, today - datetime.timedelta(days=back)))
+                if key.endswith('.json.gz')]
+        if keys:
+            # The file names have the delivery time, e.g.
+            # 123456789012_Config_us-east-1_ConfigSnapshot_20261017T000000Z_<uuid>.json.gz
+            return max(keys)
+    return None
+
+
+def _snapshot_name_parts(key):
+    name = key.rsplit('/', 1)[-1]
+    parts = name.split('_')
+    if len(parts) < 5 or parts[1] != 'Config' or parts[3] != 'ConfigSnapshot':
+        raise ValueError("Not the name of an AWS Config snapshot file: %s" % name)
+    return parts
+
+
+def snapshot_scope(key):
+    '''Returns (account, region) of a snapshot file by its name'''
+    parts = _snapshot_name_parts(key)
+    return parts[0], parts[2]
+
+
+def snapshot_time(key):
+    '''Returns when a snapshot file was taken by its name, formatted like a
+    configurationItemCaptureTime'''
+    taken = datetime.datetime.strptime(_snapshot_name_parts(key)[4], '%Y%m%dT%H%M%SZ')
+    return taken.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+
+def snapshot_rows(bucket, key, processes=0):
+    '''Maps the items of a snapshot file that have a RECONCILE_TARGETS entry.
+    Returns {(account, region, resourceType): [SnapshotRow]} sorted by key'''
+    rows = collections.defaultdict(list)
+
+    def add(item_keys, snow_object):
+        target = RECONCILE_TARGETS[item_keys['resourceType']]
+        data = snow_object.snow_data()
+        resource_id = data.get(target.key_field)
+        if resource_id:
+            scope = (item_keys['awsAccountId'], item_keys['awsRegion'], item_keys['resourceType'])
+            rows[scope].append(SnapshotRow(resource_id.lower(), resource_id, data))
+
+    if processes:
+        blocks = iter_gunzip_json_array_blocks(bucket, key, 'configurationItems', DEFAULT_BLOCK_SIZE)
+        for item_keys, snow_object in map_blocks_parallel(blocks, processes):
+            if item_keys['resourceType'] in RECONCILE_TARGETS:
+                add(item_keys, snow_object)
+    else:
+        for item in iter_gunzip_json_array(bucket, key, 'configurationItems'):
+            if item.get('resourceType') in RECONCILE_TARGETS:
+                handler, snow_object = map_configuration_item({'configurationItem': item})
+                add(item, snow_object)
+
+    for scope_rows in rows.values():
+        scope_rows.sort(key=lambda row: row.sort_key)
+    return rows
+
+
+def merge_join(snapshot, records, key_field):
+    '''Yields (snapshot row, CMDB record) pairs of two sequences sorted by
+    key, None for the side a key is missing on. Duplicate snapshot rows and
+    CMDB records of a key are dropped'''
+    records = _unique_records(records, key_field)
+    record_key, record = next(records, (None, None))
+    row_key = None
+    for row in snapshot:
+        if row.sort_key == row_key:
+            logging.warning("Ignoring duplicate snapshot item of %s" % row.resource_id)
+            continue
+        row_key = row.sort_key
+        while record is not None and record_key < row_key:
+            yield None, record
+            record_key, record = next(records, (None, None))
+        if record is not None and record_key == row_key:
+            yield row, record
+            record_key, record = next(records, (None, None))
+        else:
+            yield row, None
+
+    while record is not None:
+        yield None, record
+        record_key, record = next(records, (None, None))
+
+
+def _unique_records(records, key_field):
+    '''Yields (lower cased key, record) of CMDB records sorted by
+    key_field, only the first record of a key'''
+    previous_key = None
+    for record in records:
+        key = record[key_field].lower()
+        if previous_key is not None and key < previous_key:
+            # The join would report everything after it as missing
+            raise SnowQueryError("CMDB records aren't sorted by %s: %s after %s" % (key_field, key, previous_key))
+        if key == previous_key:
+            logging.warning("Ignoring duplicate CMDB record of %s" % record[key_field])
+            continue
+        previous_key = key
+        yield key, record
+
+
+def snow_value(value):
+    '''A mapped value the way the Table API returns it'''
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value)
+
+
+def changed_fields(data, record, fields):
+    '''Returns the import set fields of the mapped data that differ in the
+    CMDB record, fields maps them to the CMDB fields. Fields the data doesn't
+    have aren't compared, an import set row without them leaves the CMDB
+    record as it is anyway. A CMDB field the record lacks is empty, like
+    SNOW returns an empty field'''
+    return [field for field, value in data.items()
+            if field in fields and field not in VOLATILE_FIELDS and snow_value(value) != record.get(fields[field], '')]
+
+
+def cmdb_fields(target):
+    '''CMDB fields of target the reconciliation reads'''
+    return sorted(set([cmdb_field for field, cmdb_field in target.fields.items() if field not in VOLATILE_FIELDS]))
+
+
+def scope_state_key(scope, resource_id):
+    '''State store key of a resource of scope'''
+    account, region, resource_type = scope
+    return resource_key({'awsAccountId': account, 'awsRegion': region, 'resourceType': resource_type, 'resourceId': resource_id})
+
+
+def scope_records(records, scope_values, key_field):
+    '''Passes the CMDB records of a scope query through. Raises
+    SnowQueryError on a record of another scope or without key, SNOW ignores
+    conditions on fields the table doesn't have and the query matched the
+    whole table'''
+    for record in records:
+        for field, value in scope_values.items():
+            if record.get(field, '').lower() != value.lower():
+                raise SnowQueryError("CMDB record %s has %s=%r instead of %r, does the table have the field?" % (
+                    record.get('sys_id'), field, record.get(field), value))
+        if not record.get(key_field):
+            raise SnowQueryError("CMDB record %s has no %s, does the table have the field?" % (record.get('sys_id'), key_field))
+        yield record
+
+
+def deleted_data(resource_type, account, region, resource_id, capture_time):
+    '''Maps a DELETE of a resource that isn't in the snapshot anymore'''
+    message = {
+        'configurationItemDiff': {'changeType': 'DELETE'},
+        'configurationItem': {
+            'resourceType': resource_type,
+            'resourceId': resource_id,
+            'awsAccountId': account,
+            'awsRegion': region,
+            'configurationItemCaptureTime': capture_time,
+            'configurationItemStatus': 'ResourceDeleted',
+            'configuration': None,
+            'tags': None,
+        },
+    }
+    return get_handler_class(resource_type)(message).snow_data()
+
+
+class Reconciliation():
+    '''Reconciles scopes, account/region/resourceType, and counts what it
+    found. submitter gets the rows, None for a dry run. Resources
+    state_store has data for from after the snapshot are left out'''
+    def __init__(self, args, submitter=None, state_store=None, max_delete_share=DEFAULT_MAX_DELETE_SHARE, page_size=DEFAULT_PAGE_SIZE):
+        self.args = args
+        self.submitter = submitter
+        self.state_store = state_store
+        self.max_delete_share = max_delete_share
+        self.page_size = page_size
+        self.counts = collections.Counter()
+        self._lock = threading.Lock()
+
+    def reconcile(self, scope, rows, capture_time):
+        '''Joins the sorted snapshot rows of scope with its CMDB records and
+        submits the difference. capture_time is when the snapshot was taken,
+        see snapshot_time. Returns the actions of the scope'''
+        account, region, resource_type = scope
+        target = RECONCILE_TARGETS[resource_type]
+        table = get_handler(resource_type).table
+        key_field = target.fields[target.key_field]
+        deleted_field = target.fields[target.deleted_field]
+
+        scope_values = dict([(target.fields[field], value) for field, value in zip(SCOPE_FIELDS, (account, region))])
+        conditions = ['{}={}'.format(field, query_value(value)) for field, value in sorted(scope_values.items())]
+        fields = cmdb_fields(target) + ['sys_updated_on']
+        records = iter_table_records(self.args, target.cmdb_table, conditions, fields, key_field, page_size=self.page_size)
+        # Both in the SNOW format, so string compare works
+        cmdb_capture_time = snow_time(capture_time)
+        if self.state_store is not None:
+            self.state_store.prefetch([scope_state_key(scope, row.resource_id) for row in rows])
+
+        counts = collections.Counter()
+        deletes = []
+        cmdb_records = 0
+        for row, record in merge_join(rows, scope_records(records, scope_values, key_field), key_field):
+            if record is not None:
+                cmdb_records += 1
+                if record.get('sys_updated_on', '') >= cmdb_capture_time:
+                    counts[NEWER] += 1
+                    continue
+            if row is not None and self._newer_state(scope, row.resource_id, capture_time):
+                counts[NEWER] += 1
+            elif record is None:
+                self._submit(table, row.data, CREATE, counts)
+            elif row is None:
+                if record.get(deleted_field) != target.deleted_value:
+                    deletes.append(record[key_field])
+                else:
+                    counts[UNCHANGED] += 1
+            else:
+                changed = changed_fields(row.data, record, target.fields)
+                if changed:
+                    logging.debug("%s changed: %s" % (row.resource_id, ", ".join(changed)))
+                    self._submit(table, row.data, UPDATE, counts)
+                else:
+                    counts[UNCHANGED] += 1
+
+        if deletes and len(deletes) > self.max_delete_share * cmdb_records:
+            logging.error("Not deleting %s of %s CMDB records of %s in %s/%s, the snapshot looks incomplete" % (
+                len(deletes), cmdb_records, resource_type, account, region))
+            counts[SKIPPED_DELETE] += len(deletes)
+        else:
+            if self.state_store is not None:
+                self.state_store.prefetch([scope_state_key(scope, resource_id) for resource_id in deletes])
+            for resource_id in deletes:
+                if self._newer_state(scope, resource_id, capture_time):
+                    counts[NEWER] += 1
+                else:
+                    # Gone by the time the snapshot was taken
+                    self._submit(table, deleted_data(resource_type, account, region, resource_id, capture_time), DELETE, counts)
+
+        for action, count in counts.items():
+            metrics.count('ReconciledResources', count, resourceType=resource_type, action=action)
+        logging.info("Reconciled %s in %s/%s: %s snapshot items, %s CMDB records, %s" % (
+            resource_type, account, region, len(rows), cmdb_records, dict(counts)))
+        with self._lock:
+            self.counts.update(counts)
+        return counts
+
+    def _newer_state(self, scope, resource_id, capture_time):
+        '''Whether the state store has data of the resource from after
+        capture_time'''
+        if self.state_store is None:
+            return False
+        stored = self.state_store.get(scope_state_key(scope, resource_id))
+        # Both are formatted as %Y-%m-%dT%H:%M:%S.%fZ, so string compare works
+        return stored is not None and stored['capture_time'] > capture_time
+
+    def _submit(self, table, data, action, counts):
+        counts[action] += 1
+        if self.submitter is not None:
+            # The action is the tag, failed rows are counted per action
+            self.submitter.add(table, data, action)
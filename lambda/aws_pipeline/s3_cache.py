@@ -0,0 +1,274 @@
+# Process wide S3 client and a /tmp cache of decompressed Config files
+# Redelivered SQS messages and retried invocations download the same
+# oversized change notifications and snapshot files again. A warm lambda
+# container keeps /tmp, so the files are stored there decompressed, under
+# bucket, key and ETag. The next download of a cached file is a conditional
+# GET (If-None-Match): S3 answers 304 without a body and the file is read
+# from disk, no download and no gunzip. Least recently used files are
+# evicted once the cache is over its size, by default half of the /tmp file
+# system, which in a lambda is the ephemeral storage. The other half is room
+# for the file that is being downloaded.
+#
+# SNOW_S3_CACHE=off turns it off.
+# SNOW_S3_CACHE_DIR sets the directory, SNOW_S3_CACHE_BYTES its size.
+import collections
+import hashlib
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+from .metrics import metrics
+
+# Partial files older than this were left by a process that died, e.g. a
+# lambda that timed out. Longer than a lambda can run
+STALE_PARTIAL_SECONDS = 15 * 60
+
+_PARTIAL_PREFIX = 'partial-'
+_UNSAFE_ETAG_CHARS = re.compile(r'[^0-9A-Za-z-]')
+
+_s3_client = None
+_s3_client_lock = threading.Lock()
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_s3_client():
+    '''Returns the process wide S3 client. boto3 clients are thread safe,
+    creating them isn't'''
+    global _s3_client
+    with _s3_client_lock:
+        if _s3_client is None:
+            import boto3
+            _s3_client = boto3.client('s3')
+        return _s3_client
+
+
+def _key_name(bucket, key):
+    return hashlib.sha256(("%s/%s" % (bucket, key)).encode('utf-8')).hexdigest()
+
+
+def _etag_name(etag):
+    # ETags are quoted hex digests, with a -<parts> suffix for multipart
+    # uploads. Only the digest goes into the file name
+    return _UNSAFE_ETAG_CHARS.sub('', etag)
+
+
+class _CachedFile():
+    __slots__ = ('etag_name', 'path', 'size')
+
+    def __init__(self, etag_name, path, size):
+        self.etag_name = etag_name
+        self.path = path
+        self.size = size
+
+
+class CacheWriter():
+    '''Writes a downloaded file next to the cache, commit() moves it in. A
+    file that grows past the cache size is dropped'''
+    def __init__(self, cache, bucket, key, etag):
+        self.cache = cache
+        self.bucket = bucket
+        self.key = key
+        self.etag = etag
+        self.size = 0
+        fd, self.path = tempfile.mkstemp(prefix=_PARTIAL_PREFIX, dir=cache.directory)
+        self._file = os.fdopen(fd, 'wb')
+
+    def write(self, data):
+        if self._file is None:
+            return
+        self.size += len(data)
+        if self.size > self.cache.max_bytes:
+            logging.debug("s3://%s/%s is larger than the S3 cache, not caching it" % (self.bucket, self.key))
+            self.abort()
+            return
+        try:
+            self._file.write(data)
+        except OSError as e:
+            # E.g. /tmp is full, the download goes on without the cache
+            logging.warning("Failed to write s3://%s/%s to the S3 cache: %s" % (self.bucket, self.key, e))
+            self.abort()
+
+    def commit(self):
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        self.cache._add(self.bucket, self.key, self.etag, self.path, self.size)
+
+    def abort(self):
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        _remove(self.path)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class S3ObjectCache():
+    '''Size bounded LRU cache of files on disk, by S3 bucket, key and ETag.
+    Shared by every thread of the process'''
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # {key hash: _CachedFile}, least recently used first. Only the
+        # latest ETag of a key is kept
+        self._files = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+    def _load(self):
+        '''Picks up the files a previous process of the container left'''
+        found = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+            if entry.name.startswith(_PARTIAL_PREFIX):
+                if stat.st_mtime < time.time() - STALE_PARTIAL_SECONDS:
+                    _remove(entry.path)
+                continue
+            name, _, etag_name = entry.name.partition('.')
+            found.append((stat.st_mtime, name, etag_name, entry.path, stat.st_size))
+
+        # A hit touches the file, its mtime is the last use
+        for _, name, etag_name, path, size in sorted(found):
+            previous = self._files.pop(name, None)
+            if previous is not None:
+                # Outdated version of the key
+                self._bytes -= previous.size
+                _remove(previous.path)
+            self._files[name] = _CachedFile(etag_name, path, size)
+            self._bytes += size
+        self._evict()
+        logging.debug("S3 cache in %s has %s files, %s bytes" % (self.directory, len(self._files), self._bytes))
+
+    def etag(self, bucket, key):
+        '''Returns the ETag of the cached version of the file, None if it
+        isn't cached'''
+        with self._lock:
+            cached = self._files.get(_key_name(bucket, key))
+            return '"%s"' % cached.etag_name if cached is not None else None
+
+    def open(self, bucket, key, etag):
+        '''Returns the cached file opened for reading, None if it is gone.
+        Counts a hit'''
+        name = _key_name(bucket, key)
+        with self._lock:
+            cached = self._files.get(name)
+            if cached is None or cached.etag_name != _etag_name(etag):
+                return None
+            try:
+                # Evicting only unlinks, an open file stays readable
+                cached_file = open(cached.path, 'rb')
+            except OSError:
+                self._forget(name)
+                return None
+            self._files.move_to_end(name)
+            self.hits += 1
+
+        try:
+            os.utime(cached.path)
+        except OSError:
+            pass
+        metrics.count('S3CacheLookups', outcome='hit')
+        return cached_file
+
+    def writer(self, bucket, key, etag):
+        '''Returns a CacheWriter for the downloaded file, counts a miss. None
+        if the file can't be cached'''
+        with self._lock:
+            self.misses += 1
+        metrics.count('S3CacheLookups', outcome='miss')
+        if not etag:
+            return None
+        try:
+            return CacheWriter(self, bucket, key, etag)
+        except OSError as e:
+            logging.warning("Failed to write to the S3 cache in %s: %s" % (self.directory, e))
+            return None
+
+    def _add(self, bucket, key, etag, partial_path, size):
+        name = _key_name(bucket, key)
+        etag_name = _etag_name(etag)
+        path = os.path.join(self.directory, "%s.%s" % (name, etag_name))
+        with self._lock:
+            try:
+                os.replace(partial_path, path)
+            except OSError as e:
+                logging.warning("Failed to add s3://%s/%s to the S3 cache: %s" % (bucket, key, e))
+                _remove(partial_path)
+                return
+            previous = self._files.get(name)
+            if previous is not None and previous.path != path:
+                _remove(previous.path)
+            self._forget(name)
+            self._files[name] = _CachedFile(etag_name, path, size)
+            self._bytes += size
+            self._evict()
+        metrics.record('S3CacheBytes', self._bytes, 'Bytes')
+
+    def _forget(self, name):
+        cached = self._files.pop(name, None)
+        if cached is not None:
+            self._bytes -= cached.size
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and self._files:
+            name, cached = self._files.popitem(last=False)
+            self._bytes -= cached.size
+            self.evictions += 1
+            _remove(cached.path)
+            metrics.count('S3CacheEvictions')
+
+
+def default_cache_bytes(directory):
+    '''Half of the file system the cache is on'''
+    return shutil.disk_usage(directory).total // 2
+
+
+def get_object_cache():
+    '''Returns the process wide S3 cache, None if it is turned off'''
+    global _cache
+    if os.environ.get('SNOW_S3_CACHE', 'on').lower() in ['off', '0', 'false', 'no']:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            directory = os.environ.get('SNOW_S3_CACHE_DIR') or os.path.join(tempfile.gettempdir(), 'snow-s3-cache')
+            try:
+                os.makedirs(directory, exist_ok=True)
+                max_bytes = int(os.environ.get('SNOW_S3_CACHE_BYTES') or default_cache_bytes(directory))
+                _cache = S3ObjectCache(directory, max_bytes)
+            except OSError as e:
+                logging.warning("S3 cache in %s not available, downloading every time: %s" % (directory, e))
+                return None
+        return _cache
+
+
+def log_cache_stats():
+    '''Logs the hit rate of the S3 cache, if it was used in this process'''
+    cache = _cache
+    if cache is not None:
+        logging.info("S3 cache %s: %s hits, %s misses, %.0f%% hit rate, %s evictions" % (
+            cache.directory, cache.hits, cache.misses, cache.hit_rate * 100, cache.evictions))
@@ -0,0 +1,409 @@
+# Streaming access to the gzipped json files AWS Config delivers to S3
+# Snapshot files can be several hundred MB uncompressed. Instead of holding
+# the compressed, decompressed and parsed version in memory at the same time
+# we decompress in chunks and parse the configurationItems one by one.
+# Decompressed files are kept in the /tmp cache of s3_cache.py for retries
+import codecs
+import json
+import logging
+import re
+import time
+import zlib
+
+from snow_objects import jsonlib
+from snow_objects.errors import S3DownloadError
+from .metrics import SECONDS_TO_MILLISECONDS, metrics
+from .s3_cache import get_object_cache, get_s3_client
+
+# Bytes we read from S3 at once
+CHUNK_SIZE = 1024 * 1024
+
+_WHITESPACE = ' \t\n\r'
+_NUMBER_CHARS = '0123456789.eE+-'
+
+# Opening brace and first key of an object, e.g. '{"version":'
+_OBJECT_START = re.compile(r'\{[ \t\n\r]*"[^"\\]*"[ \t\n\r]*:')
+# Bytes _bracket_balance drops
+_NOT_BRACKETS_OR_QUOTES = bytes(sorted(set(range(256)) - set(b'{}[]"')))
+# How far a block may grow past its size while its brackets don't balance,
+# e.g. in one huge item. After that its items are parsed
+MAX_BLOCK_GROWTH = 4
+
+
+def _not_modified(error):
+    # botocore raises a ClientError with code 304 for a GET with a matching
+    # If-None-Match
+    return str(getattr(error, 'response', {}).get('Error', {}).get('Code')) in ['304', 'NotModified']
+
+
+def get_s3_object(bucket, key, if_none_match=None):
+    '''Starts the download of a key/file in S3 and returns the get_object
+    response. None if if_none_match is given and still the ETag of the file'''
+    request = {'Bucket': bucket, 'Key': key}
+    if if_none_match is not None:
+        request['IfNoneMatch'] = if_none_match
+    try:
+        return get_s3_client().get_object(**request)
+    except Exception as e:
+        if if_none_match is not None and _not_modified(e):
+            return None
+        metrics.count('S3Downloads', outcome='error')
+        raise S3DownloadError("Failed to download file from s3://%s/%s: %s" % (bucket, key, e))
+
+
+def parse_s3_url(url):
+    '''Returns (bucket, key) of s3://bucket/key'''
+    if not url.startswith('s3://'):
+        raise ValueError("S3 URL must look like s3://bucket/key: %s" % url)
+    bucket, _, key = url[len('s3://'):].partition('/')
+    return bucket, key
+
+
+def list_s3_keys(bucket, prefix, delimiter=None, s3_client=None):
+    '''Returns the keys below prefix, or with a delimiter the common
+    prefixes, of all pages'''
+    s3_client = s3_client or get_s3_client()
+    request = {'Bucket': bucket, 'Prefix': prefix}
+    if delimiter is not None:
+        request['Delimiter'] = delimiter
+    found = []
+    while True:
+        response = s3_client.list_objects_v2(**request)
+        if delimiter is not None:
+            found.extend([common['Prefix'] for common in response.get('CommonPrefixes', [])])
+        else:
+            found.extend([content['Key'] for content in response.get('Contents', [])])
+        if not response.get('IsTruncated'):
+            return found
+        request['ContinuationToken'] = response['NextContinuationToken']
+
+
+def iter_s3_object(bucket, key, chunk_size=CHUNK_SIZE):
+    '''Yields the content of a key/file in S3 in chunks'''
+    logging.debug("Function start")
+    start = time.perf_counter()
+    response = get_s3_object(bucket, key)
+    for chunk in iter_s3_body(response['Body'], chunk_size, time.perf_counter() - start):
+        yield chunk
+
+
+def iter_s3_body(body, chunk_size=CHUNK_SIZE, seconds=0):
+    '''Yields the body of a get_object response in chunks. seconds is the
+    time it took to get the response'''
+    # Only the time spent in S3, not in whoever consumes the chunks
+    size = 0
+    while True:
+        start = time.perf_counter()
+        chunk = body.read(chunk_size)
+        seconds += time.perf_counter() - start
+        if not chunk:
+            break
+        size += len(chunk)
+        yield chunk
+
+    metrics.count('S3Downloads', outcome='ok')
+    metrics.record('S3DownloadTime', seconds * SECONDS_TO_MILLISECONDS, 'Milliseconds')
+    metrics.record('S3DownloadBytes', size, 'Bytes')
+
+
+def iter_gunzip(chunks):
+    '''Decompresses gzipped chunks on the fly'''
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    seconds = 0
+    size = 0
+    for chunk in chunks:
+        start = time.perf_counter()
+        data = decompressor.decompress(chunk)
+        seconds += time.perf_counter() - start
+        if data:
+            size += len(data)
+            yield data
+    data = decompressor.flush()
+    if data:
+        size += len(data)
+        yield data
+
+    metrics.record('GunzipTime', seconds * SECONDS_TO_MILLISECONDS, 'Milliseconds')
+    metrics.record('GunzipBytes', size, 'Bytes')
+
+
+def iter_gunzip_s3_object(bucket, key, chunk_size=CHUNK_SIZE):
+    '''Yields the decompressed content of a gzipped key/file in S3. From the
+    S3 cache if it has the current version, otherwise the download is added
+    to the cache as it is read'''
+    cache = get_object_cache()
+    if cache is None:
+        for data in iter_gunzip(iter_s3_object(bucket, key, chunk_size)):
+            yield data
+        return
+
+    start = time.perf_counter()
+    etag = cache.etag(bucket, key)
+    response = get_s3_object(bucket, key, etag)
+    if response is None:
+        cached_file = cache.open(bucket, key, etag)
+        if cached_file is not None:
+            logging.debug("Reading s3://%s/%s from the S3 cache" % (bucket, key))
+            with cached_file:
+                while True:
+                    data = cached_file.read(chunk_size)
+                    if not data:
+                        return
+                    yield data
+        # Evicted since, download it after all
+        response = get_s3_object(bucket, key)
+
+    writer = cache.writer(bucket, key, response.get('ETag'))
+    try:
+        for data in iter_gunzip(iter_s3_body(response['Body'], chunk_size, time.perf_counter() - start)):
+            if writer is not None:
+                writer.write(data)
+            yield data
+    except BaseException:
+        # Also when the consumer stops early, only complete files are cached
+        if writer is not None:
+            writer.abort()
+        raise
+    if writer is not None:
+        writer.commit()
+
+
+def iter_text(chunks, encoding='utf-8'):
+    '''Decodes byte chunks, multi byte characters can be split between chunks'''
+    decoder = codecs.getincrementaldecoder(encoding)()
+    for chunk in chunks:
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    text = decoder.decode(b'', final=True)
+    if text:
+        yield text
+
+
+def _bracket_balance(text):
+    '''Opening minus closing brackets of json text that doesn't start or
+    end in a string, those in strings aren't counted'''
+    # UTF-8 doesn't use the bytes of ASCII characters in others
+    data = text.encode('utf-8')
+    if b'\\' in data:
+        data = data.replace(b'\\\\', b'').replace(b'\\"', b'')
+    # Left are the brackets and the quotes, every other one starting a
+    # string. A string without brackets is a "" pair, so is the end of one
+    # and the start of the next without brackets between them
+    data = data.translate(None, _NOT_BRACKETS_OR_QUOTES).replace(b'""', b'')
+    if b'"' in data:
+        data = b''.join(data.split(b'"')[::2])
+    return data.count(b'{') + data.count(b'[') - data.count(b'}') - data.count(b']')
+
+
+class JsonStreamReader():
+    '''Minimal incremental json reader on top of json.JSONDecoder.raw_decode.
+    Only as much of the document is kept in memory as needed for the value
+    that is currently parsed'''
+    def __init__(self, text_chunks):
+        self._chunks = iter(text_chunks)
+        self._decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        '''Reads the next chunk, returns False at the end of the document'''
+        if self._eof:
+            return False
+
+        # Drop what we parsed already, but only once it's worth the copy
+        if self._pos > len(self._buffer) // 2:
+            self._buffer = self._buffer[self._pos:]
+            self._pos = 0
+
+        try:
+            self._buffer += next(self._chunks)
+        except StopIteration:
+            self._eof = True
+            return False
+        return True
+
+    def _peek(self):
+        '''Returns the next non whitespace character without consuming it'''
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos] in _WHITESPACE:
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                raise ValueError("Unexpected end of json document")
+
+    def _expect(self, chars):
+        char = self._peek()
+        if char not in chars:
+            raise ValueError("Expected one of %s at offset %s, got %s" % (chars, self._pos, char))
+        self._pos += 1
+        return char
+
+    def _value(self):
+        '''Decodes the next complete json value'''
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except ValueError:
+                # Most likely the value continues in the next chunk
+                if not self._fill():
+                    raise
+                continue
+
+            # A number at the end of the buffer might continue in the next chunk
+            if (end == len(self._buffer) or self._buffer[end] in _NUMBER_CHARS) and self._fill():
+                continue
+
+            self._last_value_start, self._pos = self._pos, end
+            return value
+
+    def iter_array(self, key):
+        '''Yields the items of the array stored under key in the top level
+        object. Everything else is parsed and dropped'''
+        return self._iter_array(key, self._items)
+
+    def iter_array_blocks(self, key, block_size):
+        '''Like iter_array, but yields the items as json text blocks
+        "item,item,..." of about block_size characters, to parse them in
+        another process. See _blocks'''
+        return self._iter_array(key, self._blocks, block_size)
+
+    def _iter_array(self, key, read_items, *read_args):
+        self._expect('{')
+        if self._peek() == '}':
+            self._finish()
+            return
+
+        while True:
+            current_key = self._value()
+            self._expect(':')
+
+            if current_key == key:
+                self._expect('[')
+                if self._peek() == ']':
+                    self._pos += 1
+                else:
+                    # Reads up to and including the closing ]
+                    for value in read_items(*read_args):
+                        yield value
+            else:
+                self._value()
+
+            if self._expect(',}') == '}':
+                self._finish()
+                return
+
+    def _finish(self):
+        '''Reads the rest of the document, whitespace at most. The source of
+        the chunks sees the end of the file, the S3 cache only keeps
+        complete files'''
+        for _ in self._chunks:
+            pass
+
+    def _items(self):
+        while True:
+            yield self._value()
+            if self._expect(',]') == ']':
+                return
+
+    def _blocks(self, block_size):
+        '''Splits the items without parsing them, that is what the workers
+        are for. Every item of a snapshot starts with the same key, so a
+        block ends before a "}, {<first key>:" past block_size where the
+        brackets in the block, outside of strings, balance. The candidates
+        are never in a string, a quote in one is escaped. A block that
+        doesn't balance within MAX_BLOCK_GROWTH is split by parsing its
+        items, so are arrays of anything but objects'''
+        if self._peek() != '{':
+            while True:
+                block, done = self._parsed_block(block_size)
+                yield block
+                if done:
+                    return
+
+        match = _OBJECT_START.match(self._buffer, self._pos)
+        while match is None and self._fill():
+            match = _OBJECT_START.match(self._buffer, self._pos)
+        object_start = match.group(0) if match is not None else None
+
+        while True:
+            end = self._block_end(object_start, block_size) if object_start is not None else None
+            if end is None:
+                block, done = self._parsed_block(block_size)
+                yield block
+                if done:
+                    return
+                continue
+
+            yield self._buffer[self._pos:end]
+            self._pos = end
+            self._expect(',')
+
+    def _block_end(self, object_start, block_size):
+        '''Returns the buffer offset where the block starting at _pos ends,
+        None if no balanced end was found'''
+        # Offsets are relative to _pos, _fill moves the buffer
+        balance = 0
+        counted = 0
+        search_from = block_size
+        while True:
+            found = self._buffer.find(object_start, self._pos + search_from)
+            if found == -1:
+                if len(self._buffer) - self._pos > block_size * MAX_BLOCK_GROWTH or not self._fill():
+                    return None
+                continue
+
+            # Only a "}, {" is the start of a sibling object
+            comma = found - 1
+            while comma > self._pos and self._buffer[comma] in _WHITESPACE:
+                comma -= 1
+            end = comma
+            while end > self._pos and self._buffer[end - 1] in _WHITESPACE:
+                end -= 1
+            search_from = found + 1 - self._pos
+            if self._buffer[comma] != ',' or self._buffer[end - 1] != '}':
+                continue
+
+            balance += _bracket_balance(self._buffer[self._pos + counted:end])
+            counted = end - self._pos
+            if balance == 0:
+                return end
+
+    def _parsed_block(self, block_size):
+        '''Returns a block of items found by parsing them and whether the
+        array ended with it'''
+        items = []
+        size = 0
+        while size < block_size:
+            item = self._raw_value()
+            items.append(item)
+            size += len(item)
+            if self._expect(',]') == ']':
+                return ','.join(items), True
+        return ','.join(items), False
+
+    def _raw_value(self):
+        '''Returns the json text of the next complete json value'''
+        self._value()
+        start = self._last_value_start
+        return self._buffer[start:self._pos]
+
+
+def iter_gunzip_json_array(bucket, key, array_key):
+    '''Yields the items of array_key from a gzipped json file in S3'''
+    return JsonStreamReader(iter_text(iter_gunzip_s3_object(bucket, key))).iter_array(array_key)
+
+
+def iter_gunzip_json_array_blocks(bucket, key, array_key, block_size):
+    '''Yields the items of array_key from a gzipped json file in S3 as json
+    text blocks "item,item,..." of about block_size characters'''
+    return JsonStreamReader(iter_text(iter_gunzip_s3_object(bucket, key))).iter_array_blocks(array_key, block_size)
+
+
+def load_gunzip_json(bucket, key):
+    '''Returns a gzipped json file in S3 as parsed json. The compressed file is
+    never held in memory as a whole'''
+    return jsonlib.loads(b''.join(iter_gunzip_s3_object(bucket, key)))
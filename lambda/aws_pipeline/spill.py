@@ -0,0 +1,248 @@
+# Spill buffer in S3 for SNOW outages
+# While SNOW is down for maintenance, every retry of a SQS message costs a
+# lambda invocation. In degraded mode the messages are mapped as usual, but
+# SpillSubmitter writes their SNOW rows to S3 instead, one gzipped NDJSON
+# segment per import set table and flush, and the messages are done:
+#   <prefix>/<table>/<UTC time>-<random>.ndjson.gz
+# Every line is {"key": ..., "time": ..., "row": {...}}. key identifies what
+# the row writes in SNOW, time is its capture time. replay-spilled-rows.py
+# loads the segments into SNOW once it is back, only the latest row per key.
+#
+# Replay progress is checkpointed in <prefix>/_replay/checkpoint.json, rows
+# that SNOW rejects on replay are spilled to <prefix>/_failed/ to replay
+# them from there once fixed.
+#
+# Once SNOW is back, live processing goes on while the replay runs. Spilled
+# rows are committed to the state store like submitted ones, so it holds the
+# latest state of every resource, spilled or sent. With the state store the
+# replay skips rows it has newer, different data for, live processing sent
+# those to SNOW already.
+import gzip
+import logging
+import threading
+import time
+import uuid
+
+from snow_objects import jsonlib
+from snow_objects.batch import SnowRowResult
+from snow_objects.mapping import snow_time
+from snow_objects.registry import HANDLERS
+from .metrics import metrics
+from .s3_cache import get_s3_client
+from .s3_stream import list_s3_keys, parse_s3_url
+from .state_store import payload_hash, resource_key
+
+# Prefixes that aren't tables
+CHECKPOINT_KEY = '_replay/checkpoint.json'
+FAILED_PREFIX = '_failed'
+
+# Fields of a row that identify what it writes in SNOW. u_package and
+# u_version are the package rows of the SSM inventories
+KEY_FIELDS = ('u_account_id', 'u_region', 'asset_tag', 'u_package', 'u_version')
+# A row has the capture time in the field of its change type
+TIME_FIELDS = ('u_last_change_update', 'u_last_change_snapshot', 'u_last_change_delete', 'u_last_change_create')
+
+SPILL_MODES = ['degraded', 'always']
+
+
+def parse_spill_url(url):
+    '''Returns (bucket, prefix) of s3://bucket/prefix'''
+    bucket, prefix = parse_s3_url(url)
+    return bucket, prefix.strip('/')
+
+
+def _join(*parts):
+    return '/'.join([part for part in parts if part])
+
+
+def row_key(table, row):
+    '''Identifies what a row writes in SNOW, rows with the same key replace
+    each other'''
+    values = [table] + [str(row.get(field, '')) for field in KEY_FIELDS]
+    # A removed package is the package with a "-" in front, its key is the
+    # key of the package, the latest of both wins
+    values[KEY_FIELDS.index('u_package') + 1] = values[KEY_FIELDS.index('u_package') + 1].lstrip('-')
+    return '|'.join(values)
+
+
+def row_time(row):
+    # SNOW format, %Y-%m-%d %H:%M:%S, string compare works
+    return max([row[field] for field in TIME_FIELDS if row.get(field)] or [''])
+
+
+def spill_line(key, row):
+    return jsonlib.dumps({'key': key, 'time': row_time(row), 'row': row})
+
+
+def table_resource_types():
+    '''Returns {import set table: resourceType} of the tables only a single
+    resource type submits to'''
+    types = {}
+    for resource_type, handler in HANDLERS.items():
+        if handler.submit and handler.table:
+            types.setdefault(handler.table, []).append(resource_type)
+    return dict([(table, table_types[0]) for table, table_types in types.items() if len(table_types) == 1])
+
+
+def replay_state_key(table, row, resource_types=None):
+    '''State store key with the latest state of what a spilled row writes,
+    None if there is none: the package index for the package rows of SSM
+    inventories, the resource state for the other rows'''
+    resource_type = (resource_types or table_resource_types()).get(table)
+    if resource_type is None or not row.get('u_account_id') or not row.get('asset_tag'):
+        return None
+    if resource_type == 'AWS::SSM::ManagedInstanceInventory':
+        from snow_objects.ssm_inventory import PACKAGE_INDEX_KEY
+        return PACKAGE_INDEX_KEY.format(account=row['u_account_id'], region=row.get('u_region'), instance=row['asset_tag'])
+    return resource_key({'awsAccountId': row['u_account_id'], 'awsRegion': row.get('u_region'), 'resourceType': resource_type,
+                         'resourceId': row['asset_tag']})
+
+
+def superseded(row, stored):
+    '''Whether the state store record of a spilled row has newer, different
+    data. Live processing sent it to SNOW, the row would overwrite it'''
+    if stored is None:
+        return False
+    if 'packages' in stored:
+        # Package index: the row is outdated if it disagrees with it
+        package, version = row.get('u_package') or '', row.get('u_version')
+        if package.startswith('-'):
+            return version in stored['packages'].get(package[1:], [])
+        return version not in stored['packages'].get(package, [])
+    if stored['payload_hash'] == payload_hash(row):
+        # SNOW got this data from the row or not at all, e.g. live
+        # processing found it unchanged
+        return False
+    # SNOW times have seconds only, within the same second the row goes
+    return snow_time(stored['capture_time']) > row_time(row)
+
+
+class SpillSubmitter():
+    '''Stands in for SnowBatchSubmitter while SNOW is down. flush() writes
+    the rows of every table as one segment to S3'''
+    def __init__(self, spill_url, s3_client=None):
+        self.bucket, self.prefix = parse_spill_url(spill_url)
+        self.s3_client = s3_client or get_s3_client()
+        # {table: [(line, tag)]}
+        self._lines = {}
+        self._lock = threading.Lock()
+
+    def add(self, table, data, tag=None):
+        line = spill_line(row_key(table, data), data)
+        with self._lock:
+            self._lines.setdefault(table, []).append((line, tag))
+
+    def flush(self):
+        '''Writes the buffered rows, returns a SnowRowResult per row'''
+        with self._lock:
+            lines, self._lines = self._lines, {}
+        results = []
+        for table, table_lines in lines.items():
+            try:
+                key = write_segment(self.s3_client, self.bucket, _join(self.prefix, table), [line for line, tag in table_lines])
+            except Exception as e:
+                logging.error("Failed to spill %s rows of SNOW table %s to s3://%s/%s: %s" % (len(table_lines), table, self.bucket, self.prefix, e))
+                results.extend([SnowRowResult(table, tag, False, None, None, str(e)) for line, tag in table_lines])
+                continue
+
+            logging.info("Spilled %s rows of SNOW table %s to s3://%s/%s" % (len(table_lines), table, self.bucket, key))
+            metrics.count('SpilledRows', len(table_lines), table=table)
+            results.extend([SnowRowResult(table, tag, True, 'spilled', None, None) for line, tag in table_lines])
+        return results
+
+
+def write_segment(s3_client, bucket, prefix, lines):
+    '''Writes json lines as a gzipped NDJSON segment below prefix, returns
+    its key. Segment keys sort by the second they were written in'''
+    key = "%s/%s-%s.ndjson.gz" % (prefix, time.strftime('%Y%m%dT%H%M%SZ', time.gmtime()), uuid.uuid4().hex[:12])
+    s3_client.put_object(Bucket=bucket, Key=key, Body=gzip.compress(b'\n'.join(lines) + b'\n'), ContentEncoding='gzip',
+                         ContentType='application/x-ndjson')
+    return key
+
+
+def list_tables(s3_client, bucket, prefix):
+    '''Returns the tables with spilled segments'''
+    tables = []
+    for table_prefix in list_s3_keys(bucket, prefix + '/' if prefix else '', delimiter='/', s3_client=s3_client):
+        table = table_prefix.rstrip('/').rsplit('/', 1)[-1]
+        if not table.startswith('_'):
+            tables.append(table)
+    return sorted(tables)
+
+
+def list_segments(s3_client, bucket, prefix, table):
+    return sorted([key for key in list_s3_keys(bucket, _join(prefix, table) + '/', s3_client=s3_client) if key.endswith('.ndjson.gz')])
+
+
+def read_segment(s3_client, bucket, key):
+    '''Yields the decoded lines of a segment'''
+    body = s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()
+    for line in gzip.decompress(body).splitlines():
+        if line:
+            yield jsonlib.loads(line)
+
+
+def latest_rows(s3_client, bucket, segments):
+    '''Returns the latest row of every key in the segments, sorted by key.
+    Of rows with the same time the one of the later segment wins'''
+    latest = {}
+    for segment in segments:
+        for line in read_segment(s3_client, bucket, segment):
+            current = latest.get(line['key'])
+            if current is None or line['time'] >= current[0]:
+                latest[line['key']] = (line['time'], line['row'])
+    return [(key, latest[key][1]) for key in sorted(latest)]
+
+
+def delete_segments(s3_client, bucket, segments):
+    # delete_objects takes up to 1000 keys
+    for start in range(0, len(segments), 1000):
+        s3_client.delete_objects(Bucket=bucket, Delete={'Objects': [{'Key': key} for key in segments[start:start + 1000]], 'Quiet': True})
+
+
+def _no_such_key(error):
+    return str(getattr(error, 'response', {}).get('Error', {}).get('Code')) in ['NoSuchKey', '404']
+
+
+class ReplayCheckpoint():
+    '''Replay progress in S3. Per table the segments of the replay that is
+    in progress and how many of its rows made it to SNOW, plus the segments
+    replayed already'''
+    def __init__(self, s3_client, bucket, prefix):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = _join(prefix, CHECKPOINT_KEY)
+        try:
+            self.state = jsonlib.loads(s3_client.get_object(Bucket=bucket, Key=self.key)['Body'].read())
+        except Exception as e:
+            if not _no_such_key(e):
+                raise
+            # First replay
+            self.state = {}
+        self.state.setdefault('tables', {})
+        self.state.setdefault('replayed', [])
+
+    def in_progress(self, table):
+        '''Returns (segments, rows done) of an unfinished replay of table'''
+        progress = self.state['tables'].get(table)
+        if progress is None:
+            return None, 0
+        return progress['segments'], progress['rows_done']
+
+    def progress(self, table, segments, rows_done):
+        self.state['tables'][table] = {'segments': segments, 'rows_done': rows_done}
+        self.save()
+
+    def done(self, table, segments, deleted=False):
+        '''The segments are in SNOW. Deleted segments are forgotten, the
+        others remembered so the next replay skips them'''
+        self.state['tables'].pop(table, None)
+        if not deleted:
+            self.state['replayed'] = sorted(set(self.state['replayed']) | set(segments))
+        self.save()
+
+    def replayed(self):
+        return set(self.state['replayed'])
+
+    def save(self):
+        self.s3_client.put_object(Bucket=self.bucket, Key=self.key, Body=jsonlib.dumps(self.state), ContentType='application/json')
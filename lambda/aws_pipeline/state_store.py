@@ -0,0 +1,281 @@
+# Per resource state of what we submitted to SNOW
+# Keyed by account/region/resourceType/resourceId we remember the configurationItemCaptureTime
+# and a hash of the submitted SNOW object. This allows to skip objects that
+# didn't change since the last submission (e.g. every snapshot) and change
+# notifications that arrive after a newer one already got submitted
+#
+# Backends: sqlite for local runs, DynamoDB (or anything speaking its API,
+# e.g. DynamoDB Local) for lambda
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+
+# Fields that change with every submission without the resource changing
+VOLATILE_FIELDS = [
+    'change_type',
+    'u_last_change_update',
+    'u_last_change_snapshot',
+    'u_last_change_delete',
+    'u_last_change_create',
+]
+
+# Pending writes are flushed once there are this many. 25 is the max of a
+# DynamoDB BatchWriteItem call
+WRITE_BATCH_SIZE = 25
+
+# Keys per read of the records of a batch. 100 is the max of a DynamoDB
+# BatchGetItem call, sqlite allows 999 parameters per statement
+READ_BATCH_SIZE = 100
+
+# Records we keep in memory so a warm lambda doesn't read them again
+MAX_CACHED_RECORDS = 100000
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def resource_key(configuration_item):
+    '''Returns the key of the resource in the state store. The resourceType
+    is needed, e.g. an EC2 instance and its SSM inventory share the resourceId'''
+    return "{}/{}/{}/{}".format(configuration_item['awsAccountId'], configuration_item.get('awsRegion'),
+                                configuration_item['resourceType'], configuration_item['resourceId'])
+
+
+def payload_hash(data):
+    '''Stable hash of the SNOW object without the fields that change with
+    every submission'''
+    stable = dict((key, value) for key, value in data.items() if key not in VOLATILE_FIELDS)
+    return hashlib.sha1(json.dumps(stable, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class StateStore():
+    '''Base class with write-behind buffering, backends implement _load and _write'''
+    def __init__(self):
+        self._cache = {}
+        # tag -> {key: record}, waiting for the submission of tag to succeed
+        self._staged = {}
+        # key -> record, waiting to be written to the backend
+        self._pending = {}
+        # Keys prefetch() found no record of, until the batch is committed
+        self._absent = set()
+        self._lock = threading.Lock()
+        self.skipped_unchanged = 0
+        self.skipped_stale = 0
+
+    def get(self, key):
+        with self._lock:
+            if key in self._pending:
+                return self._pending[key]
+            if key in self._cache:
+                return self._cache[key]
+            if key in self._absent:
+                return None
+
+        record = self._load(key)
+        with self._lock:
+            self._remember(key, record)
+        return record
+
+    def prefetch(self, keys):
+        '''Reads the records of keys that aren't cached yet with as few
+        backend calls as possible, e.g. for all resources of a batch'''
+        with self._lock:
+            missing = sorted(set([key for key in keys if key not in self._pending and key not in self._cache and key not in self._absent]))
+
+        for start in range(0, len(missing), READ_BATCH_SIZE):
+            chunk = missing[start:start + READ_BATCH_SIZE]
+            records = self._load_many(chunk)
+            with self._lock:
+                for key in chunk:
+                    if records.get(key) is None:
+                        self._absent.add(key)
+                    else:
+                        self._remember(key, records[key])
+
+    def put(self, key, record):
+        '''Buffers a record, it gets written with the next flush'''
+        with self._lock:
+            self._pending[key] = record
+            self._remember(key, record)
+            full = len(self._pending) >= WRITE_BATCH_SIZE
+
+        if full:
+            self.flush()
+
+    def stage(self, tag, key, record):
+        '''Remembers a record that only gets written once commit() confirms
+        the submission of tag'''
+        with self._lock:
+            self._staged.setdefault(tag, {})[key] = record
+
+    def commit(self, failed_tags=(), tags=None):
+        '''Writes the staged records of every tag that didn't fail, drops the
+        others so their resources get submitted again. With tags only those
+        are committed, batches processed in parallel don't commit each other'''
+        with self._lock:
+            if tags is None:
+                staged = self._staged
+                self._staged = {}
+            else:
+                staged = dict([(tag, self._staged.pop(tag)) for tag in tags if tag in self._staged])
+            for tag, records in staged.items():
+                if tag in failed_tags:
+                    continue
+                for key, record in records.items():
+                    self._pending[key] = record
+                    self._remember(key, record)
+            # Another process may write them meanwhile
+            self._absent.clear()
+
+        self.flush()
+
+    def discard(self, tags):
+        '''Drops the staged records of tags without writing them, for a batch
+        that failed before it got committed. Their resources get submitted
+        again'''
+        with self._lock:
+            for tag in tags:
+                self._staged.pop(tag, None)
+            self._absent.clear()
+
+    def flush(self):
+        '''Writes the pending records to the backend'''
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+
+        # Readers find the records in the cache in the meantime
+        if pending:
+            self._write(pending)
+
+    def should_submit(self, configuration_item, data, tag):
+        '''Checks the SNOW object data of configuration_item against the
+        stored state. Stages the new state if it needs to be submitted'''
+        key = resource_key(configuration_item)
+        record = {
+            'capture_time': configuration_item['configurationItemCaptureTime'],
+            'payload_hash': payload_hash(data),
+        }
+
+        stored = self.get(key)
+        if stored is not None:
+            # Both are formatted as %Y-%m-%dT%H:%M:%S.%fZ, so string compare works
+            if record['capture_time'] < stored['capture_time']:
+                logging.debug("Skipping %s, captured %s before the stored %s" % (key, record['capture_time'], stored['capture_time']))
+                self.skipped_stale += 1
+                return False
+
+            if record['payload_hash'] == stored['payload_hash']:
+                logging.debug("Skipping %s, unchanged since %s" % (key, stored['capture_time']))
+                self.skipped_unchanged += 1
+                # Move the watermark, SNOW already has the data
+                self.put(key, record)
+                return False
+
+        self.stage(tag, key, record)
+        return True
+
+    def _remember(self, key, record):
+        if record is None:
+            return
+        self._absent.discard(key)
+        if len(self._cache) >= MAX_CACHED_RECORDS:
+            self._cache.clear()
+        self._cache[key] = record
+
+    def _load(self, key):
+        raise NotImplementedError
+
+    def _load_many(self, keys):
+        '''Returns {key: record} of the keys that have a record'''
+        raise NotImplementedError
+
+    def _write(self, records):
+        raise NotImplementedError
+
+
+class SqliteStateStore(StateStore):
+    '''State store in a local sqlite file'''
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self._db_lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS resource_state (resource_key TEXT PRIMARY KEY, record TEXT NOT NULL)")
+        self._db.commit()
+
+    def _load(self, key):
+        with self._db_lock:
+            row = self._db.execute("SELECT record FROM resource_state WHERE resource_key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def _load_many(self, keys):
+        with self._db_lock:
+            rows = self._db.execute("SELECT resource_key, record FROM resource_state WHERE resource_key IN (%s)" % ",".join(["?"] * len(keys)),
+                                    keys).fetchall()
+        return dict([(key, json.loads(record)) for key, record in rows])
+
+    def _write(self, records):
+        with self._db_lock:
+            with self._db:
+                self._db.executemany("INSERT OR REPLACE INTO resource_state (resource_key, record) VALUES (?, ?)",
+                                     [(key, json.dumps(record)) for key, record in records.items()])
+
+
+class DynamoDbStateStore(StateStore):
+    '''State store in a DynamoDB table with the string hash key resource_key'''
+    def __init__(self, table_name, dynamodb_client=None, endpoint_url=None):
+        super().__init__()
+        self.table_name = table_name
+        if dynamodb_client is None:
+            import boto3
+            dynamodb_client = boto3.client('dynamodb', endpoint_url=endpoint_url)
+        self.dynamodb_client = dynamodb_client
+
+    def _load(self, key):
+        response = self.dynamodb_client.get_item(TableName=self.table_name, Key={'resource_key': {'S': key}})
+        if 'Item' not in response:
+            return None
+        return json.loads(response['Item']['record']['S'])
+
+    def _load_many(self, keys):
+        records = {}
+        request_items = {self.table_name: {'Keys': [{'resource_key': {'S': key}} for key in keys]}}
+        # DynamoDB hands back what it couldn't read when throttled
+        while request_items:
+            response = self.dynamodb_client.batch_get_item(RequestItems=request_items)
+            for item in response.get('Responses', {}).get(self.table_name, []):
+                records[item['resource_key']['S']] = json.loads(item['record']['S'])
+            request_items = response.get('UnprocessedKeys')
+        return records
+
+    def _write(self, records):
+        write_requests = [{'PutRequest': {'Item': {'resource_key': {'S': key}, 'record': {'S': json.dumps(record)}}}}
+                          for key, record in records.items()]
+        for start in range(0, len(write_requests), WRITE_BATCH_SIZE):
+            request_items = {self.table_name: write_requests[start:start + WRITE_BATCH_SIZE]}
+            # DynamoDB hands back what it couldn't write when throttled
+            while request_items:
+                response = self.dynamodb_client.batch_write_item(RequestItems=request_items)
+                request_items = response.get('UnprocessedItems')
+
+
+def open_state_store(url, endpoint_url=None):
+    '''Returns the process wide state store for url, which is either
+    sqlite:///path/to/file.db or dynamodb://table-name'''
+    if not url:
+        return None
+
+    with _stores_lock:
+        if url not in _stores:
+            if url.startswith('sqlite://'):
+                _stores[url] = SqliteStateStore(url[len('sqlite://'):])
+            elif url.startswith('dynamodb://'):
+                _stores[url] = DynamoDbStateStore(url[len('dynamodb://'):], endpoint_url=endpoint_url)
+            else:
+                raise ValueError("Unsupported state store %s" % url)
+        return _stores[url]
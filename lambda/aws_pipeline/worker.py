@@ -0,0 +1,226 @@
+# Long running SQS consumer for container deployments, e.g. backfills
+# Receiver threads long poll the queue and hand the messages to processor
+# threads through a bounded queue. Once it is full the receivers stop
+# polling, so we never hold more messages than we can process before their
+# visibility timeout. A heartbeat extends the visibility of every message
+# we hold, processed messages are deleted with DeleteMessageBatch.
+#
+# SIGTERM/SIGINT stop the receivers, the processors finish their current
+# batch and every message that wasn't started yet is made visible again
+# right away, so another worker picks it up
+import logging
+import queue
+import signal
+import threading
+import time
+
+from .metrics import metrics
+
+# SQS limits: 10 messages per receive and per batch call, 20 seconds long poll
+SQS_MAX_BATCH_ENTRIES = 10
+SQS_MAX_WAIT_SECONDS = 20
+
+DEFAULT_RECEIVERS = 2
+DEFAULT_PROCESSORS = 4
+DEFAULT_VISIBILITY_TIMEOUT = 120
+# Messages a processor hands to process_batch at once. Larger batches make
+# for fuller SNOW insertMultiple calls
+DEFAULT_BATCH_MESSAGES = 50
+
+# Pause after a failed receive, e.g. when throttled or the network is gone
+RECEIVE_ERROR_PAUSE = 5
+
+
+class SqsWorker():
+    '''Consumes queue_url until stopped, or until it was idle for
+    idle_exit seconds. process_batch gets lists of (message_id, body) and
+    returns the message ids that failed, those become visible again after
+    the visibility timeout'''
+    def __init__(self, queue_url, process_batch, sqs_client, receivers=DEFAULT_RECEIVERS, processors=DEFAULT_PROCESSORS,
+                 visibility_timeout=DEFAULT_VISIBILITY_TIMEOUT, batch_messages=DEFAULT_BATCH_MESSAGES,
+                 wait_seconds=SQS_MAX_WAIT_SECONDS, idle_exit=0):
+        self.queue_url = queue_url
+        self.process_batch = process_batch
+        self.sqs_client = sqs_client
+        self.receivers = max(1, int(receivers))
+        self.processors = max(1, int(processors))
+        self.visibility_timeout = int(visibility_timeout)
+        self.batch_messages = max(1, int(batch_messages))
+        self.wait_seconds = min(int(wait_seconds), SQS_MAX_WAIT_SECONDS)
+        self.idle_exit = idle_exit
+
+        # Backpressure: receive batches waiting for a processor
+        self._work = queue.Queue(maxsize=self.processors * 2)
+        # receipt handle -> message id of every message we hold
+        self._in_flight = {}
+        self._in_flight_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._last_received = time.time()
+
+        self.received = 0
+        self.deleted = 0
+        self.failed = 0
+        self.released = 0
+
+    def stop(self, *args):
+        '''Stops receiving, also the SIGTERM/SIGINT handler'''
+        if not self._stopping.is_set():
+            logging.info("Stopping SQS worker, finishing the current batches")
+        self._stopping.set()
+
+    def run(self):
+        '''Runs until stopped. Returns once every message we held is either
+        processed or released'''
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self.stop)
+            signal.signal(signal.SIGINT, self.stop)
+
+        receivers = [self._start(self._receive_loop, 'sqs-receiver-%s' % number) for number in range(self.receivers)]
+        processors = [self._start(self._process_loop, 'sqs-processor-%s' % number) for number in range(self.processors)]
+        heartbeat_stop = threading.Event()
+        heartbeat = self._start(self._heartbeat_loop, 'sqs-heartbeat', heartbeat_stop)
+
+        while not self._stopping.wait(1):
+            if self.idle_exit and self._idle() > self.idle_exit:
+                logging.info("No messages for %s seconds, stopping" % self.idle_exit)
+                self.stop()
+
+        # Receivers finish their long poll, what they get is released again
+        for thread in receivers:
+            thread.join()
+        for thread in processors:
+            thread.join()
+        self._release_queued()
+        heartbeat_stop.set()
+        heartbeat.join()
+        metrics.flush()
+
+        logging.info("SQS worker done: received %s, deleted %s, failed %s, released %s" % (self.received, self.deleted, self.failed, self.released))
+
+    def _start(self, target, name, *args):
+        thread = threading.Thread(target=target, name=name, args=args)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _idle(self):
+        '''Seconds since the last message, 0 while we still hold messages'''
+        with self._in_flight_lock:
+            if self._in_flight:
+                return 0
+        return time.time() - self._last_received
+
+    def _receive_loop(self):
+        while not self._stopping.is_set():
+            try:
+                response = self.sqs_client.receive_message(QueueUrl=self.queue_url, MaxNumberOfMessages=SQS_MAX_BATCH_ENTRIES,
+                                                           VisibilityTimeout=self.visibility_timeout, WaitTimeSeconds=self.wait_seconds)
+            except Exception as e:
+                logging.error("Failed to receive from %s: %s" % (self.queue_url, e))
+                self._stopping.wait(RECEIVE_ERROR_PAUSE)
+                continue
+
+            messages = response.get('Messages', [])
+            if not messages:
+                continue
+
+            self._last_received = time.time()
+            batch = [(message['MessageId'], message['ReceiptHandle'], message['Body']) for message in messages]
+            with self._in_flight_lock:
+                for message_id, receipt_handle, body in batch:
+                    self._in_flight[receipt_handle] = message_id
+                self.received += len(batch)
+            metrics.count('SqsReceived', len(batch))
+
+            # Blocks while the processors are behind
+            while True:
+                if self._stopping.is_set():
+                    self._release(batch)
+                    break
+                try:
+                    self._work.put(batch, timeout=1)
+                    break
+                except queue.Full:
+                    continue
+
+    def _process_loop(self):
+        while not self._stopping.is_set():
+            try:
+                batch = self._work.get(timeout=1)
+            except queue.Empty:
+                continue
+
+            # Whatever else is waiting already, up to batch_messages
+            while len(batch) < self.batch_messages:
+                try:
+                    batch = batch + self._work.get_nowait()
+                except queue.Empty:
+                    break
+
+            try:
+                failed = self.process_batch([(message_id, body) for message_id, receipt_handle, body in batch])
+            except Exception as e:
+                logging.fatal("Failed to process %s messages: %r" % (len(batch), e), exc_info=e)
+                failed = set([message_id for message_id, receipt_handle, body in batch])
+
+            self._delete([(message_id, receipt_handle) for message_id, receipt_handle, body in batch if message_id not in failed])
+            self._forget([receipt_handle for message_id, receipt_handle, body in batch])
+            self.failed += len(failed)
+            metrics.flush()
+
+    def _heartbeat_loop(self, stop):
+        '''Extends the visibility of every message we hold well before it
+        runs out'''
+        while not stop.wait(max(1, self.visibility_timeout / 3.0)):
+            with self._in_flight_lock:
+                in_flight = list(self._in_flight.items())
+            if in_flight:
+                self._change_visibility(in_flight, self.visibility_timeout)
+                metrics.count('SqsVisibilityExtended', len(in_flight))
+
+    def _release_queued(self):
+        while True:
+            try:
+                self._release(self._work.get_nowait())
+            except queue.Empty:
+                return
+
+    def _release(self, batch):
+        '''Makes messages we won't process visible again right away'''
+        handles = [(receipt_handle, message_id) for message_id, receipt_handle, body in batch]
+        self._change_visibility(handles, 0)
+        self._forget([receipt_handle for receipt_handle, message_id in handles])
+        self.released += len(handles)
+
+    def _forget(self, receipt_handles):
+        with self._in_flight_lock:
+            for receipt_handle in receipt_handles:
+                self._in_flight.pop(receipt_handle, None)
+
+    def _delete(self, messages):
+        '''Deletes (message_id, receipt_handle) with DeleteMessageBatch.
+        What fails to be deleted gets processed again, the state store
+        skips it then'''
+        for start in range(0, len(messages), SQS_MAX_BATCH_ENTRIES):
+            chunk = messages[start:start + SQS_MAX_BATCH_ENTRIES]
+            entries = [{'Id': str(number), 'ReceiptHandle': receipt_handle} for number, (message_id, receipt_handle) in enumerate(chunk)]
+            try:
+                response = self.sqs_client.delete_message_batch(QueueUrl=self.queue_url, Entries=entries)
+            except Exception as e:
+                logging.error("Failed to delete %s messages from %s: %s" % (len(entries), self.queue_url, e))
+                continue
+            if response.get('Failed'):
+                logging.error("Failed to delete %s messages from %s: %s" % (len(response['Failed']), self.queue_url, response['Failed']))
+            self.deleted += len(response.get('Successful', []))
+            metrics.count('SqsDeleted', len(response.get('Successful', [])))
+
+    def _change_visibility(self, handles, timeout):
+        '''Sets the visibility timeout of (receipt_handle, message_id)'''
+        for start in range(0, len(handles), SQS_MAX_BATCH_ENTRIES):
+            chunk = handles[start:start + SQS_MAX_BATCH_ENTRIES]
+            entries = [{'Id': str(number), 'ReceiptHandle': receipt_handle, 'VisibilityTimeout': timeout}
+                       for number, (receipt_handle, message_id) in enumerate(chunk)]
+            try:
+                self.sqs_client.change_message_visibility_batch(QueueUrl=self.queue_url, Entries=entries)
+            except Exception as e:
+                logging.error("Failed to change the visibility of %s messages in %s: %s" % (len(entries), self.queue_url, e))
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+# Reconciles the CMDB with the latest AWS Config snapshots, see
+# aws_pipeline/reconcile.py. Finds the newest snapshot of every account and
+# region in the AWS Config delivery bucket, or takes the given snapshot files,
+# and submits only the resources that are missing, differ or are gone from
+# the CMDB. With --state-store, the one of the lambda, resources live
+# processing has sent newer data for are left alone, e.g.
+#   reconcile-cmdb.py --config-bucket my-config-bucket --account 123456789012 --region us-east-1 --region eu-west-1 \
+#       --snow-hostname example.service-now.com --snow-user ... --snow-password ... --dry-run
+import argparse
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+
+from snow_objects.batch import DEFAULT_BATCH_SIZE, SnowBatchSubmitter  # noqa: E402
+from snow_objects.client import log_pool_stats  # noqa: E402
+from snow_objects.executor import SnowSubmissionExecutor  # noqa: E402
+from snow_objects.table import DEFAULT_PAGE_SIZE  # noqa: E402
+from aws_pipeline.metrics import metrics  # noqa: E402
+from aws_pipeline.parallel_map import close_mapping_pools  # noqa: E402
+from aws_pipeline.reconcile import (DEFAULT_MAX_DELETE_SHARE, DEFAULT_SNAPSHOT_DAYS, RECONCILE_TARGETS, Reconciliation,  # noqa: E402
+                                    latest_snapshot_key, snapshot_rows, snapshot_scope, snapshot_time)
+from aws_pipeline.s3_stream import parse_s3_url  # noqa: E402
+from aws_pipeline.state_store import open_state_store  # noqa: E402
+
+
+def snapshot_locations(args):
+    '''Returns (bucket, key) of every snapshot to reconcile'''
+    locations = [parse_s3_url(url) for url in args.get('snapshots') or []]
+    for account in args.get('accounts') or []:
+        for region in args.get('regions') or []:
+            key = latest_snapshot_key(args['config_bucket'], args.get('config_prefix'), account, region, days=args['snapshot_days'])
+            if key is None:
+                logging.error("No snapshot of %s/%s within %s days, not reconciling it" % (account, region, args['snapshot_days']))
+                continue
+            locations.append((args['config_bucket'], key))
+    return locations
+
+
+def reconcile(args):
+    '''Reconciles every scope of the snapshots. Returns the number of rows
+    that failed'''
+    submitter = None if args.get('dry_run') else SnowBatchSubmitter(args)
+    state_store = open_state_store(args.get('state_store_url'))
+    if state_store is None:
+        logging.warning("No state store, only the CMDB records updated since the snapshot are left alone")
+    reconciliation = Reconciliation(args, submitter, state_store=state_store, max_delete_share=args['max_delete_share'],
+                                    page_size=args['page_size'])
+
+    # The snapshots are mapped one after the other, possibly on all cores,
+    # their scopes are joined with the CMDB in parallel
+    executor = SnowSubmissionExecutor(args['reconcile_workers'])
+    for bucket, key in snapshot_locations(args):
+        logging.info("Mapping snapshot s3://%s/%s" % (bucket, key))
+        rows = snapshot_rows(bucket, key, processes=args.get('map_processes') or 0)
+        account, region = snapshot_scope(key)
+        capture_time = snapshot_time(key)
+        # Every type, no items of a type might mean all of them are gone
+        for resource_type in sorted(RECONCILE_TARGETS):
+            scope = (account, region, resource_type)
+            executor.submit(scope, reconciliation.reconcile, scope, rows.get(scope, []), capture_time)
+
+    failed_scopes = 0
+    for outcome in executor.wait():
+        if not outcome.ok:
+            logging.fatal("Failed to reconcile %s: %r" % ("/".join(outcome.tag), outcome.error), exc_info=outcome.error)
+            failed_scopes += 1
+    executor.shutdown()
+
+    failed = 0
+    if submitter is not None:
+        results = submitter.flush()
+        submitter.shutdown()
+        failed = len([result for result in results if not result.ok])
+        logging.info("Submitted %s rows to SNOW, %s failed" % (len(results), failed))
+    logging.info("Reconciled: %s%s" % (dict(reconciliation.counts), " (dry run)" if args.get('dry_run') else ""))
+    return failed + failed_scopes
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Reconcile the CMDB with the latest AWS Config snapshots')
+    parser.add_argument('--debug', '-d', dest='debug', action='store_true', required=False, help='Enable debugging output')
+    parser.add_argument('--config-bucket', dest='config_bucket', default='', required=False, help='S3 bucket AWS Config delivers the snapshots to')
+    parser.add_argument('--config-prefix', dest='config_prefix', default='', required=False, help='Key prefix of the AWS Config delivery channel')
+    parser.add_argument('--account', dest='accounts', action='append', required=False, help='AWS account to reconcile, can be given more than once')
+    parser.add_argument('--region', dest='regions', action='append', required=False, help='AWS region to reconcile, can be given more than once')
+    parser.add_argument('--snapshot', dest='snapshots', action='append', required=False, help='s3://bucket/key of a snapshot file to reconcile, instead of the latest one')
+    parser.add_argument('--snapshot-days', dest='snapshot_days', type=int, default=DEFAULT_SNAPSHOT_DAYS, required=False, help='Days to look back for the latest snapshot')
+    parser.add_argument('--dry-run', dest='dry_run', action='store_true', required=False, help='Only count the creates, updates and deletes')
+    parser.add_argument('--max-delete-share', dest='max_delete_share', type=float, default=DEFAULT_MAX_DELETE_SHARE, required=False, help='Skip the deletes of an account/region if more than this share of its CMDB records would be deleted')
+    parser.add_argument('--state-store', dest='state_store_url', default='', required=False, help='State store of the lambda, sqlite:///path/to/file.db or dynamodb://table-name. Skips the resources live processing has newer data for')
+    parser.add_argument('--page-size', dest='page_size', type=int, default=DEFAULT_PAGE_SIZE, required=False, help='CMDB records per Table API request')
+    parser.add_argument('--reconcile-workers', dest='reconcile_workers', type=int, default=4, required=False, help='Account/regions joined with the CMDB in parallel')
+    parser.add_argument('--map-processes', dest='map_processes', type=int, default=0, required=False, help='Map snapshot items on this many processes, e.g. the number of cores')
+    parser.add_argument('--snow-hostname', '-n', dest='snow_hostname', default='', required=True, help='SNOW hostname, HOSTNAME in https://HOSTNAME/, no https etc.')
+    parser.add_argument('--snow-scheme', dest='snow_scheme', default='https', required=False, help='https, or http for a local SNOW stand-in')
+    parser.add_argument('--snow-user', '-u', dest='snow_user', default='', required=True, help='SNOW API User')
+    parser.add_argument('--snow-password', '-p', dest='snow_password', default='', required=True, help='SNOW API Password')
+    parser.add_argument('--snow-batch-size', dest='snow_batch_size', type=int, default=DEFAULT_BATCH_SIZE, required=False, help='Max. number of rows per SNOW insertMultiple call')
+    parser.add_argument('--snow-workers', dest='snow_workers', type=int, default=8, required=False, help='Number of threads submitting to SNOW')
+    parser.add_argument('--snow-rate-limit', dest='snow_rate_limit', type=float, default=0, required=False, help='Max. SNOW requests per second, 0 for no limit')
+    args = vars(parser.parse_args())
+
+    if not args['snapshots'] and not (args['config_bucket'] and args['accounts'] and args['regions']):
+        parser.error("Either --snapshot or --config-bucket with --account and --region is required")
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    logging.basicConfig(level=logging.DEBUG if args['debug'] else logging.INFO,
+                        format="[%(levelname)8s:%(filename)25s:%(lineno)4s - %(funcName)45s()] %(message)s")
+    try:
+        failed = reconcile(args)
+    finally:
+        close_mapping_pools()
+        log_pool_stats()
+        metrics.flush()
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+# Sends the rows spilled to S3 while SNOW was degraded to SNOW, once it is
+# back. Per import set table only the latest row of every SNOW object goes,
+# sorted by its key, in windows of insertMultiple calls on many threads.
+# After every window the progress is checkpointed in S3, an interrupted replay
+# resumes where it stopped. Rows SNOW rejects are spilled to
+# <prefix>/_failed/<table>/, replay them with --spill-url .../_failed once
+# fixed. If SNOW degrades again the replay stops, run it again later.
+# With --state-store, the one of the lambda, rows live processing has sent
+# newer data for since are skipped, see aws_pipeline/spill.py
+import argparse
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+
+from snow_objects.batch import DEFAULT_BATCH_SIZE, SnowBatchSubmitter  # noqa: E402
+from snow_objects.client import log_pool_stats, snow_unavailable  # noqa: E402
+from aws_pipeline.metrics import metrics  # noqa: E402
+from aws_pipeline.s3_cache import get_s3_client  # noqa: E402
+from aws_pipeline.spill import (FAILED_PREFIX, ReplayCheckpoint, delete_segments, latest_rows, list_segments, list_tables, parse_spill_url,  # noqa: E402
+                                replay_state_key, spill_line, superseded, table_resource_types, write_segment)
+from aws_pipeline.state_store import open_state_store  # noqa: E402
+
+# insertMultiple calls per worker between two checkpoints
+WINDOW_CHUNKS = 4
+
+
+def replay_table(table, checkpoint, args):
+    '''Sends the spilled rows of table to SNOW. Returns False if SNOW
+    degraded while doing so'''
+    s3_client = get_s3_client()
+    bucket, prefix = parse_spill_url(args['spill_url'])
+
+    segments, rows_done = checkpoint.in_progress(table)
+    if segments is None:
+        replayed = checkpoint.replayed()
+        segments = [segment for segment in list_segments(s3_client, bucket, prefix, table) if segment not in replayed]
+        if not segments:
+            logging.info("Nothing to replay for %s" % table)
+            return True
+        # The segments spilled while we replay wait for the next run
+        checkpoint.progress(table, segments, 0)
+    else:
+        logging.info("Resuming replay of %s after %s rows" % (table, rows_done))
+
+    rows = latest_rows(s3_client, bucket, segments)
+    logging.info("Replaying %s rows of %s segments to SNOW table %s" % (len(rows), len(segments), table))
+
+    window = args['snow_batch_size'] * args['snow_workers'] * WINDOW_CHUNKS
+    submitter = SnowBatchSubmitter(args)
+    while rows_done < len(rows):
+        rows_window = rows[rows_done:rows_done + window]
+        skipped = 0
+        for key, row in current_rows(table, rows_window, args.get('state_store')):
+            if row is None:
+                skipped += 1
+                continue
+            submitter.add(table, row, key)
+        failed = set([result.tag for result in submitter.flush() if not result.ok])
+
+        if failed and snow_unavailable(args):
+            logging.error("SNOW is degraded again, stopping the replay of %s after %s of %s rows" % (table, rows_done, len(rows)))
+            return False
+
+        if failed:
+            segment = write_segment(s3_client, bucket, '/'.join([part for part in [prefix, FAILED_PREFIX, table] if part]),
+                                [spill_line(key, row) for key, row in rows_window if key in failed])
+            logging.error("SNOW rejected %s rows of %s, spilled them to s3://%s/%s" % (len(failed), table, bucket, segment))
+        metrics.count('ReplayedRows', len(rows_window) - len(failed) - skipped, table=table, outcome='ok')
+        metrics.count('ReplayedRows', len(failed), table=table, outcome='error')
+        metrics.count('ReplayedRows', skipped, table=table, outcome='superseded')
+
+        rows_done += len(rows_window)
+        checkpoint.progress(table, segments, rows_done)
+        logging.info("Replayed %s of %s rows of %s, %s superseded by live processing" % (rows_done, len(rows), table, skipped))
+
+    if args.get('delete'):
+        delete_segments(s3_client, bucket, segments)
+    checkpoint.done(table, segments, deleted=args.get('delete'))
+    logging.info("Replayed %s segments of %s" % (len(segments), table))
+    return True
+
+
+def current_rows(table, rows, state_store):
+    '''Yields the (key, row) tuples of rows, the row None if the state store
+    has newer data of it'''
+    if state_store is None:
+        for key, row in rows:
+            yield key, row
+        return
+
+    resource_types = table_resource_types()
+    state_keys = [replay_state_key(table, row, resource_types) for key, row in rows]
+    state_store.prefetch([state_key for state_key in state_keys if state_key is not None])
+    for (key, row), state_key in zip(rows, state_keys):
+        if state_key is not None and superseded(row, state_store.get(state_key)):
+            logging.debug("Skipping %s, superseded by live processing" % key)
+            yield key, None
+        else:
+            yield key, row
+
+
+def replay(args):
+    s3_client = get_s3_client()
+    bucket, prefix = parse_spill_url(args['spill_url'])
+    checkpoint = ReplayCheckpoint(s3_client, bucket, prefix)
+
+    args['state_store'] = open_state_store(args.get('state_store_url'))
+    if args['state_store'] is None:
+        logging.warning("No state store, the spilled rows overwrite what live processing sent to SNOW since")
+
+    tables = args.get('tables') or list_tables(s3_client, bucket, prefix)
+    try:
+        for table in tables:
+            if not replay_table(table, checkpoint, args):
+                return False
+        return True
+    finally:
+        log_pool_stats()
+        metrics.flush()
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Replay the rows spilled while SNOW was degraded')
+    parser.add_argument('--debug', '-d', dest='debug', action='store_true', required=False, help='Enable debugging output')
+    parser.add_argument('--spill-url', dest='spill_url', required=True, help='s3://bucket/prefix the lambda spilled to')
+    parser.add_argument('--state-store', dest='state_store_url', default='', required=False, help='State store of the lambda, sqlite:///path/to/file.db or dynamodb://table-name. Skips the rows live processing has newer data for')
+    parser.add_argument('--table', dest='tables', action='append', required=False, help='Only replay this SNOW import set table, can be given more than once')
+    parser.add_argument('--snow-hostname', '-n', dest='snow_hostname', default='', required=True, help='SNOW hostname, HOSTNAME in https://HOSTNAME/, no https etc.')
+    parser.add_argument('--snow-scheme', dest='snow_scheme', default='https', required=False, help='https, or http for a local SNOW stand-in')
+    parser.add_argument('--snow-user', '-u', dest='snow_user', default='', required=True, help='SNOW API User')
+    parser.add_argument('--snow-password', '-p', dest='snow_password', default='', required=True, help='SNOW API Password')
+    parser.add_argument('--snow-batch-size', dest='snow_batch_size', type=int, default=DEFAULT_BATCH_SIZE, required=False, help='Max. number of rows per SNOW insertMultiple call')
+    parser.add_argument('--snow-workers', dest='snow_workers', type=int, default=16, required=False, help='Number of threads submitting to SNOW')
+    parser.add_argument('--snow-rate-limit', dest='snow_rate_limit', type=float, default=0, required=False, help='Max. SNOW requests per second, 0 for no limit')
+    parser.add_argument('--delete', dest='delete', action='store_true', required=False, help='Delete the segments once replayed, otherwise the checkpoint remembers them')
+    return vars(parser.parse_args())
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    logging.basicConfig(level=logging.DEBUG if args['debug'] else logging.INFO,
+                        format="[%(levelname)8s:%(filename)25s:%(lineno)4s - %(funcName)45s()] %(message)s")
+    sys.exit(0 if replay(args) else 1)
@@ -0,0 +1,238 @@
+# Batched SNOW submission for the asyncio pipeline
+# Full chunks are posted as tasks as soon as they are full, up to concurrency
+# POSTs per SNOW instance are in flight at once. Uses aiohttp if it is
+# installed, otherwise the requests based SnowClient runs on a thread pool.
+# Either way the rate limiter and circuit breaker of the SnowClient are shared
+# with the sync path.
+# Chunks, fallback to single rows and row results work like in batch.py
+import asyncio
+import atexit
+import concurrent.futures
+import logging
+import time
+import weakref
+
+from aws_pipeline.metrics import SECONDS_TO_MILLISECONDS, metrics
+from . import jsonlib
+from .batch import ROW_REJECTED_STATUS_CODES, SnowBatchSubmitter, SnowRowResult, chunk_body, chunk_error_results, chunk_path, chunk_results, count_rows, row_path, row_result
+from .client import DEFAULT_TIMEOUT, get_snow_client, snow_base_url
+from .retry import RetryPolicy, retry_delay
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# POSTs in flight per SNOW instance
+DEFAULT_CONCURRENCY = 10
+
+# {event loop: {base_url: client}}, a client is bound to the loop it was
+# created on
+_clients = weakref.WeakKeyDictionary()
+
+
+class SnowResponse():
+    '''The parts of a requests response the batch functions look at'''
+    __slots__ = ('status_code', 'headers', 'text')
+
+    def __init__(self, status_code, headers, text):
+        self.status_code = status_code
+        self.headers = headers
+        self.text = text
+
+    def json(self):
+        return jsonlib.loads(self.text)
+
+
+async def _acquire(rate_limiter):
+    '''TokenBucket.acquire without blocking the event loop'''
+    while True:
+        wait = rate_limiter.reserve()
+        if not wait:
+            return
+        await asyncio.sleep(wait)
+
+
+class AsyncSnowClient():
+    '''POSTs to a single SNOW instance from the event loop it was created on'''
+    def __init__(self, args, concurrency=DEFAULT_CONCURRENCY):
+        self.base_url = snow_base_url(args)
+        self.concurrency = max(1, int(concurrency))
+        # Rate limiter and, without aiohttp, the connection pool. Every
+        # concurrent POST needs its own connection
+        self.sync_client = get_snow_client(dict(args, snow_workers=max(self.concurrency, int(args.get('snow_workers') or 1))))
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        # Blocking calls: the sync client without aiohttp, credential refreshes
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency)
+        self._session = None
+
+    async def post(self, path, args, data):
+        '''SnowClient.post as a coroutine'''
+        async with self._semaphore:
+            if aiohttp is None:
+                return await asyncio.get_event_loop().run_in_executor(self._executor, self.sync_client.post, path, args, data)
+            return await self._post("{}{}".format(self.base_url, path), args, data)
+
+    async def _post(self, url, args, data):
+        '''SnowClient.post with the retries and circuit breaker shared with
+        the sync client'''
+        rate_limiter = self.sync_client.rate_limiter
+        breaker = self.sync_client.circuit_breaker
+        policy = RetryPolicy(deadline=args.get('deadline'))
+
+        attempt = 0
+        while True:
+            breaker.check()
+            await _acquire(rate_limiter)
+            response = error = None
+            try:
+                response = await self._post_with_refresh(url, args, data)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+            except BaseException:
+                # Also a CancelledError, an Exception before python 3.8
+                breaker.abort_trial()
+                raise
+
+            delay = retry_delay(policy, breaker, rate_limiter, attempt, response, error)
+            if delay is None:
+                if error is not None:
+                    raise error
+                return response
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def _post_with_refresh(self, url, args, data):
+        response = await self._timed_post(url, args, data)
+
+        refresh = args.get('snow_credentials_refresh')
+        if response.status_code == 401 and refresh is not None:
+            logging.warning("SNOW returned 401, refreshing credentials and trying again")
+            # Secrets Manager call, keep it off the event loop
+            args['snow_user'], args['snow_password'] = await asyncio.get_event_loop().run_in_executor(self._executor, refresh)
+            response = await self._timed_post(url, args, data)
+
+        return response
+
+    async def _timed_post(self, url, args, data):
+        session = self._get_session()
+        start = time.perf_counter()
+        try:
+            async with session.post(url, data=data, auth=aiohttp.BasicAuth(args['snow_user'], args['snow_password'])) as response:
+                text = await response.text()
+        except Exception:
+            metrics.record('SnowRequestTime', (time.perf_counter() - start) * SECONDS_TO_MILLISECONDS, 'Milliseconds', {'status': 'error'})
+            raise
+        metrics.record('SnowRequestTime', (time.perf_counter() - start) * SECONDS_TO_MILLISECONDS, 'Milliseconds', {'status': str(response.status)})
+        metrics.record('SnowRequestBytes', len(data), 'Bytes')
+        return SnowResponse(response.status, response.headers, text)
+
+    def _get_session(self):
+        # Created on first use, it needs the running loop
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.concurrency),
+                timeout=aiohttp.ClientTimeout(sock_connect=DEFAULT_TIMEOUT[0], sock_read=DEFAULT_TIMEOUT[1]),
+                headers={"Content-Type": "application/json", "Accept": "application/json"},
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+def get_async_snow_client(args, concurrency=None):
+    '''Returns the client for args['snow_hostname'] of the running event loop.
+    It lives as long as the loop, on a loop that is kept between lambda
+    invocations the connections are reused'''
+    loop_clients = _clients.setdefault(asyncio.get_event_loop(), {})
+    base_url = snow_base_url(args)
+    if base_url not in loop_clients:
+        logging.debug("Creating new async SNOW client for %s" % base_url)
+        loop_clients[base_url] = AsyncSnowClient(args, concurrency or args.get('snow_concurrency') or DEFAULT_CONCURRENCY)
+    return loop_clients[base_url]
+
+
+@atexit.register
+def _close_clients():
+    '''The loops outlive the invocations, close their sessions on exit'''
+    for loop, loop_clients in list(_clients.items()):
+        if loop.is_closed() or loop.is_running():
+            continue
+        for client in loop_clients.values():
+            loop.run_until_complete(client.close())
+
+
+class AsyncSnowBatchSubmitter(SnowBatchSubmitter):
+    '''SnowBatchSubmitter for code running on an event loop. add() posts a
+    full chunk as task, flush() is a coroutine. Only use it from the thread
+    of the loop'''
+    def __init__(self, args, client=None, batch_size=None, batch_bytes=None):
+        # A single worker, the base class then never starts a thread
+        SnowBatchSubmitter.__init__(self, args, batch_size, batch_bytes, workers=1)
+        self.client = client or get_async_snow_client(args)
+        self._tasks = []
+
+    def threadsafe(self):
+        '''Returns a submitter for code running on other threads, e.g.
+        BlockingCalls, that hands the rows to this one on its loop'''
+        return LoopSubmitter(self, asyncio.get_event_loop())
+
+    async def flush(self):
+        '''Sends all buffered rows and returns the results of every row
+        submitted since the last flush'''
+        for table in list(self._buffers):
+            self._send(*self._take(table))
+
+        tasks, self._tasks = self._tasks, []
+        results = []
+        for chunk in await asyncio.gather(*tasks):
+            results.extend(chunk)
+
+        count_rows(results)
+        return results
+
+    def _send(self, table, rows):
+        if not rows:
+            return
+
+        logging.debug("Submitting %s rows to SNOW table %s" % (len(rows), table))
+        self._tasks.append(asyncio.ensure_future(self._submit_chunk_async(table, rows)))
+
+    async def _submit_chunk_async(self, table, rows):
+        '''Sends rows with one insertMultiple call'''
+        try:
+            response = await self.client.post(chunk_path(table), self.args, chunk_body(rows))
+        except Exception as e:
+            return chunk_error_results(table, rows, e)
+
+        if response.status_code in [200, 201]:
+            return chunk_results(table, rows, response)
+
+        if response.status_code not in ROW_REJECTED_STATUS_CODES:
+            return chunk_error_results(table, rows, "SNOW responded with status code %s" % response.status_code)
+
+        # Same fallback as the sync submitter, the rows go in parallel
+        logging.warning("SNOW rejected insertMultiple on %s with %s, falling back to single rows" % (table, response.status_code))
+        return await asyncio.gather(*[self._submit_row_async(table, row, tag) for row, tag in rows])
+
+    async def _submit_row_async(self, table, row, tag):
+        '''Sends a single row to the import set table'''
+        try:
+            response = await self.client.post(row_path(table), self.args, row)
+        except Exception as e:
+            return SnowRowResult(table, tag, False, None, None, str(e))
+        return row_result(table, tag, response)
+
+
+class LoopSubmitter():
+    '''add() of an AsyncSnowBatchSubmitter for other threads. The rows are
+    added on the loop, before a blocking call that added them returns there'''
+    def __init__(self, submitter, loop):
+        self.submitter = submitter
+        self.loop = loop
+
+    def add(self, table, data, tag=None):
+        self.loop.call_soon_threadsafe(self.submitter.add, table, data, tag)
@@ -0,0 +1,193 @@
+# Buffered submission of SNOW objects via the import set insertMultiple API
+# Rows are collected per import set table and sent in chunks, instead of one
+# POST per configuration item
+import collections
+import logging
+import threading
+
+from aws_pipeline.metrics import metrics
+from . import jsonlib
+from .client import get_snow_client
+from .executor import SnowSubmissionExecutor
+
+DEFAULT_BATCH_SIZE = 100
+# SNOW rejects bodies above glide.rest.max_content_length (10MB by default),
+# stay well below it
+DEFAULT_BATCH_BYTES = 1024 * 1024
+
+# SNOW rejected the data of an insertMultiple call, a single row may be to
+# blame. Sent one by one only that row fails. Any other status, like 401, 403
+# or 404, fails the rows of the chunk as they are
+ROW_REJECTED_STATUS_CODES = [400, 413, 422]
+
+# Import set row states SNOW reports back per row
+FAILED_ROW_STATES = ['error']
+
+# Outcome of a single submitted row. tag is whatever the caller handed in to
+# find the origin of the row again, e.g. the SQS message id
+SnowRowResult = collections.namedtuple('SnowRowResult', ['table', 'tag', 'ok', 'status', 'sys_id', 'message'])
+
+
+class SnowBatchSubmitter():
+    '''Collects rows per SNOW import set table and flushes them in chunks'''
+    def __init__(self, args, batch_size=None, batch_bytes=None, workers=None):
+        # Args only here to not accidently expose the credentials. The SNOW
+        # client updates them if the password got rotated
+        self.args = args
+        self.batch_size = int(batch_size or args.get('snow_batch_size') or DEFAULT_BATCH_SIZE)
+        self.batch_bytes = int(batch_bytes or args.get('snow_batch_bytes') or DEFAULT_BATCH_BYTES)
+
+        # Full chunks are sent by the executor while new rows get buffered
+        self.executor = SnowSubmissionExecutor(workers or args.get('snow_workers') or 1)
+
+        self._buffers = {}
+        self._buffer_bytes = {}
+        self._lock = threading.Lock()
+
+    def add(self, table, data, tag=None):
+        '''Buffers a row for table. Sends the buffer of the table when it is full'''
+        row = jsonlib.dumps(data)
+        full = []
+
+        with self._lock:
+            # Byte budget: send what we have before the row would exceed it
+            if table in self._buffers and self._buffer_bytes[table] + len(row) > self.batch_bytes:
+                full.append(self._take(table))
+
+            self._buffers.setdefault(table, []).append((row, tag))
+            self._buffer_bytes[table] = self._buffer_bytes.get(table, 0) + len(row) + 1
+
+            if len(self._buffers[table]) >= self.batch_size:
+                full.append(self._take(table))
+
+        # Sending happens outside of the lock, other threads keep buffering
+        for table, rows in full:
+            self._send(table, rows)
+
+    def flush(self):
+        '''Sends all buffered rows and returns the results of every row
+        submitted since the last flush'''
+        with self._lock:
+            full = [self._take(table) for table in list(self._buffers)]
+        for table, rows in full:
+            self._send(table, rows)
+
+        results = []
+        for outcome in self.executor.wait():
+            if outcome.ok:
+                results.extend(outcome.result)
+                continue
+
+            table, rows = outcome.tag
+            results.extend([SnowRowResult(table, tag, False, None, None, str(outcome.error)) for row, tag in rows])
+
+        count_rows(results)
+        return results
+
+    def shutdown(self):
+        '''Stops the threads of the submitter, flush() first'''
+        self.executor.shutdown()
+
+    def _take(self, table):
+        rows = self._buffers.pop(table, [])
+        self._buffer_bytes.pop(table, None)
+        return table, rows
+
+    def _send(self, table, rows):
+        if not rows:
+            return
+
+        logging.debug("Submitting %s rows to SNOW table %s" % (len(rows), table))
+        self.executor.submit((table, rows), self._submit_chunk, table, rows)
+
+    def _submit_chunk(self, table, rows):
+        '''Sends rows with one insertMultiple call'''
+        try:
+            response = get_snow_client(self.args).post(chunk_path(table), self.args, chunk_body(rows))
+        except Exception as e:
+            return chunk_error_results(table, rows, e)
+
+        if response.status_code in [200, 201]:
+            return chunk_results(table, rows, response)
+
+        if response.status_code not in ROW_REJECTED_STATUS_CODES:
+            # Retried already, or an auth or routing error every single row
+            # would run into as well
+            return chunk_error_results(table, rows, "SNOW responded with status code %s" % response.status_code)
+
+        # A single broken row can make SNOW reject the whole request. Send
+        # the rows one by one so only the broken one fails
+        logging.warning("SNOW rejected insertMultiple on %s with %s, falling back to single rows" % (table, response.status_code))
+        return [self._submit_row(table, row, tag) for row, tag in rows]
+
+    def _submit_row(self, table, row, tag):
+        '''Sends a single row to the import set table'''
+        try:
+            response = get_snow_client(self.args).post(row_path(table), self.args, row)
+        except Exception as e:
+            return SnowRowResult(table, tag, False, None, None, str(e))
+        return row_result(table, tag, response)
+
+
+# Request and response handling shared with the asyncio submitter
+def count_rows(results):
+    '''Records the submitted rows per table and outcome'''
+    rows_by_outcome = collections.Counter([(result.table, result.ok) for result in results])
+    for (table, ok), rows in rows_by_outcome.items():
+        metrics.count('SnowRows', rows, table=table, outcome='ok' if ok else 'error')
+
+
+def chunk_path(table):
+    return "/api/now/import/{}/insertMultiple".format(table)
+
+
+def row_path(table):
+    return "/api/now/import/{}".format(table)
+
+
+def chunk_body(rows):
+    '''insertMultiple body of already serialized (row, tag) tuples'''
+    return b'{"records":[' + b','.join([row for row, tag in rows]) + b']}'
+
+
+def chunk_error_results(table, rows, error):
+    logging.error("Failed to submit %s rows to SNOW table %s: %s" % (len(rows), table, error))
+    return [SnowRowResult(table, tag, False, None, None, str(error)) for row, tag in rows]
+
+
+def chunk_results(table, rows, response):
+    '''Results of the rows of an accepted insertMultiple call'''
+    row_results = _response_rows(response)
+    if len(row_results) != len(rows):
+        # SNOW processes the import set asynchronously, no result per row
+        return [SnowRowResult(table, tag, True, 'queued', None, None) for row, tag in rows]
+
+    return [_row_result(table, tag, result) for (row, tag), result in zip(rows, row_results)]
+
+
+def row_result(table, tag, response):
+    '''Result of a row sent on its own'''
+    if response.status_code != 201:
+        return SnowRowResult(table, tag, False, str(response.status_code), None, response.text)
+
+    row_results = _response_rows(response)
+    if not row_results:
+        return SnowRowResult(table, tag, True, 'inserted', None, None)
+    return _row_result(table, tag, row_results[0])
+
+
+def _response_rows(response):
+    '''Returns the per row results of an import set response'''
+    try:
+        result = response.json().get('result', [])
+    except ValueError:
+        return []
+    if isinstance(result, dict):
+        return [result]
+    return result
+
+
+def _row_result(table, tag, row_result):
+    status = row_result.get('status')
+    message = row_result.get('error_message') or row_result.get('status_message')
+    return SnowRowResult(table, tag, status not in FAILED_ROW_STATES, status, row_result.get('sys_id'), message)
@@ -0,0 +1,207 @@
+# Pooled HTTP client for the SNOW REST API
+# One client per SNOW hostname lives on module level, so the TCP+TLS
+# connections survive between warm lambda invocations and between the
+# iterations of the process_sqs loop
+# requests is only imported with the first client, importing it costs about
+# 100ms of lambda cold start that messages we skip don't need
+import logging
+import socket
+import threading
+import time
+
+from aws_pipeline.metrics import SECONDS_TO_MILLISECONDS, metrics
+from .retry import CircuitBreaker, RetryPolicy, retry_delay
+from .throttle import TokenBucket
+
+# Number of hosts we keep a pool for and number of connections per host
+DEFAULT_POOL_CONNECTIONS = 4
+DEFAULT_POOL_MAXSIZE = 10
+
+# Connection and read timeout in seconds. Without a timeout a hanging SNOW
+# instance keeps the lambda busy until it gets killed
+DEFAULT_TIMEOUT = (5, 60)
+
+# SNOW is only reachable via https, http is for local stand-ins in load tests
+DEFAULT_SCHEME = 'https'
+
+# Keep idle connections alive on TCP level, otherwise NAT gateways and
+# load balancers drop them silently between two invocations
+KEEPALIVE_SOCKET_OPTIONS = [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+if hasattr(socket, 'TCP_KEEPIDLE'):
+    KEEPALIVE_SOCKET_OPTIONS += [
+        (socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 60),
+        (socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 20),
+        (socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3),
+    ]
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def keep_alive_adapter(pool_connections, pool_maxsize):
+    '''Returns a HTTPAdapter that enables TCP keep-alive on every pooled
+    connection'''
+    from requests.adapters import HTTPAdapter
+    from urllib3.connection import HTTPConnection
+
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+    # Same call HTTPAdapter.__init__ does, plus the socket options
+    adapter.init_poolmanager(pool_connections, pool_maxsize,
+                             socket_options=HTTPConnection.default_socket_options + KEEPALIVE_SOCKET_OPTIONS)
+    return adapter
+
+
+class SnowClient():
+    '''Persistent session to a single SNOW instance'''
+    def __init__(self, hostname, pool_connections=DEFAULT_POOL_CONNECTIONS, pool_maxsize=DEFAULT_POOL_MAXSIZE, rate_limit=None, scheme=DEFAULT_SCHEME):
+        self.hostname = hostname
+        self.base_url = "{}://{}".format(scheme, hostname)
+        # Shared by every thread that talks to this instance
+        self.rate_limiter = TokenBucket(rate_limit)
+        self.circuit_breaker = CircuitBreaker()
+
+        import requests
+        # Retried, anything else propagates without touching the breaker
+        self.transport_errors = (requests.ConnectionError, requests.Timeout)
+        self.adapter = keep_alive_adapter(pool_connections, pool_maxsize)
+        self.session = requests.Session()
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+        self.session.headers.update({
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+            "Connection": "keep-alive",
+        })
+
+    def post(self, path, args, data):
+        '''POSTs already serialized data to the SNOW instance. Waits for the
+        rate limiter, retries connection errors and 408/429/502/503/504 with
+        backoff until args['deadline'] and raises SnowUnavailableError while
+        the circuit breaker is open, see retry.py'''
+        return self._request('POST', path, args, data=data)
+
+    def get(self, path, args, params=None):
+        '''GETs path with the query parameters params, e.g. from the Table
+        API. Rate limited and retried like post'''
+        return self._request('GET', path, args, params=params)
+
+    def _request(self, method, path, args, **kwargs):
+        url = "{}{}".format(self.base_url, path)
+        policy = RetryPolicy(deadline=args.get('deadline'))
+
+        attempt = 0
+        while True:
+            self.circuit_breaker.check()
+            self.rate_limiter.acquire()
+            response = error = None
+            try:
+                response = self._send(method, url, args, kwargs)
+            except self.transport_errors as e:
+                error = e
+            except Exception:
+                self.circuit_breaker.abort_trial()
+                raise
+
+            delay = retry_delay(policy, self.circuit_breaker, self.rate_limiter, attempt, response, error)
+            if delay is None:
+                if error is not None:
+                    raise error
+                return response
+            time.sleep(delay)
+            attempt += 1
+
+    def _send(self, method, url, args, kwargs):
+        '''Request with the credentials from args. On a 401 the credentials
+        are refreshed once via args['snow_credentials_refresh']'''
+        response = self._timed_request(method, url, args, kwargs)
+
+        refresh = args.get('snow_credentials_refresh')
+        if response.status_code == 401 and refresh is not None:
+            logging.warning("SNOW returned 401, refreshing credentials and trying again")
+            args['snow_user'], args['snow_password'] = refresh()
+            response = self._timed_request(method, url, args, kwargs)
+
+        return response
+
+    def _timed_request(self, method, url, args, kwargs):
+        '''A single request, its duration is recorded per status code'''
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, url, auth=(args['snow_user'], args['snow_password']), timeout=DEFAULT_TIMEOUT, **kwargs)
+        except Exception:
+            metrics.record('SnowRequestTime', (time.perf_counter() - start) * SECONDS_TO_MILLISECONDS, 'Milliseconds', {'status': 'error'})
+            raise
+        metrics.record('SnowRequestTime', (time.perf_counter() - start) * SECONDS_TO_MILLISECONDS, 'Milliseconds', {'status': str(response.status_code)})
+        if kwargs.get('data') is not None:
+            metrics.record('SnowRequestBytes', len(kwargs['data']), 'Bytes')
+        return response
+
+    def stats(self):
+        '''Returns connection pool counters. A hit is a request on an
+        already open connection, a miss needed a new TCP+TLS handshake'''
+        requests_total = 0
+        connections = 0
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            requests_total += pool.num_requests
+            connections += pool.num_connections
+
+        return {
+            'requests': requests_total,
+            'pool_hits': requests_total - connections,
+            'pool_misses': connections,
+        }
+
+
+def snow_base_url(args):
+    '''Returns the URL of the SNOW instance in args, e.g. https://HOSTNAME'''
+    return "{}://{}".format(args.get('snow_scheme') or DEFAULT_SCHEME, args['snow_hostname'])
+
+
+def snow_concurrency(args):
+    '''Max. number of threads of this process that talk to SNOW at once.
+    Every processor of the SQS worker has its own submitter with snow_workers
+    threads, or with --async up to snow_concurrency POSTs in flight. The
+    Table API readers of reconcile-cmdb.py and the CMDB mirror come on top'''
+    posters = int(args.get('snow_workers') or 1)
+    if args.get('async_mode'):
+        posters = max(posters, int(args.get('snow_concurrency') or 1))
+    readers = int(args.get('reconcile_workers') or 0) + (1 if args.get('cmdb_mirror_url') else 0)
+    return posters * int(args.get('sqs_processors') or 1) + readers
+
+
+def get_snow_client(args):
+    '''Returns the process wide client for args['snow_hostname']'''
+    base_url = snow_base_url(args)
+    client = _clients.get(base_url)
+    if client is not None:
+        return client
+
+    with _clients_lock:
+        if base_url not in _clients:
+            logging.debug("Creating new SNOW client for %s" % base_url)
+            # Every thread that talks to SNOW at once needs its own connection
+            pool_maxsize = max(int(args.get('snow_pool_size') or DEFAULT_POOL_MAXSIZE), snow_concurrency(args))
+            _clients[base_url] = SnowClient(
+                args['snow_hostname'],
+                pool_maxsize=pool_maxsize,
+                rate_limit=args.get('snow_rate_limit'),
+                scheme=args.get('snow_scheme') or DEFAULT_SCHEME,
+            )
+        return _clients[base_url]
+
+
+def snow_unavailable(args):
+    '''Whether the circuit breaker of the SNOW instance in args is open.
+    False if this process didn't talk to it yet'''
+    client = _clients.get(snow_base_url(args)) if args.get('snow_hostname') else None
+    return client is not None and client.circuit_breaker.is_open()
+
+
+def log_pool_stats():
+    '''Logs the connection reuse of every SNOW client in this process'''
+    for base_url, client in list(_clients.items()):
+        logging.info("SNOW connection pool %s: %s" % (base_url, client.stats()))
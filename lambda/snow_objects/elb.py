@@ -2,73 +2,52 @@
 # Takes the AWS Config message and processes it
 # Contains also the function to map the AWS Config processed object to a SNOW object
 from .generic import SnowAwsGenericObject
-from datetime import datetime
-import pprint
+from .mapping import attributes, constant, field, has_configuration, joined, resource_type_is, when
 
 
 class SnowElbObject(SnowAwsGenericObject):
     '''Inherits attributes from SnowAwsGenericObject, and adds ELB-specific attributes.'''
 
-    def __init__(self, message):
-        super().__init__(message)
-
-        self.u_elb_scheme = None  # Elb scheme: public or private
-        self.u_elb_type = None
-        self.u_subnet_ids = None
-        self.u_vpc_id = None
-        self.u_cross_zone_enabled = None
-        self.u_deletion_protection = None
-        self.u_public_elb = None
-        self.u_private_elb = None
-        self.u_arn = None
-        self.u_state = None
-
-        self._set_values(message)
+    __slots__ = (
+        'u_elb_scheme',  # Elb scheme: public or private
+        'u_elb_type',
+        'u_subnet_ids',
+        'u_vpc_id',
+        'u_cross_zone_enabled',
+        'u_deletion_protection',
+        'u_public_elb',
+        'u_private_elb',
+        'u_arn',
+        'u_state',
+    )
+
+    MAPPING = [
+        field(('asset_tag', 'u_arn'), 'ARN'),
+        field('name', 'resourceName'),
+        when(
+            has_configuration,
+            field('u_elb_scheme', 'configuration.scheme'),
+            when(
+                resource_type_is('AWS::ElasticLoadBalancing::LoadBalancer'),
+                field('u_vpc_id', 'configuration.vpcid'),
+                constant('u_elb_type', 'classic'),
+                field('u_availability_zone', 'configuration.availabilityZones', joined()),
+                field('u_subnet_ids', 'configuration.subnets', joined()),
+            ),
+            when(
+                resource_type_is('AWS::ElasticLoadBalancingV2::LoadBalancer'),
+                field('state', 'configuration.state.code'),
+                field('u_vpc_id', 'configuration.vpcId'),
+                field('u_elb_type', 'configuration.type'),
+                field('u_availability_zone', 'configuration.availabilityZones', joined('zoneName')),
+                field('u_subnet_ids', 'configuration.availabilityZones', joined('subnetId')),
+                attributes('supplementaryConfiguration.LoadBalancerAttributes', {
+                    'load_balancing.cross_zone.enabled': 'u_cross_zone_enabled',
+                    'deletion_protection.enabled': 'u_deletion_protection',
+                }),
+            ),
+        ),
+    ]
 
     def _get_snow_table(self):
         return 'u_imp_cmdb_ci_aws_elastic_load_balancer'
-
-    def _set_values(self, message):
-        '''Set the values'''
-        super()._set_values(message)
-
-        conf_item = message['configurationItem']
-
-        self.asset_tag = conf_item['ARN']
-        self.u_arn = conf_item['ARN']
-        self.name = conf_item['resourceName']
-
-        # This is set to none if change notification type is DELETE
-        if conf_item['configuration'] is not None:
-            elb_conf = message['configurationItem']['configuration']
-
-            self.u_elb_scheme = elb_conf['scheme']
-
-            if conf_item['resourceType'] == 'AWS::ElasticLoadBalancing::LoadBalancer':
-                self.u_vpc_id = elb_conf['vpcid']
-                self.u_elb_type = 'classic'
-                self.u_availability_zone = ",".join(elb_conf['availabilityZones'])
-                self.u_subnet_ids = ",".join(elb_conf['subnets'])
-            elif conf_item['resourceType'] == 'AWS::ElasticLoadBalancingV2::LoadBalancer':
-                self.state = elb_conf['state']['code']
-                self.u_vpc_id = elb_conf['vpcId']
-                self.u_elb_type = elb_conf['type']
-
-                azs = [az['zoneName'] for az in elb_conf['availabilityZones']]
-                self.u_availability_zone = ",".join(azs)
-
-                subnets = [az['subnetId'] for az in elb_conf['availabilityZones']]
-                self.u_subnet_ids = ",".join(subnets)
-
-                elb_attr = conf_item['supplementaryConfiguration']['LoadBalancerAttributes']
-                for attr in elb_attr:
-                    if attr['key'] == 'load_balancing.cross_zone.enabled':
-                        self.u_cross_zone_enabled = attr['value']
-                    elif attr['key'] == 'deletion_protection.enabled':
-                        self.u_deletion_protection = attr['value']
-
-    def __str__(self):
-        return str(vars(self))
-
-    def __repr__(self):
-        return pprint.pformat(vars(self))
@@ -0,0 +1,28 @@
+# Exceptions for everything that makes processing a message impossible
+# They fail a single SQS record, the other records of the batch go on
+class SnowIntegrationError(Exception):
+    '''Base class of all errors of the AWS Config to SNOW integration'''
+
+
+class InvalidMessageError(SnowIntegrationError):
+    '''The AWS Config message doesn't look like we expect it'''
+
+
+class S3DownloadError(SnowIntegrationError):
+    '''A file AWS Config delivered to S3 couldn't be retrieved'''
+
+
+class SnowSubmissionError(SnowIntegrationError):
+    '''SNOW didn't accept the data'''
+
+
+class FanoutError(SnowIntegrationError):
+    '''Snapshot chunks couldn't be sent back to SQS'''
+
+
+class SnowUnavailableError(SnowSubmissionError):
+    '''SNOW is degraded, the circuit breaker doesn't let requests through'''
+
+
+class SnowQueryError(SnowIntegrationError):
+    '''SNOW didn't answer a Table API query'''
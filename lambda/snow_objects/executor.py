@@ -0,0 +1,62 @@
+# Bounded thread pool for work that mostly waits on SNOW
+# Collects the outcome of every task so the caller can decide per record what
+# failed, instead of the first failure killing the whole run
+import collections
+import concurrent.futures
+import logging
+import threading
+
+DEFAULT_WORKERS = 4
+
+# Outcome of a single task. tag is whatever the caller handed in to find the
+# origin of the task again, e.g. the SQS message id
+SubmissionOutcome = collections.namedtuple('SubmissionOutcome', ['tag', 'ok', 'result', 'error'])
+
+
+def _run(tag, fn, fn_args):
+    try:
+        return SubmissionOutcome(tag, True, fn(*fn_args), None)
+    except Exception as e:
+        logging.debug("Task %s failed: %r" % (tag, e))
+        return SubmissionOutcome(tag, False, None, e)
+
+
+class SnowSubmissionExecutor():
+    '''Runs tasks on up to workers threads. With a single worker tasks run
+    inline on the calling thread'''
+    def __init__(self, workers=DEFAULT_WORKERS):
+        self.workers = max(1, int(workers or 1))
+        self._pool = None
+        if self.workers > 1:
+            self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+        # Backpressure: producers block once this many tasks are queued up
+        self._slots = threading.BoundedSemaphore(self.workers * 2)
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def submit(self, tag, fn, *fn_args):
+        '''Schedules fn(*fn_args), blocks while too many tasks are queued'''
+        if self._pool is None:
+            outcome = _run(tag, fn, fn_args)
+            with self._lock:
+                self._pending.append(outcome)
+            return
+
+        self._slots.acquire()
+        future = self._pool.submit(_run, tag, fn, fn_args)
+        future.add_done_callback(lambda f: self._slots.release())
+        with self._lock:
+            self._pending.append(future)
+
+    def wait(self):
+        '''Waits for all scheduled tasks, returns their outcomes in the order
+        they were submitted'''
+        with self._lock:
+            pending = self._pending
+            self._pending = []
+
+        return [item.result() if isinstance(item, concurrent.futures.Future) else item for item in pending]
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
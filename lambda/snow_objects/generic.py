@@ -1,155 +1,208 @@
 # Generic data object with values that every AWS resource should define
 # Contains also the function to map the AWS Config message to a SNOW object
+import operator
 import pprint
-import requests
-import sys
 import logging
-import json
-from datetime import datetime
+
+from aws_pipeline.metrics import metrics
+from . import jsonlib
+from .client import get_snow_client, snow_base_url
+from .errors import InvalidMessageError, SnowSubmissionError
+from .mapping import by_change_type, compile_mapping, field, snow_time, tags, value
 
 
 class SnowAwsGenericObject():
-    '''Generic object for SNOW with values that every other AWS object should have'''
+    '''Generic object for SNOW with values that every other AWS object should have.
+    Every subclass declares its SNOW fields in __slots__, the FIELDS schema
+    of the class is the SNOW fields of the class and all its parents'''
+    # Object related settings that should be used by every object
+    __slots__ = (
+        'install_date',
+        'asset_tag',
+        'name',
+        'cost_center',
+        'state',
+        'u_region',
+        'u_account_id',
+        'u_used_for',
+        'used_for',
+        'u_client',
+        'u_service_tag',
+        'u_availability_zone',
+        'u_group',
+        'u_backup_group',
+        'u_pod',
+        'u_poc',
+        'u_classification',
+        'u_additional_tags',
+        'u_expiration',
+        'u_last_change_update',
+        'u_last_change_snapshot',
+        'u_last_change_delete',
+        'u_last_change_create',
+        # Internal, not sent to SNOW
+        'change_type',
+    )
+    # Slots that are not sent to SNOW
+    INTERNAL_FIELDS = ('change_type',)
+
+    # Standard values we expect all the resource types to need to use.
+    # Resource-specific attributes will be listed in that particular resource type
+    MAPPING = [
+        tags({
+            'COSTCENTER': 'cost_center',
+            'NAME': 'name',
+            'ENVIRONMENT': ('u_used_for', 'used_for'),
+            'SERVICE': 'u_service_tag',
+            'BACKUPGROUP': 'u_backup_group',
+            'GROUP': 'u_group',
+            'EXPIRATION': 'u_expiration',
+            'CLIENT': 'u_client',
+            'POD': 'u_pod',
+            'POC': 'u_poc',
+            'CLASSIFICATION': 'u_classification',
+        }, 'u_additional_tags'),
+        field('u_account_id', 'awsAccountId'),
+        value('u_region', lambda obj, item: item['awsRegion'] or None),
+        # Set all the time fields...
+        by_change_type({
+            'snapshot': 'u_last_change_snapshot',
+            'UPDATE': 'u_last_change_update',
+            'DELETE': 'u_last_change_delete',
+            'CREATE': 'u_last_change_create',
+        }, 'configurationItemCaptureTime', snow_time),
+        # resourceCreationTime doesn't exist in AWS::SSM::ManagedInstanceInventory
+        field('install_date', 'resourceCreationTime', snow_time, optional=True),
+    ]
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        _compile_schema(cls)
+
     def __init__(self, message):
-        # Object related settings that should be used by every object
-        self.install_date = None
-        self.asset_tag = None
-        self.name = None
-        self.cost_center = None
-        self.state = None
-        self.u_region = None
-        self.u_account_id = None
-        self.u_used_for = None
-        self.u_service_tag = None
-        self.u_availability_zone = None
-        self.u_group = None
-        self.u_backup_group = None
-        self.u_pod = None
-        self.u_poc = None
-        self.u_classification = None
-        self.u_additional_tags = None
-        self.u_expiration = None
-        self.u_last_change_update = None
-        self.u_last_change_snapshot = None
-        self.u_last_change_delete = None
-        self.u_last_change_create = None
+        for field in self._ALL_SLOTS:
+            setattr(self, field, None)
 
         self._set_values(message)
 
+    def snow_data(self):
+        '''Returns the SNOW fields that have a value'''
+        return {field: value for field, value in zip(self.FIELDS, self._get_fields(self)) if value is not None}
+
+    def state_data(self):
+        '''Returns what the state store compares to find out if the object
+        changed since its last submission'''
+        return self.snow_data()
+
     def _set_values(self, message):
-        '''Standard values we expect all the resource types to need to use.  Resource-specific attributes will be listed in that particular resource type.'''
+        '''Checks the message and applies the MAPPING of the class and its
+        parents to the configurationItem'''
         if 'configurationItem' not in message:
             logging.fatal("if 'configurationItem' not in message: in generic.py")
             pprint.pprint(message)
-            sys.exit(1)
-        tags = message['configurationItem']['tags']
-        if tags is not None:
-            v_additional_tags = ''
-            for tag in tags:
-                # Two tag options, one via key & value naming, one without
-                key = None
-                value = None
-                if 'key' in tag:
-                    key = tag['key'].upper()
-                    value = tag['value']
-                else:
-                    key = tag.upper()
-                    value = tags[tag]
-
-                if key == 'COSTCENTER':
-                    self.cost_center = value
-                elif key == 'NAME':
-                    self.name = value
-                elif key == 'ENVIRONMENT':
-                    self.u_used_for = value
-                    self.used_for = value
-                elif key == 'SERVICE':
-                    self.u_service_tag = value
-                elif key == 'BACKUPGROUP':
-                    self.u_backup_group = value
-                elif key == 'GROUP':
-                    self.u_group = value
-                elif key == 'EXPIRATION':
-                    self.u_expiration = value
-                elif key == 'CLIENT':
-                    self.u_client = value
-                elif key == 'POD':
-                    self.u_pod = value
-                elif key == 'POC':
-                    self.u_poc = value
-                elif key == 'CLASSIFICATION':
-                    self.u_classification = value
-                else:
-                    v_additional_tags += key + '=' + value + '; '
-            if v_additional_tags:
-                self.u_additional_tags = v_additional_tags.rstrip('; ')
-        self.u_account_id = message['configurationItem']['awsAccountId']
-        if 'configurationItemDiff' in message:
-            self.change_type = message['configurationItemDiff']['changeType']
-        else:
-            self.change_type = 'snapshot'
+            raise InvalidMessageError("configurationItem not in message")
+        conf_item = message['configurationItem']
+
         # There are some cases where there might not be a region. Like IAM...
         # didn't face it yet, but lets have it implemented
         # TODO: remove
-        if 'awsRegion' not in message['configurationItem']:
+        if 'awsRegion' not in conf_item:
             pprint.pprint(message)
             print("awsRegion not in message in generic.py")
-            sys.exit(1)
-        if message['configurationItem']['awsRegion']:
-            self.u_region = message['configurationItem']['awsRegion']
+            raise InvalidMessageError("awsRegion not in configurationItem")
 
-        # Set all the time fields...
-        capture_time = datetime.strptime(message['configurationItem']['configurationItemCaptureTime'], '%Y-%m-%dT%H:%M:%S.%fZ').strftime('%Y-%m-%d %H:%M:%S')
-        if self.change_type == 'snapshot':
-            self.u_last_change_snapshot = capture_time
-        elif self.change_type == 'UPDATE':
-            self.u_last_change_update = capture_time
-        elif self.change_type == 'DELETE':
-            self.u_last_change_delete = capture_time
-        elif self.change_type == 'CREATE':
-            self.u_last_change_create = capture_time
+        if 'configurationItemDiff' in message:
+            self.change_type = message['configurationItemDiff']['changeType']
+        else:
+            self.change_type = 'snapshot'
 
-        # resourceCreationTime doesn't exist in AWS::SSM::ManagedInstanceInventory
-        if 'resourceCreationTime' in message['configurationItem'] and message['configurationItem']['resourceCreationTime'] is not None:
-            self.install_date = datetime.strptime(message['configurationItem']['resourceCreationTime'], '%Y-%m-%dT%H:%M:%S.%fZ').strftime('%Y-%m-%d %H:%M:%S')
+        self._apply_mapping(self, conf_item)
 
     def submit_data_to_snow(self, data, args):
         '''Sends the object to SNOW'''
-        headers = {"Content-Type": "application/json", "Accept": "application/json"}
-
-        # Args only here to not accidently expose the credentials and to have
-        # a much easyer and simple vars(self)
-        snow_user = args['snow_user']
-        snow_password = args['snow_password']
-        snow_url = "https://{}/api/now/import/{}".format(args['snow_hostname'], self._get_snow_table())
+        # Args only here to not accidently expose the credentials and to keep
+        # them out of the object
+        snow_path = "/api/now/import/{}".format(self._get_snow_table())
+        snow_url = "{}{}".format(snow_base_url(args), snow_path)
 
         try:
             logging.debug("Submitting data to SNOW")
-            response = requests.post(snow_url, auth=(snow_user, snow_password), headers=headers, data=json.dumps(data))
+            with metrics.timer('SnowSubmitTime', table=self._get_snow_table()):
+                response = get_snow_client(args).post(snow_path, args, jsonlib.dumps(data))
         except Exception as e:
-            logging.fatal("Used requests.post(%s, ....)" % snow_url)
+            logging.fatal("Used session.post(%s, ....)" % snow_url)
             logging.fatal("Failed to submit data to SNOW. %s" % e)
             logging.fatal("Data submitted:")
             pprint.pprint(data)
-            sys.exit(1)
+            raise SnowSubmissionError("Failed to submit data to SNOW: %s" % e)
 
         if response.status_code != 201:
-            logging.fatal("Used requests.post(%s, ....)" % snow_url)
+            logging.fatal("Used session.post(%s, ....)" % snow_url)
             logging.fatal("Failed to submit data to SNOW. Response status code isn't 201.")
             logging.fatal("Status Code: %s, Response Headers: %s, Error Response: %s" % (response.status_code, response.headers, response.text))
             logging.fatal("User authentication errors could also mean 'permission denied'. SNOW is kinda buggy here")
-            sys.exit(1)
+            raise SnowSubmissionError("SNOW responded with status code %s" % response.status_code)
 
     def add_to_snow(self, args):
         '''Add data to snow.
         We have two functions because SSM Inventory overwrites this block and
         we don't want to duplicate the function'''
 
-        data = vars(self)
+        data = self.snow_data()
+
+        # Batched submission if the caller set up a submitter for this run
+        submitter = args.get('snow_submitter')
+        if submitter is not None:
+            submitter.add(self._get_snow_table(), data, args.get('message_id'))
+            return
+
         self.submit_data_to_snow(data, args)
 
+    def _all_values(self):
+        return dict([(field, getattr(self, field)) for field in self._ALL_SLOTS])
+
     def __str__(self):
-        return str(vars(self))
+        return str(self._all_values())
 
     def __repr__(self):
-        return pprint.pformat(vars(self))
+        return pprint.pformat(self._all_values())
+
+
+def _compile_schema(cls):
+    '''Collects the slots of cls and its parents into cls._ALL_SLOTS and the
+    SNOW fields into cls.FIELDS. cls._get_fields reads all of them with one
+    call, which is what makes snow_data() cheap. The MAPPING rules of cls and
+    its parents are compiled into cls._apply_mapping'''
+    all_slots = []
+    internal = set()
+    rules = []
+    for klass in reversed(cls.__mro__):
+        all_slots.extend(klass.__dict__.get('__slots__', ()))
+        internal.update(klass.__dict__.get('INTERNAL_FIELDS', ()))
+        rules.extend(klass.__dict__.get('MAPPING', ()))
+
+    mapping = compile_mapping(rules)
+    unknown = [name for name in mapping.fields if name not in all_slots]
+    if unknown:
+        raise TypeError("MAPPING of %s sets fields without a slot: %s" % (cls.__name__, ", ".join(unknown)))
+    cls._apply_mapping = staticmethod(mapping.apply)
+
+    cls._ALL_SLOTS = tuple(all_slots)
+    cls.FIELDS = tuple([field for field in all_slots if field not in internal])
+    getter = operator.attrgetter(*cls.FIELDS)
+    # attrgetter with a single name doesn't return a tuple
+    cls._get_fields = staticmethod(getter if len(cls.FIELDS) > 1 else lambda obj: (getter(obj),))
+
+
+_compile_schema(SnowAwsGenericObject)
+
+
+def snow_object_class(class_name, table, mapping):
+    '''Returns a SnowAwsGenericObject subclass for a resource type that needs
+    nothing but a MAPPING. The slots are the fields the mapping sets'''
+    fields = [name for name in compile_mapping(mapping).fields if name not in SnowAwsGenericObject._ALL_SLOTS]
+    return type(class_name, (SnowAwsGenericObject,), {
+        '__slots__': tuple(fields),
+        'MAPPING': list(mapping),
+        '_get_snow_table': lambda self: table,
+    })
@@ -0,0 +1,32 @@
+# Pluggable json backend
+# orjson decodes and encodes several times faster than the json module of the
+# standard library. It is used when it's installed, otherwise we fall back to
+# json. SNOW_JSON_BACKEND=json forces the standard library
+import json
+import os
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None and os.environ.get('SNOW_JSON_BACKEND', 'orjson') == 'orjson':
+    BACKEND = 'orjson'
+
+    def loads(data):
+        '''Decodes json from str or bytes'''
+        return orjson.loads(data)
+
+    def dumps(obj):
+        '''Encodes obj as UTF-8 json bytes'''
+        return orjson.dumps(obj)
+else:
+    BACKEND = 'json'
+
+    def loads(data):
+        '''Decodes json from str or bytes'''
+        return json.loads(data)
+
+    def dumps(obj):
+        '''Encodes obj as UTF-8 json bytes'''
+        return json.dumps(obj).encode('utf-8')
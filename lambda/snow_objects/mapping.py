@@ -0,0 +1,213 @@
+# Declarative mapping of AWS Config configuration items to SNOW fields
+# Every SNOW object class has a MAPPING, a list of rules applied in order.
+# Rules are built once when the class is defined: paths are split, tag maps
+# are turned into dicts and conditions grouped, so mapping an item is a
+# plain loop over small functions. A new resource type only needs a mapping
+#
+# Every function in a rule (conditions, values) gets the SNOW object and the
+# configurationItem. The object has its change_type set already
+import collections
+import functools
+import operator
+import re
+from datetime import datetime
+
+AWS_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+SNOW_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# fields is the tuple of SNOW fields the rule may set, apply(obj, item) sets them
+Rule = collections.namedtuple('Rule', ['fields', 'apply'])
+
+
+# What AWS Config timestamps look like, e.g. 2019-03-01T10:00:00.123Z
+_AWS_TIME_RE = re.compile(r'(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)\.\d{1,6}Z\Z')
+
+
+@functools.lru_cache(maxsize=65536)
+def snow_time(aws_time):
+    '''Returns an AWS Config timestamp in the SNOW format. Memoized, a
+    snapshot has lots of items created or captured at the same time'''
+    match = _AWS_TIME_RE.match(aws_time)
+    if match is not None:
+        try:
+            # Validates the date like strptime does, at a fraction of the cost
+            datetime(*[int(part) for part in match.groups()])
+            return "{} {}".format(aws_time[:10], aws_time[11:19])
+        except ValueError:
+            pass
+    return datetime.strptime(aws_time, AWS_TIME_FORMAT).strftime(SNOW_TIME_FORMAT)
+
+
+def joined(key=None):
+    '''Transform that joins a list with ",", optionally the key of every element'''
+    if key is None:
+        return ",".join
+
+    def join(values):
+        return ",".join([value[key] for value in values])
+    return join
+
+
+def compile_path(path):
+    '''Returns a function that looks up the dotted path in a dict'''
+    keys = tuple(path.split('.'))
+    if len(keys) == 1:
+        return operator.itemgetter(keys[0])
+
+    def get(item):
+        for key in keys:
+            item = item[key]
+        return item
+    return get
+
+
+def compile_optional_path(path):
+    '''Like compile_path, but returns None if a key along the path is missing'''
+    keys = tuple(path.split('.'))
+
+    def get(item):
+        for key in keys:
+            if item is None or key not in item:
+                return None
+            item = item[key]
+        return item
+    return get
+
+
+def field(names, path, transform=None, optional=False):
+    '''Sets the field(s) to the value at path in the configurationItem.
+    Optional fields are left untouched if the path is missing or None'''
+    if isinstance(names, str):
+        names = (names,)
+    names = tuple(names)
+
+    if optional:
+        get = compile_optional_path(path)
+    else:
+        get = compile_path(path)
+
+    def apply(obj, item):
+        value = get(item)
+        if value is None and optional:
+            return
+        if transform is not None:
+            value = transform(value)
+        for name in names:
+            setattr(obj, name, value)
+    return Rule(names, apply)
+
+
+def value(name, function):
+    '''Sets the field to function(obj, item), for everything a path can't express'''
+    def apply(obj, item):
+        setattr(obj, name, function(obj, item))
+    return Rule((name,), apply)
+
+
+def constant(name, constant_value):
+    '''Sets the field to a fixed value, usually combined with when()'''
+    def apply(obj, item):
+        setattr(obj, name, constant_value)
+    return Rule((name,), apply)
+
+
+def by_change_type(fields_by_change_type, path, transform=None):
+    '''Sets the field of the change type of the object to the value at path'''
+    get = compile_path(path)
+
+    def apply(obj, item):
+        name = fields_by_change_type.get(obj.change_type)
+        if name is None:
+            return
+        value = get(item)
+        if transform is not None:
+            value = transform(value)
+        setattr(obj, name, value)
+    return Rule(tuple(fields_by_change_type.values()), apply)
+
+
+def tags(tag_fields, other_field):
+    '''Maps the tags of the configurationItem by their upper cased key.
+    tag_fields maps a key to the field(s) it is stored in, the other tags are
+    joined to "KEY=value; KEY=value" in other_field'''
+    tag_fields = dict([(key, (names,) if isinstance(names, str) else tuple(names)) for key, names in tag_fields.items()])
+    names = tuple(sorted(set([name for names in tag_fields.values() for name in names]))) + (other_field,)
+
+    def apply(obj, item):
+        item_tags = item['tags']
+        if item_tags is None:
+            return
+
+        # Two tag options, one via key & value naming, one without
+        if isinstance(item_tags, dict):
+            pairs = item_tags.items()
+        else:
+            pairs = [(tag['key'], tag['value']) for tag in item_tags]
+
+        other = ''
+        for key, tag_value in pairs:
+            key = key.upper()
+            target = tag_fields.get(key)
+            if target is None:
+                other += key + '=' + tag_value + '; '
+                continue
+            for name in target:
+                setattr(obj, name, tag_value)
+
+        if other:
+            setattr(obj, other_field, other.rstrip('; '))
+    return Rule(names, apply)
+
+
+def attributes(path, attribute_fields):
+    '''Maps a list of {"key": ..., "value": ...} dicts at path, e.g. the
+    LoadBalancerAttributes, to fields. Unknown keys are ignored'''
+    get = compile_path(path)
+
+    def apply(obj, item):
+        for attribute in get(item):
+            name = attribute_fields.get(attribute['key'])
+            if name is not None:
+                setattr(obj, name, attribute['value'])
+    return Rule(tuple(attribute_fields.values()), apply)
+
+
+def when(condition, *rules):
+    '''Applies the rules only if condition(obj, item) is true'''
+    compiled = compile_mapping(rules)
+    apply_rules = compiled.apply
+
+    def apply(obj, item):
+        if condition(obj, item):
+            apply_rules(obj, item)
+    return Rule(compiled.fields, apply)
+
+
+def compile_mapping(rules):
+    '''Returns a single Rule that applies the rules in order'''
+    rules = tuple(rules)
+    fields = []
+    for rule in rules:
+        fields.extend([name for name in rule.fields if name not in fields])
+    steps = tuple([rule.apply for rule in rules])
+
+    def apply(obj, item):
+        for step in steps:
+            step(obj, item)
+    return Rule(tuple(fields), apply)
+
+
+# Conditions shared by the resource types
+def has_configuration(obj, item):
+    '''The configuration is None if change notification type is DELETE'''
+    return item['configuration'] is not None
+
+
+def is_delete(obj, item):
+    return obj.change_type == 'DELETE'
+
+
+def resource_type_is(resource_type):
+    def condition(obj, item):
+        return item['resourceType'] == resource_type
+    return condition
@@ -0,0 +1,65 @@
+# Registry of the AWS Config resource types we map to SNOW objects
+# The handler modules are only imported once their resource type shows up,
+# a lambda that only sees EC2 instances never loads the S3 or SSM code
+import collections
+import importlib
+import logging
+import threading
+
+from aws_pipeline.metrics import metrics
+
+# module and class_name of the SnowAwsGenericObject subclass, the SNOW import
+# set table and if the mapped objects are sent to SNOW already. table is None
+# where we don't have an import set table yet
+ResourceHandler = collections.namedtuple('ResourceHandler', ['module', 'class_name', 'table', 'submit'])
+
+HANDLERS = {
+    'AWS::EC2::Instance': ResourceHandler('snow_objects.ec2', 'SnowEc2Object', 'u_imp_cmdb_ci_ec2_instance', True),
+    'AWS::ElasticLoadBalancingV2::LoadBalancer': ResourceHandler('snow_objects.elb', 'SnowElbObject', 'u_imp_cmdb_ci_aws_elastic_load_balancer', False),
+    'AWS::ElasticLoadBalancing::LoadBalancer': ResourceHandler('snow_objects.elb', 'SnowElbObject', 'u_imp_cmdb_ci_aws_elastic_load_balancer', False),
+    'AWS::S3::Bucket': ResourceHandler('snow_objects.s3', 'SnowS3Object', None, False),
+    'AWS::SSM::ManagedInstanceInventory': ResourceHandler('snow_objects.ssm_inventory', 'SnowSSMInventoryObject', 'u_imp_aws_ec2_software_instance', True),
+    'AWS::RDS::DBInstance': ResourceHandler('snow_objects.rds', 'SnowRDSObject', 'u_imp_aws_rds_instance', False),
+}
+
+# List of resources we accept. We skip all other ones
+ACCEPT_RESOURCES = sorted(HANDLERS)
+
+_classes = {}
+_classes_lock = threading.Lock()
+
+
+def get_handler(resource_type):
+    '''Returns the ResourceHandler of resource_type, None if we skip it'''
+    return HANDLERS.get(resource_type)
+
+
+def get_handler_class(resource_type):
+    '''Returns the SNOW object class of resource_type, importing its module
+    on first use'''
+    handler = HANDLERS[resource_type]
+    cls = _classes.get(handler)
+    if cls is not None:
+        return cls
+
+    with _classes_lock:
+        if handler not in _classes:
+            module = importlib.import_module(handler.module)
+            _classes[handler] = getattr(module, handler.class_name)
+        return _classes[handler]
+
+
+def map_configuration_item(message):
+    '''Maps the configurationItem of message to its SNOW object. Returns the
+    ResourceHandler and the object, (None, None) for resource types we skip'''
+    resource_type = message['configurationItem']['resourceType']
+
+    # Resources to skip right away
+    handler = get_handler(resource_type)
+    if handler is None:
+        logging.debug("Skipping %s" % resource_type)
+        metrics.count('SkippedConfigurationItems')
+        return None, None
+
+    with metrics.timer('MappingTime', resourceType=resource_type):
+        return handler, get_handler_class(resource_type)(message)
@@ -0,0 +1,158 @@
+# Retries and circuit breaking of SNOW requests
+# Connection errors, timeouts and 408/429/502/503/504 may succeed later, they
+# are retried with exponential backoff and full jitter, so the threads and
+# lambdas that failed together don't retry together. Everything else is
+# final: the row fails and the message goes back to SQS. No retry is started
+# that wouldn't finish before the lambda runs out of time. Other exceptions,
+# e.g. of the credential refresh, aren't SNOW failing, they propagate right
+# away and leave the circuit breaker as it is.
+#
+# One circuit breaker per SNOW instance counts the requests of every thread
+# and task that failed even after their retries. After
+# DEFAULT_FAILURE_THRESHOLD of them in a row SNOW is considered degraded and
+# requests fail right away for DEFAULT_OPEN_SECONDS, the messages go back to
+# SQS instead of holding lambda concurrency. Then a single trial request,
+# without retries, decides if it closes again.
+import logging
+import random
+import threading
+import time
+
+from aws_pipeline.metrics import metrics
+from .errors import SnowUnavailableError
+from .throttle import parse_retry_after
+
+# SNOW answers with these when it is overloaded or throttles the API user
+THROTTLE_STATUS_CODES = [429, 503]
+RETRYABLE_STATUS_CODES = [408, 429, 502, 503, 504]
+
+# Attempts per request, including the first one
+DEFAULT_MAX_ATTEMPTS = 4
+# Backoff before retry n is random between 0 and BASE_DELAY * 2^n seconds,
+# capped at MAX_DELAY
+BASE_DELAY = 0.5
+MAX_DELAY = 20
+# Seconds the lambda must have left after the backoff: for the request itself
+# and for handing the results back to SQS
+MIN_REMAINING_SECONDS = 10
+
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_OPEN_SECONDS = 30
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+def is_retryable(response=None, error=None):
+    '''Whether a failed attempt may succeed later. error is only passed for
+    the transport errors of the HTTP client, connection errors and timeouts'''
+    if error is not None:
+        return True
+    return response.status_code in RETRYABLE_STATUS_CODES
+
+
+class RetryPolicy():
+    '''Backoff of a single request. deadline is the time.monotonic() by which
+    the caller has to be done, e.g. the end of the lambda invocation'''
+    def __init__(self, max_attempts=DEFAULT_MAX_ATTEMPTS, base_delay=BASE_DELAY, max_delay=MAX_DELAY, deadline=None):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+
+    def delay(self, attempt, retry_after=0):
+        '''Returns the seconds to wait after the failed attempt (0 based),
+        None to give up'''
+        if attempt + 1 >= self.max_attempts:
+            return None
+
+        delay = max(random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt)), retry_after)
+        if self.deadline is not None and time.monotonic() + delay + MIN_REMAINING_SECONDS > self.deadline:
+            logging.warning("Not retrying, the lambda would run out of time")
+            return None
+        return delay
+
+
+class CircuitBreaker():
+    '''Shared by every thread and task that talks to one SNOW instance'''
+    def __init__(self, failure_threshold=DEFAULT_FAILURE_THRESHOLD, open_seconds=DEFAULT_OPEN_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.state = CLOSED
+        self._failures = 0
+        self._opened_at = 0
+        self._lock = threading.Lock()
+
+    def is_open(self):
+        '''Whether requests fail right away at the moment'''
+        with self._lock:
+            return self.state == OPEN and time.monotonic() < self._opened_at + self.open_seconds
+
+    def check(self):
+        '''Raises SnowUnavailableError unless a request may be sent'''
+        with self._lock:
+            if self.state == CLOSED:
+                return
+            if self.state == OPEN and time.monotonic() >= self._opened_at + self.open_seconds:
+                # This request is the trial, the others keep failing until it
+                # is done
+                logging.info("Sending a trial request to SNOW after %.0f seconds" % self.open_seconds)
+                self.state = HALF_OPEN
+                return
+        metrics.count('SnowCircuitRejected')
+        raise SnowUnavailableError("SNOW is degraded, not sending requests for up to %s seconds" % self.open_seconds)
+
+    def success(self):
+        with self._lock:
+            if self.state != CLOSED:
+                logging.warning("SNOW answers again, closing the circuit breaker")
+            self.state = CLOSED
+            self._failures = 0
+
+    def is_trial(self):
+        with self._lock:
+            return self.state == HALF_OPEN
+
+    def abort_trial(self):
+        '''Hands the trial back after a request that failed before SNOW
+        answered, e.g. in the credential refresh. The next request is the
+        trial then'''
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self.state = OPEN
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and self._failures >= self.failure_threshold):
+                logging.error("SNOW failed %s requests in a row, failing requests for %s seconds" % (self._failures, self.open_seconds))
+                metrics.count('SnowCircuitOpened')
+                self.state = OPEN
+                self._opened_at = time.monotonic()
+
+
+def retry_delay(policy, breaker, rate_limiter, attempt, response=None, error=None):
+    '''Records the outcome of an attempt. Returns the seconds to wait before
+    the next attempt, None if the outcome is final'''
+    if not is_retryable(response, error):
+        # SNOW answered, even a 400 means it is up
+        breaker.success()
+        return None
+
+    retry_after = 0
+    if response is not None and response.status_code in THROTTLE_STATUS_CODES:
+        # Slow down every thread, not only this one
+        metrics.count('SnowThrottled')
+        retry_after = parse_retry_after(response.headers.get('Retry-After'))
+        rate_limiter.pause(retry_after)
+
+    delay = policy.delay(attempt, retry_after) if not breaker.is_trial() else None
+    if delay is None:
+        breaker.failure()
+        return None
+
+    outcome = str(response.status_code) if response is not None else type(error).__name__
+    logging.warning("SNOW request failed with %s, retrying in %.1f seconds" % (outcome, delay))
+    metrics.count('SnowRetries', outcome=outcome)
+    return delay
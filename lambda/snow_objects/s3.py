@@ -2,49 +2,49 @@
 # Takes the AWS Config message and processes it
 # Contains also the function to map the AWS Config processed object to a SNOW object
 from .generic import SnowAwsGenericObject
-import json
+from .mapping import field, has_configuration, value, when
+from . import jsonlib
 
 
 class SnowS3Object(SnowAwsGenericObject):
     '''Inherits attributes from SnowAwsGenericObject, and adds S3-specific attributes.'''
 
-    def __init__(self, message):
-        super().__init__(message)
-
-        self.u_bucket_versioning = None
-        self.u_bucket_logging_destination_bucket = None
-        self.u_bucket_acl_allusers = None
-        self.u_bucket_lifecycle = None
-
-        self._set_values(message)
+    __slots__ = (
+        'u_arn',
+        'u_bucket_name',
+        'u_bucket_versioning',
+        'u_bucket_logging_destination_bucket',
+        'u_bucket_acl_allusers',
+        'u_bucket_lifecycle',
+    )
+
+    MAPPING = [
+        field(('asset_tag', 'u_arn'), 'ARN'),
+        field(('name', 'u_bucket_name'), 'resourceName'),
+        when(
+            has_configuration,
+            field('u_bucket_versioning', 'supplementaryConfiguration.BucketVersioningConfiguration.status'),
+            field('u_bucket_logging_destination_bucket', 'supplementaryConfiguration.BucketLoggingConfiguration.destinationBucketName', optional=True),
+            value('u_bucket_acl_allusers', lambda obj, item: _acl_all_users(item['supplementaryConfiguration']['AccessControlList'])),
+            value('u_bucket_lifecycle', lambda obj, item: _has_lifecycle(item['supplementaryConfiguration'])),
+        ),
+    ]
 
     def _get_snow_table(self):
         # TODO
         return 'TODO'
 
-    def _set_values(self, message):
-        '''Set the values'''
-        super()._set_values(message)
-
-        conf_item = message['configurationItem']
-
-        self.asset_tag = conf_item['ARN']
-        self.u_arn = conf_item['ARN']
-        self.name = conf_item['resourceName']
-        self.u_bucket_name = conf_item['resourceName']
 
-        # This is set to none if change notification type is DELETE
-        if conf_item['configuration'] is not None:
-            s3_conf = conf_item['supplementaryConfiguration']
-            self.u_bucket_versioning = s3_conf['BucketVersioningConfiguration']['status']
-            if len(s3_conf['BucketLoggingConfiguration']) > 0:
-                self.u_bucket_logging_destination_bucket = s3_conf['BucketLoggingConfiguration']['destinationBucketName']
+def _acl_all_users(access_control_list):
+    '''Returns the permission of AllUsers in the bucket ACL, None if it has none'''
+    permission = None
+    for grant in jsonlib.loads(access_control_list)['grantList']:
+        if grant['grantee'] == 'AllUsers':
+            permission = grant['permission']
+    return permission
 
-            acl = json.loads(s3_conf['AccessControlList'])
-            for grant in acl['grantList']:
-                if grant['grantee'] == 'AllUsers':
-                    self.u_bucket_acl_allusers = grant['permission']
 
-            if 'BucketLifecycleConfiguration' in s3_conf:
-                if len(s3_conf['BucketLifecycleConfiguration']['rules']) > 0:
-                    self.u_bucket_lifecycle = True
+def _has_lifecycle(s3_conf):
+    if 'BucketLifecycleConfiguration' in s3_conf and len(s3_conf['BucketLifecycleConfiguration']['rules']) > 0:
+        return True
+    return None
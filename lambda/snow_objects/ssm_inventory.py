@@ -2,38 +2,45 @@
 # Takes the AWS Config message and processes it
 # Contains also the function to map the AWS Config processed object to a SNOW object
 from .generic import SnowAwsGenericObject
+from .batch import SnowBatchSubmitter
+from .errors import InvalidMessageError, SnowSubmissionError
+from .mapping import field
 import pprint
 import logging
-import sys
-import copy
+
+# State store key of the package index of an instance. Not a resource key,
+# so it can't clash with the state of the inventory resource itself
+PACKAGE_INDEX_KEY = "packages/{account}/{region}/{instance}"
 
 
 class SnowSSMInventoryObject(SnowAwsGenericObject):
     '''Inherits attributes from SnowAwsGenericObject, and adds SSM-specific attributes.'''
-    def __init__(self, message):
-        super().__init__(message)
-
-        self.package_changes = None
-        self.all_packages = None
-        self.u_version = None
-        self.u_package = None
-        self.id_type = None
-
-        self._set_values(message)
+    __slots__ = (
+        'u_version',
+        'u_package',
+        'id_type',
+        # Internal, the packages are sent as rows of their own
+        'package_changes',
+        'all_packages',
+    )
+    INTERNAL_FIELDS = ('package_changes', 'all_packages')
+    MAPPING = [
+        field(('asset_tag', 'id_type'), 'resourceId'),
+    ]
 
     def _get_snow_table(self):
         return 'u_imp_aws_ec2_software_instance'
 
     def _set_values(self, message):
-        '''Set the values'''
+        '''Set the values, collects the packages on top of the MAPPING'''
         super()._set_values(message)
 
         conf_item = message['configurationItem']
 
-        self.asset_tag = conf_item['resourceId']
-        self.id_type = conf_item['resourceId']
         self.package_changes = []
-        self.all_packages = []
+        # None if the message has no package inventory at all, e.g. a new
+        # instance. An empty list is an instance without packages
+        self.all_packages = None
 
         # This is set to none if change notification type is DELETE. But let's
         # make sure we catch here every case... SSM Inventory seems to be
@@ -45,11 +52,11 @@ class SnowSSMInventoryObject(SnowAwsGenericObject):
             if 'configurationItemDiff' not in message:
                 pprint.pprint(message)
                 logging.fatal("Something is wrong. configuration not in conf_item & also no configurationItemDiff")
-                sys.exit(1)
+                raise InvalidMessageError("configuration not in configurationItem & also no configurationItemDiff")
             if message['configurationItemDiff']['changeType'] != 'DELETE':
                 pprint.pprint(message)
                 logging.fatal("Something is wrong. configuration not in conf_item & changeType != DELETE")
-                sys.exit(1)
+                raise InvalidMessageError("configuration not in configurationItem & changeType != DELETE")
 
         # This seems to be only hit if its a new instance.... they don't have
         # all the details, like no ssm_inventory_conf['AWS:Application']
@@ -68,6 +75,7 @@ class SnowSSMInventoryObject(SnowAwsGenericObject):
             # get this information in more verbose form from the EC2 snapshot & change
             # update
             packages = ssm_inventory_conf['AWS:Application']['Content']
+            self.all_packages = []
             for package_name in packages:
                 # Package name can contain multiple version. This is rare but
                 # possible, e.g. with the kernel package
@@ -94,7 +102,7 @@ class SnowSSMInventoryObject(SnowAwsGenericObject):
                 if change_type not in ['CREATE', 'DELETE', 'UPDATE']:
                     logging.fatal("Unknown SSM Inventory change type %s for %s" % (change_type, changed_property))
                     pprint.pprint(changes_raw[changed_property])
-                    sys.exit(1)
+                    raise InvalidMessageError("Unknown SSM Inventory change type %s" % change_type)
 
                 if change_type == 'UPDATE':
                     # The update is a little bit effed up. You can end up with various # changes that are unimportant, like install time or PackageId
@@ -107,53 +115,130 @@ class SnowSSMInventoryObject(SnowAwsGenericObject):
 
                 self.package_changes.append(changes_raw[changed_property])
 
+    def package_index(self):
+        '''Returns the packages of the inventory as name -> sorted versions,
+        None if the message has no package inventory'''
+        if self.all_packages is None:
+            return None
+
+        index = {}
+        for package in self.all_packages:
+            index.setdefault(package['Name'], []).append(package_version(package))
+        for versions in index.values():
+            versions.sort()
+        return index
+
+    def state_data(self):
+        '''The packages are part of the state, a changed package has to make
+        it past the state store'''
+        data = self.snow_data()
+        data['packages'] = self.package_index()
+        return data
+
     def add_to_snow(self, args):
-        '''Add data to snow.'''
-
-        # Get the core structure without the data we need to itterate through
-        data = copy.deepcopy(vars(self))
-        del data['package_changes']
-        del data['all_packages']
-
-        # Two cases:
-        # 1. snapshots & create: we submit all packages we found, in case we missed something
-        # 2. updates: we only submit the changes, even though we have the full
-        #    list. This saves a lot of resources
-        # 3. We ignore DELETES since the entire instance gets marked as terminated
-        #    DELETES here is not the changes of the package itself which has its own change_type
-        if data['change_type'] in ['snapshot', 'CREATE']:
-            for package in self.all_packages:
-                data['u_package'] = package['Name']
-
-                if 'Release' in package:
-                    data['u_version'] = "{}-{}".format(package['Version'], package['Release'])
-                else:
-                    data['u_version'] = package['Version']
-
-                #self.snow_submission(self, data, args)
-
-        elif data['change_type'] == 'UPDATE':
-            for package_change in self.package_changes:
-                if package_change['changeType'] == 'CREATE':
-                    package = package_change['updatedValue']
-                    data['change_type'] == package_change['changeType']
-                elif package_change['changeType'] == 'DELETE':
-                    package = package_change['previousValue']
-                    data['change_type'] == package_change['changeType']
-                else:
-                    print("TODO: not implemented/seen change %s yet" % package_change['changeType'])
-                    pprint.pprint(package_change)
-                    print("EXITING SCRIPT")
-                    sys.exit(1)
-
-                data['u_package'] = package['Name']
-                if package_change['changeType'] == 'DELETE':
-                    # Deleted packages are highlighted and processed with a prepended "-"
-                    data['u_package'] = "-{}".format(data['u_package'])
-
-                if 'Release' in package:
-                    data['u_version'] = "{}-{}".format(package['Version'], package['Release'])
-                else:
-                    data['u_version'] = package['Version']
-
-                #self.snow_submission(self, data, args)
+        '''Add data to snow.
+        Every package is a row of its own in the SNOW table. With a state store
+        we keep the package index of every instance and only submit what
+        changed since the last submission, otherwise we fall back to what the
+        message tells us'''
+        # We ignore DELETES since the entire instance gets marked as
+        # terminated. DELETES here is not the changes of the package itself
+        # which has its own change_type
+        if self.change_type == 'DELETE':
+            return
+
+        packages = self.package_index()
+        state_store = args.get('state_store')
+        if state_store is not None and packages is not None:
+            key = PACKAGE_INDEX_KEY.format(account=self.u_account_id, region=self.u_region, instance=self.asset_tag)
+            stored = state_store.get(key)
+            if stored is None:
+                rows = index_rows(packages)
+            else:
+                rows = diff_package_indexes(stored['packages'], packages)
+            # Written once the submission of the message succeeded
+            state_store.stage(args.get('message_id'), key, {'packages': packages})
+        elif self.change_type in ['snapshot', 'CREATE']:
+            # No index to compare with, we submit all packages we found, in
+            # case we missed something
+            rows = index_rows(packages or {})
+        else:
+            # Updates without index: only what AWS Config tells us changed
+            rows = self._package_change_rows()
+
+        if not rows:
+            logging.debug("No package changes for %s" % self.asset_tag)
+            return
+
+        logging.debug("Submitting %s package changes for %s" % (len(rows), self.asset_tag))
+        self._submit_rows(rows, args)
+
+    def _package_change_rows(self):
+        '''Returns the (package, version) rows of the configurationItemDiff'''
+        rows = []
+        for package_change in self.package_changes:
+            if package_change['changeType'] == 'CREATE':
+                rows.append((package_change['updatedValue']['Name'], package_version(package_change['updatedValue'])))
+            elif package_change['changeType'] == 'DELETE':
+                # Deleted packages are highlighted and processed with a prepended "-"
+                rows.append(("-{}".format(package_change['previousValue']['Name']), package_version(package_change['previousValue'])))
+            elif package_change['changeType'] == 'UPDATE':
+                # A new version of the package, the row gets updated
+                if package_change.get('updatedValue') is not None:
+                    rows.append((package_change['updatedValue']['Name'], package_version(package_change['updatedValue'])))
+        return rows
+
+    def _submit_rows(self, rows, args):
+        '''Sends a row per package, batched via insertMultiple'''
+        data = self.snow_data()
+        submitter = args.get('snow_submitter')
+        if submitter is not None:
+            for package_name, version in rows:
+                submitter.add(self._get_snow_table(), dict(data, u_package=package_name, u_version=version), args.get('message_id'))
+            return
+
+        # No shared submitter, e.g. SNS. Use our own so the rows still go in
+        # chunks instead of a POST per package
+        submitter = SnowBatchSubmitter(args, workers=1)
+        for package_name, version in rows:
+            submitter.add(self._get_snow_table(), dict(data, u_package=package_name, u_version=version))
+        failed = [result for result in submitter.flush() if not result.ok]
+        if failed:
+            raise SnowSubmissionError("Failed to submit %s of %s packages of %s: %s" % (len(failed), len(rows), self.asset_tag, failed[0].message))
+
+
+def package_version(package):
+    '''Returns the version of a package as we store it in SNOW'''
+    if 'Release' in package:
+        return "{}-{}".format(package['Version'], package['Release'])
+    return package['Version']
+
+
+def index_rows(index):
+    '''Returns a (package, version) row for every package in the index'''
+    return [(package_name, version) for package_name in sorted(index) for version in index[package_name]]
+
+
+def diff_package_indexes(old, new):
+    '''Returns the (package, version) rows that turn old into new: added
+    packages and versions, new versions and removed packages, the latter
+    prepended with a "-"'''
+    rows = []
+    for package_name in sorted(set(old) | set(new)):
+        old_versions = old.get(package_name, [])
+        new_versions = new.get(package_name, [])
+        if old_versions == new_versions:
+            continue
+
+        for version in new_versions:
+            if version not in old_versions:
+                rows.append((package_name, version))
+
+        # A single version package that got another version is an update of
+        # its row, nothing to remove
+        if len(old_versions) == 1 and len(new_versions) == 1:
+            continue
+        for version in old_versions:
+            if version not in new_versions:
+                rows.append(("-{}".format(package_name), version))
+    return rows
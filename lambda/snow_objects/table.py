@@ -0,0 +1,92 @@
+# Reading SNOW tables via the Table API
+# iter_table_records pages through the records of a query sorted by a key
+# field. Pages are fetched by key, "key>last key of the previous page",
+# instead of with sysparm_offset: SNOW has to skip every row before the
+# offset, deep pages of a big table get slower and slower. Rows written while
+# we page are neither skipped nor seen twice because of shifting offsets.
+# Keys like asset_tag aren't unique, the records of the last key of a full
+# page are read by "key=last key" and sys_id before the next page.
+from . import jsonlib
+from .client import get_snow_client
+from .errors import SnowQueryError
+
+DEFAULT_PAGE_SIZE = 5000
+
+
+def table_path(table):
+    return "/api/now/table/{}".format(table)
+
+
+def query_value(value):
+    '''Escapes a value for an encoded query, ^ separates the conditions'''
+    return str(value).replace('^', '^^')
+
+
+def iter_table_records(args, table, conditions, fields, key_field, page_size=DEFAULT_PAGE_SIZE):
+    '''Yields the records of table matching the encoded query conditions,
+    e.g. ['u_account_id=123'], as dicts of the raw values of fields, sorted
+    by key_field and sys_id. Records without key_field are left out'''
+    fields = list(fields)
+    for field in [key_field, 'sys_id']:
+        if field not in fields:
+            fields.append(field)
+    conditions = list(conditions) + ['{}ISNOTEMPTY'.format(key_field)]
+    if key_field == 'sys_id':
+        # Unique, nothing to break ties with
+        for record in _iter_sorted(args, table, conditions, fields, 'sys_id', page_size):
+            yield record
+        return
+
+    last = None
+    while True:
+        page_conditions = conditions + (['{}>{}'.format(key_field, query_value(last))] if last is not None else [])
+        records = _query(args, table, page_conditions, fields, [key_field, 'sys_id'], page_size)
+        for record in records:
+            yield record
+        if len(records) < page_size:
+            return
+
+        # Keys aren't unique, more records of the last key can follow the
+        # page. They come by sys_id before the next page by key
+        last = records[-1][key_field]
+        tie_conditions = conditions + ['{}={}'.format(key_field, query_value(last))]
+        for record in _iter_sorted(args, table, tie_conditions, fields, 'sys_id', page_size, after=records[-1]['sys_id']):
+            yield record
+
+
+def _iter_sorted(args, table, conditions, fields, order_field, page_size, after=None):
+    '''Yields the records matching conditions sorted by order_field, which
+    has to be unique, starting after the value after'''
+    while True:
+        page_conditions = list(conditions) + (['{}>{}'.format(order_field, query_value(after))] if after is not None else [])
+        records = _query(args, table, page_conditions, fields, [order_field], page_size)
+        for record in records:
+            yield record
+        if len(records) < page_size:
+            return
+        after = records[-1][order_field]
+
+
+def _query(args, table, conditions, fields, order_fields, page_size):
+    '''Returns a page of the records matching conditions sorted by
+    order_fields'''
+    params = {
+        'sysparm_query': '^'.join(list(conditions) + ['ORDERBY{}'.format(field) for field in order_fields]),
+        'sysparm_fields': ','.join(fields),
+        'sysparm_limit': str(page_size),
+        'sysparm_display_value': 'false',
+        'sysparm_exclude_reference_link': 'true',
+        # Counting all matches costs SNOW a second query per page
+        'sysparm_no_count': 'true',
+    }
+    try:
+        response = get_snow_client(args).get(table_path(table), args, params)
+    except Exception as e:
+        raise SnowQueryError("Failed to query SNOW table %s: %s" % (table, e))
+    if response.status_code != 200:
+        raise SnowQueryError("SNOW responded with status code %s to a query of table %s" % (response.status_code, table))
+
+    try:
+        return jsonlib.loads(response.content)['result']
+    except (ValueError, KeyError) as e:
+        raise SnowQueryError("SNOW answered a query of table %s with an invalid document: %s" % (table, e))
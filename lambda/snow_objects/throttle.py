@@ -0,0 +1,73 @@
+# Process wide rate limiting of SNOW requests
+# All worker threads share one token bucket per SNOW instance. When SNOW
+# answers with 429/503 and a Retry-After header the whole bucket is paused,
+# so the other threads don't keep hammering the instance either
+import email.utils
+import threading
+import time
+
+# Pause if SNOW throttles us without telling us for how long
+DEFAULT_RETRY_AFTER = 1
+# Never wait longer than this on a single Retry-After header
+MAX_RETRY_AFTER = 60
+
+
+class TokenBucket():
+    '''Token bucket with rate tokens per second. A rate of 0/None disables
+    the limit, pauses are honored nonetheless'''
+    def __init__(self, rate=None, burst=None):
+        self.rate = float(rate or 0)
+        self.capacity = float(burst or max(1, self.rate))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        '''Blocks until a request may be sent'''
+        while True:
+            wait = self.reserve()
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def reserve(self):
+        '''Takes a token without blocking. Returns 0 if it got one, otherwise
+        the seconds to wait before trying again. For callers that can't
+        block, e.g. asyncio tasks'''
+        with self._lock:
+            now = time.monotonic()
+            wait = self._paused_until - now
+            if wait > 0:
+                return wait
+            if not self.rate:
+                return 0
+
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    def pause(self, seconds):
+        '''No token is handed out for the next seconds'''
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+def parse_retry_after(value):
+    '''Returns the seconds of a Retry-After header, which is either a number
+    of seconds or a HTTP date'''
+    if not value:
+        return DEFAULT_RETRY_AFTER
+
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = email.utils.mktime_tz(email.utils.parsedate_tz(value)) - time.time()
+        except TypeError:
+            return DEFAULT_RETRY_AFTER
+
+    return min(max(seconds, 0), MAX_RETRY_AFTER)
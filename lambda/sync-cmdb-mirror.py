@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+# Keeps a CMDB mirror current, see aws_pipeline/cmdb_mirror.py. Syncs the
+# mirror file, a full load the first time and deltas by sys_updated_on after
+# that, and uploads it to S3 for lambdas to seed their mirror from. Meant to
+# run every few minutes, e.g.
+#   sync-cmdb-mirror.py --cmdb-mirror sqlite:///var/lib/snow/cmdb-mirror.db --upload s3://my-bucket/cmdb-mirror.db \
+#       --snow-hostname example.service-now.com --snow-user ... --snow-password ...
+import argparse
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+
+from snow_objects.client import log_pool_stats  # noqa: E402
+from snow_objects.table import DEFAULT_PAGE_SIZE  # noqa: E402
+from aws_pipeline.cmdb_mirror import DEFAULT_FULL_SYNC_SECONDS, DEFAULT_PARTITIONS, CmdbMirror  # noqa: E402
+from aws_pipeline.metrics import metrics  # noqa: E402
+
+
+def sync(args):
+    url = args['cmdb_mirror_url']
+    if not url.startswith('sqlite://'):
+        raise ValueError("Unsupported CMDB mirror %s" % url)
+
+    mirror = CmdbMirror(url[len('sqlite://'):], args, partitions=args['partitions'], full_sync_seconds=args['full_sync_seconds'],
+                        page_size=args['page_size'])
+    try:
+        fetched = mirror.sync(full=args.get('full'))
+        logging.info("Synced the CMDB mirror: %s" % fetched)
+        if args.get('upload'):
+            mirror.upload(args['upload'])
+    finally:
+        mirror.close()
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Sync the local CMDB mirror')
+    parser.add_argument('--debug', '-d', dest='debug', action='store_true', required=False, help='Enable debugging output')
+    parser.add_argument('--cmdb-mirror', dest='cmdb_mirror_url', required=True, help='Mirror to sync, sqlite:///path/to/file.db')
+    parser.add_argument('--upload', dest='upload', default='', required=False, help='s3://bucket/key to copy the synced mirror to')
+    parser.add_argument('--full', dest='full', action='store_true', required=False, help='Load the tables completely, drops records deleted in SNOW')
+    parser.add_argument('--full-sync-seconds', dest='full_sync_seconds', type=int, default=DEFAULT_FULL_SYNC_SECONDS, required=False, help='Load the tables completely if the last full load is older')
+    parser.add_argument('--partitions', dest='partitions', type=int, default=DEFAULT_PARTITIONS, required=False, help='sys_id ranges a full load reads in parallel')
+    parser.add_argument('--page-size', dest='page_size', type=int, default=DEFAULT_PAGE_SIZE, required=False, help='CMDB records per Table API request')
+    parser.add_argument('--snow-hostname', '-n', dest='snow_hostname', default='', required=True, help='SNOW hostname, HOSTNAME in https://HOSTNAME/, no https etc.')
+    parser.add_argument('--snow-scheme', dest='snow_scheme', default='https', required=False, help='https, or http for a local SNOW stand-in')
+    parser.add_argument('--snow-user', '-u', dest='snow_user', default='', required=True, help='SNOW API User')
+    parser.add_argument('--snow-password', '-p', dest='snow_password', default='', required=True, help='SNOW API Password')
+    parser.add_argument('--snow-rate-limit', dest='snow_rate_limit', type=float, default=0, required=False, help='Max. SNOW requests per second, 0 for no limit')
+    return vars(parser.parse_args())
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    # One connection per partition
+    args['snow_workers'] = args['partitions']
+    logging.basicConfig(level=logging.DEBUG if args['debug'] else logging.INFO,
+                        format="[%(levelname)8s:%(filename)25s:%(lineno)4s - %(funcName)45s()] %(message)s")
+    try:
+        sync(args)
+    finally:
+        log_pool_stats()
+        metrics.flush()
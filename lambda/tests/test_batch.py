@@ -0,0 +1,105 @@
+import json
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from snow_objects.batch import ROW_REJECTED_STATUS_CODES, SnowBatchSubmitter, chunk_path, row_path  # noqa: E402
+
+
+class Response():
+    def __init__(self, status_code, result=None):
+        self.status_code = status_code
+        self.text = json.dumps({'result': result})
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class Client():
+    '''Answers insertMultiple calls with chunk_status and single rows with
+    201, or 400 for rows named "broken"'''
+    def __init__(self, chunk_status=201):
+        self.chunk_status = chunk_status
+        self.posts = []
+
+    def post(self, path, args, data):
+        body = json.loads(data)
+        self.posts.append((path, body))
+        if path.endswith('/insertMultiple'):
+            if self.chunk_status != 201:
+                return Response(self.chunk_status)
+            return Response(201, [{'status': 'inserted', 'sys_id': record['name']} for record in body['records']])
+        if body['name'] == 'broken':
+            return Response(400)
+        return Response(201, {'status': 'inserted', 'sys_id': body['name']})
+
+
+def submit(client, names, **kwargs):
+    '''Submits a row per name to u_table, returns the results'''
+    submitter = SnowBatchSubmitter({'snow_hostname': 'snow.example.com'}, **kwargs)
+    with mock.patch('snow_objects.batch.get_snow_client', lambda args: client):
+        for name in names:
+            submitter.add('u_table', {'name': name}, tag=name)
+        results = submitter.flush()
+    submitter.shutdown()
+    return results
+
+
+def chunks(client):
+    '''Names of the rows of each insertMultiple call'''
+    return [[record['name'] for record in body['records']] for path, body in client.posts if path == chunk_path('u_table')]
+
+
+def single_rows(client):
+    return [body['name'] for path, body in client.posts if path == row_path('u_table')]
+
+
+class SnowBatchSubmitterTest(unittest.TestCase):
+    def test_chunks_split_by_size(self):
+        client = Client()
+        names = ['r%s' % index for index in range(5)]
+        results = submit(client, names, batch_size=2)
+        self.assertEqual(chunks(client), [['r0', 'r1'], ['r2', 'r3'], ['r4']])
+        self.assertEqual([(result.tag, result.ok, result.sys_id) for result in results], [(name, True, name) for name in names])
+
+    def test_chunks_split_by_bytes(self):
+        client = Client()
+        names = ['r%s-%s' % (index, 'x' * 40) for index in range(5)]
+        # {"name": "..."} is about 55 bytes, two rows don't fit
+        submit(client, names, batch_size=100, batch_bytes=100)
+        self.assertEqual(chunks(client), [[name] for name in names])
+
+        client = Client()
+        submit(client, names, batch_size=100, batch_bytes=120)
+        self.assertEqual(chunks(client), [names[0:2], names[2:4], names[4:]])
+
+    def test_rejected_chunk_falls_back_to_single_rows(self):
+        for status_code in ROW_REJECTED_STATUS_CODES:
+            client = Client(chunk_status=status_code)
+            results = submit(client, ['a', 'broken', 'c'])
+            self.assertEqual(chunks(client), [['a', 'broken', 'c']])
+            self.assertEqual(single_rows(client), ['a', 'broken', 'c'])
+            self.assertEqual([(result.tag, result.ok) for result in results], [('a', True), ('broken', False), ('c', True)], status_code)
+
+    def test_failed_chunk_fails_every_row(self):
+        for status_code in [401, 500, 503]:
+            client = Client(chunk_status=status_code)
+            results = submit(client, ['a', 'b'])
+            self.assertEqual(chunks(client), [['a', 'b']])
+            self.assertEqual(single_rows(client), [])
+            self.assertEqual([(result.tag, result.ok) for result in results], [('a', False), ('b', False)])
+            self.assertIn(str(status_code), results[0].message)
+
+    def test_client_errors_fail_every_row(self):
+        client = Client()
+        client.post = mock.Mock(side_effect=RuntimeError("SNOW is down"))
+        results = submit(client, ['a', 'b'])
+        self.assertEqual(client.post.call_count, 1)
+        self.assertEqual([(result.tag, result.ok, result.message) for result in results], [('a', False, 'SNOW is down'), ('b', False, 'SNOW is down')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from aws_pipeline.coalesce import coalesce_messages  # noqa: E402
+
+
+def notification(resource_id, capture_time, state_id, change_type='UPDATE', resource_type='AWS::EC2::Instance', status='OK'):
+    return {
+        'messageType': 'ConfigurationItemChangeNotification',
+        'configurationItemDiff': {'changeType': change_type},
+        'configurationItem': {
+            'resourceType': resource_type,
+            'resourceId': resource_id,
+            'awsAccountId': '123456789012',
+            'awsRegion': 'us-east-1',
+            'configurationItemCaptureTime': '2026-10-17T%s.000Z' % capture_time,
+            'configurationStateId': state_id,
+            'configurationItemStatus': status,
+        },
+    }
+
+
+def oversized(resource_id, capture_time, state_id, change_type='UPDATE'):
+    return {
+        'messageType': 'OversizedConfigurationItemChangeNotification',
+        'configurationItemSummary': {
+            'changeType': change_type,
+            'resourceType': 'AWS::EC2::Instance',
+            'resourceId': resource_id,
+            'awsAccountId': '123456789012',
+            'awsRegion': 'us-east-1',
+            'configurationItemCaptureTime': '2026-10-17T%s.000Z' % capture_time,
+            'configurationStateId': state_id,
+        },
+    }
+
+
+def coalesced(messages, coalesce_diffs=False):
+    '''Returns the ids of the messages to process and of the superseded ones'''
+    keep, superseded = coalesce_messages(list(enumerate(messages)), coalesce_diffs=coalesce_diffs)
+    return [message_id for message_id, message in keep], superseded
+
+
+class CoalesceTest(unittest.TestCase):
+    def test_newest_update_of_a_resource_wins(self):
+        messages = [
+            notification('i-1', '10:00:00', 1),
+            notification('i-2', '10:00:00', 1),
+            notification('i-1', '10:05:00', 2),
+            notification('i-1', '10:01:00', 3),
+        ]
+        self.assertEqual(coalesced(messages), ([1, 2], [0, 3]))
+
+    def test_state_id_orders_updates_of_the_same_second(self):
+        messages = [notification('i-1', '10:00:00', 9), notification('i-1', '10:00:00', 10)]
+        self.assertEqual(coalesced(messages), ([1], [0]))
+        # Not as strings, 9 < 10
+        self.assertEqual(coalesced(list(reversed(messages))), ([0], [1]))
+
+    def test_redelivery_keeps_the_last_one(self):
+        messages = [notification('i-1', '10:00:00', 1), notification('i-1', '10:00:00', 1)]
+        self.assertEqual(coalesced(messages), ([1], [0]))
+
+    def test_deletes_always_go_through(self):
+        messages = [
+            notification('i-1', '10:00:00', 1, change_type='DELETE', status='ResourceDeleted'),
+            notification('i-1', '10:05:00', 2, change_type='DELETE', status='ResourceDeleted'),
+        ]
+        self.assertEqual(coalesced(messages), ([0, 1], []))
+
+    def test_update_older_than_a_delete_is_dropped(self):
+        for order in [[0, 1], [1, 0]]:
+            messages = [
+                notification('i-1', '10:00:00', 1),
+                notification('i-1', '10:05:00', 2, change_type='DELETE', status='ResourceDeleted'),
+            ]
+            messages = [messages[index] for index in order]
+            update = order.index(0)
+            delete = order.index(1)
+            self.assertEqual(coalesced(messages), ([delete], [update]), "order %s" % order)
+
+    def test_update_newer_than_a_delete_is_kept(self):
+        messages = [
+            notification('i-1', '10:05:00', 2, change_type='DELETE', status='ResourceDeleted'),
+            notification('i-1', '10:10:00', 3),
+        ]
+        self.assertEqual(coalesced(messages), ([0, 1], []))
+
+    def test_deleted_status_without_diff(self):
+        messages = [notification('i-1', '10:00:00', 1), notification('i-1', '10:05:00', 2, change_type=None, status='ResourceDeletedNotRecorded')]
+        self.assertEqual(coalesced(messages), ([1], [0]))
+
+    def test_oversized_notifications_take_part(self):
+        messages = [oversized('i-1', '10:00:00', 1), notification('i-1', '10:05:00', 2), oversized('i-1', '10:10:00', 3, change_type='DELETE')]
+        self.assertEqual(coalesced(messages), ([2], [0, 1]))
+
+    def test_resources_are_per_type(self):
+        messages = [notification('i-1', '10:00:00', 1), notification('i-1', '10:05:00', 2, resource_type='AWS::EC2::Volume')]
+        self.assertEqual(coalesced(messages), ([0, 1], []))
+
+    def test_diff_resource_types_only_with_coalesce_diffs(self):
+        messages = [notification('i-1', '10:00:00', 1, resource_type='AWS::SSM::ManagedInstanceInventory'),
+                    notification('i-1', '10:05:00', 2, resource_type='AWS::SSM::ManagedInstanceInventory')]
+        self.assertEqual(coalesced(messages), ([0, 1], []))
+        self.assertEqual(coalesced(messages, coalesce_diffs=True), ([1], [0]))
+
+    def test_other_messages_pass(self):
+        messages = [{'messageType': 'ConfigurationSnapshotDeliveryCompleted'}, {'messageType': 'ConfigurationItemChangeNotification'},
+                    notification('i-1', '10:00:00', 1)]
+        self.assertEqual(coalesced(messages), ([0, 1, 2], []))
+
+    def test_nothing_superseded_returns_the_messages(self):
+        messages = list(enumerate([notification('i-1', '10:00:00', 1)]))
+        self.assertIs(coalesce_messages(messages)[0], messages)
+
+
+if __name__ == '__main__':
+    unittest.main()
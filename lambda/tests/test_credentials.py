@@ -0,0 +1,87 @@
+import base64
+import json
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from aws_pipeline import credentials  # noqa: E402
+from aws_pipeline.credentials import DEFAULT_SECRET_TTL, MIN_REFRESH_INTERVAL, get_cached_secret  # noqa: E402
+
+
+class SecretsManagerClient():
+    '''Hands out the password password-<n> on the n-th call'''
+    def __init__(self, binary=False):
+        self.binary = binary
+        self.calls = 0
+
+    def get_secret_value(self, SecretId):
+        self.calls += 1
+        secret = json.dumps({'snow_password': 'password-%s' % self.calls})
+        if self.binary:
+            return {'SecretBinary': base64.b64encode(secret.encode('utf-8'))}
+        return {'SecretString': secret}
+
+
+class GetCachedSecretTest(unittest.TestCase):
+    def setUp(self):
+        self.client = SecretsManagerClient()
+        self.now = 1000.0
+        patches = [
+            mock.patch.dict(credentials._clients, {'us-east-1': self.client}, clear=True),
+            mock.patch.dict(credentials._secrets, clear=True),
+            mock.patch('aws_pipeline.credentials.time.time', lambda: self.now),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def password(self, **kwargs):
+        return get_cached_secret('snow', 'us-east-1', **kwargs)['snow_password']
+
+    def test_secret_is_cached_until_the_ttl_expires(self):
+        self.assertEqual(self.password(), 'password-1')
+        self.now += DEFAULT_SECRET_TTL - 1
+        self.assertEqual(self.password(), 'password-1')
+        self.now += 1
+        self.assertEqual(self.password(), 'password-2')
+        self.assertEqual(self.client.calls, 2)
+
+    def test_custom_ttl(self):
+        self.assertEqual(self.password(ttl=10), 'password-1')
+        self.now += 10
+        self.assertEqual(self.password(ttl=10), 'password-2')
+
+    def test_forced_refresh(self):
+        self.assertEqual(self.password(), 'password-1')
+        self.now += MIN_REFRESH_INTERVAL
+        self.assertEqual(self.password(force_refresh=True), 'password-2')
+        self.assertEqual(self.password(), 'password-2')
+
+    def test_forced_refresh_right_after_a_fetch_is_skipped(self):
+        self.assertEqual(self.password(), 'password-1')
+        # Every thread that got a 401 with the rotated password refreshes
+        for _ in range(10):
+            self.now += 0.1
+            self.assertEqual(self.password(force_refresh=True), 'password-1')
+        self.assertEqual(self.client.calls, 1)
+        self.now += MIN_REFRESH_INTERVAL
+        self.assertEqual(self.password(force_refresh=True), 'password-2')
+
+    def test_secrets_are_cached_per_name_and_region(self):
+        other = SecretsManagerClient()
+        credentials._clients['eu-west-1'] = other
+        self.assertEqual(self.password(), 'password-1')
+        self.assertEqual(get_cached_secret('snow', 'eu-west-1')['snow_password'], 'password-1')
+        self.assertEqual(get_cached_secret('other', 'us-east-1')['snow_password'], 'password-2')
+        self.assertEqual((self.client.calls, other.calls), (2, 1))
+
+    def test_binary_secret(self):
+        credentials._clients['us-east-1'] = SecretsManagerClient(binary=True)
+        self.assertEqual(self.password(), 'password-1')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import io
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from aws_pipeline.metrics import MAX_VALUES_PER_DOCUMENT, MetricsRecorder  # noqa: E402
+
+
+def flushed(recorder):
+    '''Flushes the recorder, returns the documents it wrote'''
+    recorder.output = io.StringIO()
+    recorder.flush()
+    return [json.loads(line) for line in recorder.output.getvalue().splitlines()]
+
+
+class MetricsRecorderTest(unittest.TestCase):
+    def test_emf_structure(self):
+        recorder = MetricsRecorder(namespace='Test')
+        recorder.count('SnowRows', 3, table='u_table', outcome='ok')
+        recorder.record('SubmitTime', 12.34567, 'Milliseconds', {'table': 'u_table', 'outcome': 'ok'})
+        documents = flushed(recorder)
+        self.assertEqual(len(documents), 1)
+        document = documents[0]
+        self.assertIsInstance(document['_aws']['Timestamp'], int)
+        self.assertEqual(document['_aws']['CloudWatchMetrics'], [{
+            'Namespace': 'Test',
+            'Dimensions': [['outcome', 'table']],
+            'Metrics': [{'Name': 'SnowRows', 'Unit': 'Count'}, {'Name': 'SubmitTime', 'Unit': 'Milliseconds'}],
+        }])
+        self.assertEqual((document['table'], document['outcome']), ('u_table', 'ok'))
+        self.assertEqual((document['SnowRows'], document['SubmitTime']), (3, 12.346))
+
+    def test_documents_split_at_max_values(self):
+        recorder = MetricsRecorder()
+        values = 2 * MAX_VALUES_PER_DOCUMENT + 50
+        for value in range(values):
+            recorder.record('SubmitTime', value, 'Milliseconds', {'table': 'u_table'})
+            recorder.count('SnowRows', table='u_table')
+        documents = flushed(recorder)
+        self.assertEqual([len(document['SubmitTime']) for document in documents], [MAX_VALUES_PER_DOCUMENT, MAX_VALUES_PER_DOCUMENT, 50])
+        self.assertEqual(sum([document['SubmitTime'] for document in documents], []), list(range(values)))
+        # Counters are summed up in the first document
+        self.assertEqual([document.get('SnowRows') for document in documents], [values, None, None])
+        self.assertEqual([[metric['Name'] for metric in document['_aws']['CloudWatchMetrics'][0]['Metrics']] for document in documents],
+                         [['SubmitTime', 'SnowRows'], ['SubmitTime'], ['SubmitTime']])
+        for document in documents:
+            self.assertEqual(document['table'], 'u_table')
+            self.assertEqual(document['_aws']['CloudWatchMetrics'][0]['Dimensions'], [['table']])
+
+    def test_document_per_dimension_set(self):
+        recorder = MetricsRecorder()
+        recorder.count('SnowRows', table='a')
+        recorder.count('SnowRows', table='b')
+        recorder.count('Invocations')
+        documents = sorted(flushed(recorder), key=lambda document: document.get('table', ''))
+        self.assertEqual([(document.get('table'), document['_aws']['CloudWatchMetrics'][0]['Dimensions']) for document in documents],
+                         [(None, [[]]), ('a', [['table']]), ('b', [['table']])])
+
+    def test_flush_takes_the_values(self):
+        recorder = MetricsRecorder()
+        recorder.count('SnowRows')
+        self.assertEqual(len(flushed(recorder)), 1)
+        self.assertEqual(flushed(recorder), [])
+
+    def test_disabled(self):
+        recorder = MetricsRecorder(enabled=False)
+        recorder.count('SnowRows')
+        with recorder.timer('SubmitTime'):
+            pass
+        self.assertEqual(flushed(recorder), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
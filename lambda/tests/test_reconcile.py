@@ -0,0 +1,102 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from aws_pipeline.reconcile import SnapshotRow, merge_join, scope_records, snapshot_scope, snapshot_time  # noqa: E402
+from snow_objects.errors import SnowQueryError  # noqa: E402
+
+
+def rows(*resource_ids):
+    return [SnapshotRow(resource_id.lower(), resource_id, {'asset_tag': resource_id}) for resource_id in resource_ids]
+
+
+def records(*resource_ids):
+    return [{'asset_tag': resource_id, 'sys_id': '%032x' % index} for index, resource_id in enumerate(resource_ids)]
+
+
+def joined(snapshot, cmdb):
+    '''Returns the join as (row resource_id, record sys_id) pairs'''
+    return [(row.resource_id if row is not None else None, record['sys_id'] if record is not None else None)
+            for row, record in merge_join(snapshot, cmdb, 'asset_tag')]
+
+
+class MergeJoinTest(unittest.TestCase):
+    def test_both_sides(self):
+        cmdb = records('i-1', 'i-3', 'i-4')
+        self.assertEqual(joined(rows('i-1', 'i-2', 'i-4', 'i-5'), cmdb), [
+            ('i-1', cmdb[0]['sys_id']),
+            ('i-2', None),
+            (None, cmdb[1]['sys_id']),
+            ('i-4', cmdb[2]['sys_id']),
+            ('i-5', None),
+        ])
+
+    def test_records_before_and_after_the_snapshot(self):
+        cmdb = records('i-0', 'i-2', 'i-9')
+        self.assertEqual(joined(rows('i-2'), cmdb), [(None, cmdb[0]['sys_id']), ('i-2', cmdb[1]['sys_id']), (None, cmdb[2]['sys_id'])])
+
+    def test_empty_sides(self):
+        self.assertEqual(joined([], []), [])
+        self.assertEqual(joined(rows('i-1', 'i-2'), []), [('i-1', None), ('i-2', None)])
+        cmdb = records('i-1', 'i-2')
+        self.assertEqual(joined([], cmdb), [(None, cmdb[0]['sys_id']), (None, cmdb[1]['sys_id'])])
+
+    def test_keys_are_case_insensitive(self):
+        cmdb = records('I-ABC')
+        self.assertEqual(joined(rows('i-abc'), cmdb), [('i-abc', cmdb[0]['sys_id'])])
+
+    def test_duplicate_records_are_dropped(self):
+        cmdb = records('i-1', 'i-1', 'i-2', 'i-2', 'i-3')
+        # The duplicates of i-2 would be deleted twice otherwise
+        self.assertEqual(joined(rows('i-1', 'i-3'), cmdb), [
+            ('i-1', cmdb[0]['sys_id']),
+            (None, cmdb[2]['sys_id']),
+            ('i-3', cmdb[4]['sys_id']),
+        ])
+
+    def test_duplicate_rows_are_dropped(self):
+        cmdb = records('i-1')
+        # The second i-1 would be created otherwise
+        self.assertEqual(joined(rows('i-1', 'i-1', 'i-2', 'i-2'), cmdb), [('i-1', cmdb[0]['sys_id']), ('i-2', None)])
+
+    def test_unsorted_records(self):
+        with self.assertRaises(SnowQueryError):
+            joined(rows('i-1', 'i-2', 'i-3'), records('i-1', 'i-3', 'i-2'))
+
+    def test_records_are_read_as_the_join_goes(self):
+        read = []
+
+        def cmdb():
+            for record in records('i-1', 'i-2', 'i-3'):
+                read.append(record['asset_tag'])
+                yield record
+
+        join = merge_join(rows('i-1', 'i-2', 'i-3'), cmdb(), 'asset_tag')
+        next(join)
+        self.assertEqual(read, ['i-1'])
+        next(join)
+        self.assertEqual(read, ['i-1', 'i-2'])
+
+
+class ScopeTest(unittest.TestCase):
+    KEY = 'AWSLogs/123456789012/Config/us-east-1/2026/10/17/ConfigSnapshot/123456789012_Config_us-east-1_ConfigSnapshot_20261017T061500Z_uuid.json.gz'
+
+    def test_snapshot_name(self):
+        self.assertEqual(snapshot_scope(self.KEY), ('123456789012', 'us-east-1'))
+        self.assertEqual(snapshot_time(self.KEY), '2026-10-17T06:15:00.000Z')
+        with self.assertRaises(ValueError):
+            snapshot_scope('AWSLogs/123456789012/Config/us-east-1/snapshot.json.gz')
+
+    def test_records_of_another_scope_fail_it(self):
+        scope = {'u_account_id': '123456789012', 'u_region': 'us-east-1'}
+        record = dict(scope, asset_tag='i-1')
+        self.assertEqual(list(scope_records([record], scope, 'asset_tag')), [record])
+        for other in [dict(record, u_region='eu-west-1'), {'asset_tag': 'i-1'}, dict(scope, asset_tag='')]:
+            with self.assertRaises(SnowQueryError):
+                list(scope_records([record, other], scope, 'asset_tag'))
+
+
+if __name__ == '__main__':
+    unittest.main()
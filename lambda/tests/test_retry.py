@@ -0,0 +1,155 @@
+import asyncio
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import requests  # noqa: E402
+
+from snow_objects.async_batch import AsyncSnowClient, SnowResponse  # noqa: E402
+from snow_objects.client import SnowClient  # noqa: E402
+from snow_objects.errors import SnowUnavailableError  # noqa: E402
+from snow_objects.retry import CLOSED, HALF_OPEN, OPEN, CircuitBreaker  # noqa: E402
+
+
+class Response():
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.headers = {}
+
+
+class Session():
+    '''Returns or raises the outcomes in turn'''
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.requests = 0
+
+    def request(self, method, url, **kwargs):
+        self.requests += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return Response(outcome)
+
+
+def failing_refresh():
+    raise RuntimeError("Secrets Manager is down")
+
+
+def client(*outcomes):
+    snow_client = SnowClient('snow.example.com')
+    snow_client.session = Session(*outcomes)
+    return snow_client
+
+
+ARGS = {'snow_user': 'user', 'snow_password': 'password'}
+
+
+@mock.patch('snow_objects.client.time.sleep', lambda seconds: None)
+class SnowClientTest(unittest.TestCase):
+    def test_transport_errors_are_retried(self):
+        snow_client = client(requests.ConnectionError(), requests.Timeout(), 201)
+        self.assertEqual(snow_client.post('/api', dict(ARGS), '{}').status_code, 201)
+        self.assertEqual(snow_client.session.requests, 3)
+        self.assertEqual(snow_client.circuit_breaker.state, CLOSED)
+
+    def test_failing_refresh_is_raised_right_away(self):
+        snow_client = client(*[401] * 10)
+        for _ in range(10):
+            with self.assertRaises(RuntimeError):
+                snow_client.post('/api', dict(ARGS, snow_credentials_refresh=failing_refresh), '{}')
+        self.assertEqual(snow_client.session.requests, 10)
+        self.assertEqual(snow_client.circuit_breaker.state, CLOSED)
+        self.assertEqual(snow_client.circuit_breaker._failures, 0)
+
+    def test_other_errors_are_raised_right_away(self):
+        snow_client = client(ValueError("bug"))
+        with self.assertRaises(ValueError):
+            snow_client.post('/api', dict(ARGS), '{}')
+        self.assertEqual(snow_client.session.requests, 1)
+        self.assertEqual(snow_client.circuit_breaker._failures, 0)
+
+    def test_breaker_opens_after_failed_requests(self):
+        snow_client = client(*[requests.ConnectionError()] * 40)
+        snow_client.circuit_breaker.failure_threshold = 2
+        for _ in range(2):
+            with self.assertRaises(requests.ConnectionError):
+                snow_client.post('/api', dict(ARGS), '{}')
+        self.assertEqual(snow_client.circuit_breaker.state, OPEN)
+        with self.assertRaises(SnowUnavailableError):
+            snow_client.post('/api', dict(ARGS), '{}')
+        # 4 attempts per request
+        self.assertEqual(snow_client.session.requests, 8)
+
+    def test_failing_refresh_hands_the_trial_back(self):
+        snow_client = client(401, 201)
+        breaker = snow_client.circuit_breaker
+        breaker.state = OPEN
+        breaker._opened_at = -breaker.open_seconds
+        with self.assertRaises(RuntimeError):
+            snow_client.post('/api', dict(ARGS, snow_credentials_refresh=failing_refresh), '{}')
+        self.assertEqual(breaker.state, OPEN)
+        # The next request is the trial
+        self.assertEqual(snow_client.post('/api', dict(ARGS), '{}').status_code, 201)
+        self.assertEqual(breaker.state, CLOSED)
+
+
+class AsyncSnowClientTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def post(self, *outcomes):
+        '''Posts with _post_with_refresh returning or raising the outcomes in
+        turn. Returns the client'''
+        snow_client = AsyncSnowClient(dict(ARGS, snow_hostname='async.example.com', snow_workers=1), concurrency=1)
+        outcomes = list(outcomes)
+
+        async def post_with_refresh(url, args, data):
+            outcome = outcomes.pop(0)
+            if isinstance(outcome, BaseException):
+                raise outcome
+            return SnowResponse(outcome, {}, '')
+
+        async def no_sleep(seconds):
+            pass
+
+        snow_client._post_with_refresh = post_with_refresh
+        with mock.patch('snow_objects.async_batch.asyncio.sleep', no_sleep):
+            try:
+                return snow_client, self.loop.run_until_complete(snow_client._post('http://async.example.com/api', dict(ARGS), '{}'))
+            finally:
+                snow_client._executor.shutdown()
+
+    def test_transport_errors_are_retried(self):
+        snow_client, response = self.post(asyncio.TimeoutError(), 201)
+        self.assertEqual(response.status_code, 201)
+
+    def test_other_errors_are_raised_right_away(self):
+        with self.assertRaises(RuntimeError):
+            self.post(RuntimeError("Secrets Manager is down"), 201)
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def test_trial(self):
+        breaker = CircuitBreaker(failure_threshold=1, open_seconds=0)
+        breaker.failure()
+        self.assertEqual(breaker.state, OPEN)
+        breaker.check()
+        self.assertTrue(breaker.is_trial())
+        breaker.abort_trial()
+        self.assertEqual(breaker.state, OPEN)
+        breaker.check()
+        self.assertEqual(breaker.state, HALF_OPEN)
+        breaker.failure()
+        self.assertEqual(breaker.state, OPEN)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from aws_pipeline.s3_cache import STALE_PARTIAL_SECONDS, S3ObjectCache, _key_name  # noqa: E402
+
+
+def put(cache, key, etag, data):
+    '''Caches data as if it got downloaded in two parts'''
+    writer = cache.writer('bucket', key, etag)
+    writer.write(data[:len(data) // 2])
+    writer.write(data[len(data) // 2:])
+    writer.commit()
+
+
+def read(cache, key, etag):
+    cached_file = cache.open('bucket', key, etag)
+    if cached_file is None:
+        return None
+    with cached_file:
+        return cached_file.read()
+
+
+class S3ObjectCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def files(self):
+        return sorted(os.listdir(self.directory))
+
+    def test_hit_and_miss(self):
+        cache = S3ObjectCache(self.directory, 100)
+        self.assertIsNone(cache.etag('bucket', 'a'))
+        put(cache, 'a', '"abc"', b'data')
+        self.assertEqual(cache.etag('bucket', 'a'), '"abc"')
+        self.assertEqual(read(cache, 'a', '"abc"'), b'data')
+        self.assertIsNone(read(cache, 'a', '"def"'))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_least_recently_used_files_are_evicted_by_bytes(self):
+        cache = S3ObjectCache(self.directory, 100)
+        put(cache, 'a', '"a1"', b'a' * 40)
+        put(cache, 'b', '"b1"', b'b' * 40)
+        # a is used more recently than b now
+        self.assertEqual(read(cache, 'a', '"a1"'), b'a' * 40)
+        put(cache, 'c', '"c1"', b'c' * 40)
+        self.assertIsNone(cache.etag('bucket', 'b'))
+        self.assertEqual(cache.etag('bucket', 'a'), '"a1"')
+        self.assertEqual(cache.etag('bucket', 'c'), '"c1"')
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(cache._bytes, 80)
+        self.assertEqual(len(self.files()), 2)
+
+    def test_outdated_etag_is_replaced(self):
+        cache = S3ObjectCache(self.directory, 100)
+        put(cache, 'a', '"a1"', b'old data')
+        put(cache, 'a', '"a2-3"', b'new')
+        self.assertEqual(cache.etag('bucket', 'a'), '"a2-3"')
+        self.assertIsNone(read(cache, 'a', '"a1"'))
+        self.assertEqual(read(cache, 'a', '"a2-3"'), b'new')
+        self.assertEqual(cache._bytes, 3)
+        self.assertEqual(self.files(), ['%s.a2-3' % _key_name('bucket', 'a')])
+
+    def test_oversized_download_is_dropped(self):
+        cache = S3ObjectCache(self.directory, 10)
+        put(cache, 'a', '"a1"', b'x' * 12)
+        self.assertIsNone(cache.etag('bucket', 'a'))
+        self.assertEqual(cache._bytes, 0)
+        self.assertEqual(self.files(), [])
+
+    def test_files_of_a_previous_process_are_picked_up(self):
+        cache = S3ObjectCache(self.directory, 100)
+        put(cache, 'a', '"a1"', b'a' * 10)
+        put(cache, 'b', '"b1"', b'b' * 10)
+        reloaded = S3ObjectCache(self.directory, 100)
+        self.assertEqual(reloaded.etag('bucket', 'a'), '"a1"')
+        self.assertEqual(read(reloaded, 'b', '"b1"'), b'b' * 10)
+        self.assertEqual(reloaded._bytes, 20)
+
+    def test_load_keeps_the_latest_etag_of_a_key(self):
+        name = _key_name('bucket', 'a')
+        for etag_name, age in [('a1', 60), ('a2', 0)]:
+            path = os.path.join(self.directory, '%s.%s' % (name, etag_name))
+            with open(path, 'wb') as cached_file:
+                cached_file.write(b'data')
+            os.utime(path, (time.time() - age, time.time() - age))
+        cache = S3ObjectCache(self.directory, 100)
+        self.assertEqual(cache.etag('bucket', 'a'), '"a2"')
+        self.assertEqual(cache._bytes, 4)
+        self.assertEqual(self.files(), ['%s.a2' % name])
+
+    def test_load_removes_stale_partial_files(self):
+        stale = os.path.join(self.directory, 'partial-stale')
+        fresh = os.path.join(self.directory, 'partial-fresh')
+        for path in [stale, fresh]:
+            with open(path, 'wb') as partial_file:
+                partial_file.write(b'partial')
+        old = time.time() - STALE_PARTIAL_SECONDS - 60
+        os.utime(stale, (old, old))
+        cache = S3ObjectCache(self.directory, 100)
+        # Another process may still be writing the fresh one
+        self.assertEqual(self.files(), ['partial-fresh'])
+        self.assertEqual(cache._bytes, 0)
+        self.assertEqual(len(cache._files), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from aws_pipeline.s3_stream import JsonStreamReader, iter_text  # noqa: E402
+
+# Strings that look like structure, escapes and numbers that end a chunk
+ITEMS = [
+    {'resourceId': 'i-1', 'name': 'plain', 'size': 12345678901234567890},
+    {'resourceId': 'i-2', 'name': '}, {"resourceId": "i-fake"', 'tags': ['[', ']', '{', '}']},
+    {'resourceId': 'i-3', 'name': 'quote \" backslash \\ ', 'path': 'C:\\\\', 'unicode': '\u00e9\u4e2d\U0001f600'},
+    {'resourceId': 'i-4', 'nested': {'resourceId': 'i-inner', 'list': [{'resourceId': 'i-x'}, {'a': [1, 2.5e-3, -7]}]}},
+    {'resourceId': 'i-5', 'empty': {}, 'none': None, 'bools': [True, False], 'number': -0.5},
+]
+
+DOCUMENT = json.dumps({
+    'fileVersion': '1.0',
+    'configSnapshotId': '{[not an array]}',
+    'configurationItems': ITEMS,
+    'trailing': {'configurationItems': 'not this one'},
+})
+
+
+def chunked(text, size):
+    return [text[start:start + size] for start in range(0, len(text), size)]
+
+
+class JsonStreamReaderTest(unittest.TestCase):
+    def test_items_split_across_chunks(self):
+        for size in [1, 2, 3, 7, 64, len(DOCUMENT)]:
+            items = list(JsonStreamReader(chunked(DOCUMENT, size)).iter_array('configurationItems'))
+            self.assertEqual(items, ITEMS, "chunk size %s" % size)
+
+    def test_compact_and_indented_documents(self):
+        for document in [json.dumps({'configurationItems': ITEMS}, separators=(',', ':')),
+                         json.dumps({'configurationItems': ITEMS}, indent=4)]:
+            for size in [1, 5, 100]:
+                self.assertEqual(list(JsonStreamReader(chunked(document, size)).iter_array('configurationItems')), ITEMS)
+
+    def test_number_at_the_end_of_a_chunk(self):
+        document = '{"items": [1234567, 89]}'
+        for size in range(1, len(document) + 1):
+            self.assertEqual(list(JsonStreamReader(chunked(document, size)).iter_array('items')), [1234567, 89])
+
+    def test_empty_and_missing_arrays(self):
+        self.assertEqual(list(JsonStreamReader(['{"items": []}']).iter_array('items')), [])
+        self.assertEqual(list(JsonStreamReader(['{}']).iter_array('items')), [])
+        self.assertEqual(list(JsonStreamReader(['{"other": [1, 2]}']).iter_array('items')), [])
+
+    def test_reads_the_whole_source(self):
+        chunks = iter(chunked(DOCUMENT, 10))
+        list(JsonStreamReader(chunks).iter_array('configurationItems'))
+        self.assertEqual(list(chunks), [])
+
+    def test_truncated_document(self):
+        with self.assertRaises(ValueError):
+            list(JsonStreamReader(chunked(DOCUMENT[:-40], 16)).iter_array('configurationItems'))
+
+    def test_multi_byte_characters_split_between_chunks(self):
+        data = DOCUMENT.encode('utf-8')
+        for size in [1, 2, 3]:
+            text = ''.join(iter_text([data[start:start + size] for start in range(0, len(data), size)]))
+            self.assertEqual(text, DOCUMENT)
+
+
+class ArrayBlocksTest(unittest.TestCase):
+    def blocks(self, document, chunk_size, block_size, key='configurationItems'):
+        return list(JsonStreamReader(chunked(document, chunk_size)).iter_array_blocks(key, block_size))
+
+    def items(self, blocks):
+        items = []
+        for block in blocks:
+            items.extend(json.loads('[' + block + ']'))
+        return items
+
+    def test_blocks_have_every_item_once(self):
+        items = ITEMS * 20
+        document = json.dumps({'fileVersion': '1.0', 'configurationItems': items, 'trailing': 1})
+        for chunk_size in [1, 13, 256, len(document)]:
+            for block_size in [1, 50, 400, 10 ** 6]:
+                blocks = self.blocks(document, chunk_size, block_size)
+                self.assertEqual(self.items(blocks), items, "chunk size %s, block size %s" % (chunk_size, block_size))
+
+    def test_blocks_split_at_item_boundaries(self):
+        items = [{'resourceId': 'i-%s' % index, 'padding': 'x' * 50} for index in range(100)]
+        blocks = self.blocks(json.dumps({'configurationItems': items}), 64, 500)
+        self.assertGreater(len(blocks), 5)
+        self.assertEqual(self.items(blocks), items)
+
+    def test_nested_objects_with_the_same_first_key(self):
+        # "}, {"resourceId":" inside an item isn't the start of the next one
+        items = [{'resourceId': 'i-%s' % index, 'relationships': [{'resourceId': 'vol-1'}, {'resourceId': 'vol-2'}]}
+                 for index in range(50)]
+        for block_size in [1, 30, 200]:
+            self.assertEqual(self.items(self.blocks(json.dumps({'configurationItems': items}), 17, block_size)), items)
+
+    def test_unbalanced_brackets_in_strings(self):
+        items = [{'resourceId': 'i-%s' % index, 'name': '{[' * (index % 3), 'other': ']' * (index % 2)} for index in range(60)]
+        for block_size in [1, 40, 300]:
+            self.assertEqual(self.items(self.blocks(json.dumps({'configurationItems': items}), 9, block_size)), items)
+
+    def test_closing_brackets_in_strings_dont_end_a_block(self):
+        # The brackets outside of strings balance at the "}, {" between the
+        # nested objects if those in the strings are counted
+        items = [{'resourceId': 'i-%s' % index, 'name': ']]', 'path': 'C:\\', 'quote': '\\"[]',
+                  'relationships': [{'resourceId': 'vol-1'}, {'resourceId': 'vol-2'}]} for index in range(50)]
+        document = json.dumps({'configurationItems': items})
+        for chunk_size in [11, len(document)]:
+            for block_size in [1, 30, 200]:
+                blocks = self.blocks(document, chunk_size, block_size)
+                self.assertEqual(self.items(blocks), items)
+                for block in blocks:
+                    self.assertTrue(block.lstrip().startswith('{"resourceId": "i-'), block[:40])
+
+    def test_arrays_of_anything_but_objects(self):
+        items = [1, 'a, {"b": 1}', [1, [2]], None, 2.5, {'resourceId': 'i-1'}]
+        for block_size in [1, 5, 100]:
+            self.assertEqual(self.items(self.blocks(json.dumps({'items': items}), 3, block_size, key='items')), items)
+
+    def test_empty_and_single_item_arrays(self):
+        self.assertEqual(self.blocks('{"configurationItems": []}', 4, 10), [])
+        self.assertEqual(self.items(self.blocks('{"configurationItems": [{"a": 1}]}', 4, 10)), [{'a': 1}])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,181 @@
+import gzip
+import importlib.util
+import io
+import json
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from aws_pipeline.spill import ReplayCheckpoint, latest_rows, replay_state_key, row_key, spill_line, superseded  # noqa: E402
+from aws_pipeline.state_store import payload_hash  # noqa: E402
+from snow_objects.batch import SnowRowResult  # noqa: E402
+
+INSTANCES = 'u_imp_cmdb_ci_ec2_instance'
+PACKAGES = 'u_imp_aws_ec2_software_instance'
+RESOURCE_TYPES = {INSTANCES: 'AWS::EC2::Instance', PACKAGES: 'AWS::SSM::ManagedInstanceInventory'}
+
+
+class NoSuchKey(Exception):
+    def __init__(self):
+        Exception.__init__(self, "NoSuchKey")
+        self.response = {'Error': {'Code': 'NoSuchKey'}}
+
+
+class S3Client():
+    '''Keeps the objects of get_object and put_object in memory'''
+    def __init__(self):
+        self.objects = {}
+
+    def get_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise NoSuchKey()
+        return {'Body': io.BytesIO(self.objects[(Bucket, Key)])}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[(Bucket, Key)] = Body
+
+
+def row(asset_tag, time, **fields):
+    return dict({'u_account_id': '123456789012', 'u_region': 'us-east-1', 'asset_tag': asset_tag,
+                 'u_last_change_update': '2026-10-17 %s' % time}, **fields)
+
+
+def put_segment(s3_client, key, table, rows):
+    s3_client.put_object('bucket', key, gzip.compress(b'\n'.join([spill_line(row_key(table, spilled), spilled) for spilled in rows]) + b'\n'))
+    return key
+
+
+class RowKeyTest(unittest.TestCase):
+    def test_removed_package_replaces_the_row_of_the_package(self):
+        installed = row('i-1', '10:00:00', u_package='bash', u_version='5.1')
+        removed = row('i-1', '10:05:00', u_package='-bash', u_version='5.1')
+        self.assertEqual(row_key(PACKAGES, installed), row_key(PACKAGES, removed))
+        self.assertNotEqual(row_key(PACKAGES, installed), row_key(PACKAGES, dict(installed, u_version='5.2')))
+        self.assertNotEqual(row_key(PACKAGES, installed), row_key(INSTANCES, installed))
+
+    def test_latest_row_of_a_key_wins(self):
+        s3_client = S3Client()
+        segments = [
+            put_segment(s3_client, 'a', PACKAGES, [row('i-1', '10:00:00', u_package='bash', u_version='5.1'),
+                                                   row('i-1', '10:10:00', u_package='zsh', u_version='5.8')]),
+            put_segment(s3_client, 'b', PACKAGES, [row('i-1', '10:05:00', u_package='-bash', u_version='5.1'),
+                                                   row('i-1', '10:00:00', u_package='zsh', u_version='5.8')]),
+        ]
+        self.assertEqual([spilled['u_package'] + ' ' + spilled['u_last_change_update'] for key, spilled in latest_rows(s3_client, 'bucket', segments)],
+                         ['-bash 2026-10-17 10:05:00', 'zsh 2026-10-17 10:10:00'])
+
+    def test_later_segment_wins_at_the_same_time(self):
+        s3_client = S3Client()
+        segments = [
+            put_segment(s3_client, 'a', INSTANCES, [row('i-1', '10:00:00', name='first')]),
+            put_segment(s3_client, 'b', INSTANCES, [row('i-1', '10:00:00', name='second')]),
+        ]
+        self.assertEqual([spilled['name'] for key, spilled in latest_rows(s3_client, 'bucket', segments)], ['second'])
+        self.assertEqual([spilled['name'] for key, spilled in latest_rows(s3_client, 'bucket', list(reversed(segments)))], ['first'])
+
+
+class SupersededTest(unittest.TestCase):
+    def test_state_keys(self):
+        self.assertEqual(replay_state_key(INSTANCES, row('i-1', '10:00:00'), RESOURCE_TYPES), '123456789012/us-east-1/AWS::EC2::Instance/i-1')
+        self.assertEqual(replay_state_key(PACKAGES, row('i-1', '10:00:00', u_package='bash'), RESOURCE_TYPES),
+                         'packages/123456789012/us-east-1/i-1')
+        self.assertIsNone(replay_state_key('u_other', row('i-1', '10:00:00'), RESOURCE_TYPES))
+        self.assertIsNone(replay_state_key(INSTANCES, row('', '10:00:00'), RESOURCE_TYPES))
+
+    def test_package_index(self):
+        stored = {'packages': {'bash': ['5.2'], 'kernel': ['5.10.1', '5.10.2']}}
+        self.assertTrue(superseded(row('i-1', '10:00:00', u_package='bash', u_version='5.1'), stored))
+        self.assertFalse(superseded(row('i-1', '10:00:00', u_package='bash', u_version='5.2'), stored))
+        self.assertFalse(superseded(row('i-1', '10:00:00', u_package='kernel', u_version='5.10.1'), stored))
+        # Installed again since
+        self.assertTrue(superseded(row('i-1', '10:00:00', u_package='-bash', u_version='5.2'), stored))
+        self.assertFalse(superseded(row('i-1', '10:00:00', u_package='-zsh', u_version='5.8'), stored))
+
+    def test_payload_hash(self):
+        spilled = row('i-1', '10:00:00', name='spilled')
+        newer = {'capture_time': '2026-10-17T10:05:00.000Z', 'payload_hash': payload_hash(dict(spilled, name='live'))}
+        self.assertTrue(superseded(spilled, newer))
+        # Same data, whatever the time
+        self.assertFalse(superseded(spilled, dict(newer, payload_hash=payload_hash(spilled))))
+        # Not newer, within the same second the row goes
+        self.assertFalse(superseded(spilled, dict(newer, capture_time='2026-10-17T10:00:00.500Z')))
+        self.assertFalse(superseded(spilled, dict(newer, capture_time='2026-10-17T09:55:00.000Z')))
+        self.assertFalse(superseded(spilled, None))
+
+
+def load_replay():
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'replay-spilled-rows.py')
+    spec = importlib.util.spec_from_file_location('replay_spilled_rows', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class Submitter():
+    '''Stands in for SnowBatchSubmitter, every row is accepted'''
+    added = []
+
+    def __init__(self, args):
+        self.rows = []
+
+    def add(self, table, data, tag=None):
+        self.rows.append((table, tag))
+        Submitter.added.append(data['asset_tag'])
+
+    def flush(self):
+        rows, self.rows = self.rows, []
+        return [SnowRowResult(table, tag, True, 'inserted', None, None) for table, tag in rows]
+
+
+class ReplayTest(unittest.TestCase):
+    def setUp(self):
+        self.s3_client = S3Client()
+        self.replay = load_replay()
+        Submitter.added = []
+
+    def replay_table(self, checkpoint):
+        args = {'spill_url': 's3://bucket/spill', 'snow_batch_size': 1, 'snow_workers': 1}
+        with mock.patch.object(self.replay, 'get_s3_client', lambda: self.s3_client), \
+                mock.patch.object(self.replay, 'SnowBatchSubmitter', Submitter):
+            return self.replay.replay_table(INSTANCES, checkpoint, args)
+
+    def test_checkpoint_is_kept_in_s3(self):
+        checkpoint = ReplayCheckpoint(self.s3_client, 'bucket', 'spill')
+        self.assertEqual(checkpoint.in_progress(INSTANCES), (None, 0))
+        checkpoint.progress(INSTANCES, ['spill/%s/a.ndjson.gz' % INSTANCES], 40)
+        reread = ReplayCheckpoint(self.s3_client, 'bucket', 'spill')
+        self.assertEqual(reread.in_progress(INSTANCES), (['spill/%s/a.ndjson.gz' % INSTANCES], 40))
+        reread.done(INSTANCES, ['spill/%s/a.ndjson.gz' % INSTANCES])
+        reread = ReplayCheckpoint(self.s3_client, 'bucket', 'spill')
+        self.assertEqual(reread.in_progress(INSTANCES), (None, 0))
+        self.assertEqual(reread.replayed(), set(['spill/%s/a.ndjson.gz' % INSTANCES]))
+
+    def test_replay_resumes_from_rows_done(self):
+        segment = put_segment(self.s3_client, 'spill/%s/a.ndjson.gz' % INSTANCES, INSTANCES,
+                              [row('i-%s' % index, '10:00:00') for index in range(6)])
+        checkpoint = ReplayCheckpoint(self.s3_client, 'bucket', 'spill')
+        checkpoint.progress(INSTANCES, [segment], 2)
+        self.assertTrue(self.replay_table(ReplayCheckpoint(self.s3_client, 'bucket', 'spill')))
+        # Sorted by key, the first 2 made it to SNOW before
+        self.assertEqual(Submitter.added, ['i-2', 'i-3', 'i-4', 'i-5'])
+        checkpoint = ReplayCheckpoint(self.s3_client, 'bucket', 'spill')
+        self.assertEqual(checkpoint.in_progress(INSTANCES), (None, 0))
+        self.assertEqual(checkpoint.replayed(), set([segment]))
+
+    def test_progress_is_checkpointed_per_window(self):
+        segment = put_segment(self.s3_client, 'spill/%s/a.ndjson.gz' % INSTANCES, INSTANCES,
+                              [row('i-%s' % index, '10:00:00') for index in range(6)])
+        checkpoint = ReplayCheckpoint(self.s3_client, 'bucket', 'spill')
+        checkpoint.progress(INSTANCES, [segment], 0)
+        saved = []
+        with mock.patch.object(checkpoint, 'save', lambda: saved.append(checkpoint.in_progress(INSTANCES)[1])):
+            self.replay_table(checkpoint)
+        # A window is 4 rows with a batch size and a worker of 1
+        self.assertEqual(saved, [4, 6, 0])
+
+
+if __name__ == '__main__':
+    unittest.main()
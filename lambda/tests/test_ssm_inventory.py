@@ -0,0 +1,42 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from snow_objects.ssm_inventory import diff_package_indexes, index_rows  # noqa: E402
+
+
+class DiffPackageIndexesTest(unittest.TestCase):
+    def test_unchanged(self):
+        index = {'bash': ['5.1-6'], 'kernel': ['5.10.1', '5.10.2']}
+        self.assertEqual(diff_package_indexes(index, dict(index)), [])
+        self.assertEqual(diff_package_indexes({}, {}), [])
+
+    def test_added_and_removed_packages(self):
+        old = {'bash': ['5.1-6'], 'curl': ['7.79']}
+        new = {'bash': ['5.1-6'], 'zsh': ['5.8']}
+        self.assertEqual(diff_package_indexes(old, new), [('-curl', '7.79'), ('zsh', '5.8')])
+
+    def test_new_version_of_a_single_version_package_updates_its_row(self):
+        self.assertEqual(diff_package_indexes({'bash': ['5.1-6']}, {'bash': ['5.2-1']}), [('bash', '5.2-1')])
+
+    def test_multi_version_packages(self):
+        old = {'kernel': ['5.10.1', '5.10.2']}
+        self.assertEqual(diff_package_indexes(old, {'kernel': ['5.10.2', '5.10.3']}), [('kernel', '5.10.3'), ('-kernel', '5.10.1')])
+        self.assertEqual(diff_package_indexes(old, {'kernel': ['5.10.2']}), [('-kernel', '5.10.1')])
+        self.assertEqual(diff_package_indexes({'kernel': ['5.10.2']}, old), [('kernel', '5.10.1')])
+
+    def test_from_and_to_an_empty_index(self):
+        index = {'kernel': ['5.10.1', '5.10.2'], 'bash': ['5.1-6']}
+        self.assertEqual(diff_package_indexes({}, index), index_rows(index))
+        self.assertEqual(diff_package_indexes(index, {}), [('-' + package, version) for package, version in index_rows(index)])
+
+    def test_rows_are_sorted_by_package(self):
+        old = {'b': ['1'], 'd': ['1']}
+        new = {'a': ['1'], 'c': ['1']}
+        self.assertEqual([package.lstrip('-') for package, version in diff_package_indexes(old, new)], ['a', 'b', 'c', 'd'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from aws_pipeline.state_store import SqliteStateStore, payload_hash, resource_key  # noqa: E402
+
+
+def item(resource_id, capture_time, resource_type='AWS::EC2::Instance'):
+    return {
+        'resourceType': resource_type,
+        'resourceId': resource_id,
+        'awsAccountId': '123456789012',
+        'awsRegion': 'us-east-1',
+        'configurationItemCaptureTime': '2026-10-17T%s.000Z' % capture_time,
+    }
+
+
+def data(name, change_type='update'):
+    return {'name': name, 'change_type': change_type}
+
+
+class StateStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = self.open()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def open(self):
+        '''Returns another store on the same file, it reads what got written'''
+        return SqliteStateStore(os.path.join(self.directory, 'state.db'))
+
+    def submit(self, configuration_item, object_data, tag='batch'):
+        '''Submits successfully if the store says so'''
+        if not self.store.should_submit(configuration_item, object_data, tag):
+            return False
+        self.store.commit()
+        return True
+
+    def test_new_and_changed_resources_are_submitted(self):
+        self.assertTrue(self.submit(item('i-1', '10:00:00'), data('a')))
+        self.assertTrue(self.submit(item('i-1', '10:05:00'), data('b')))
+        self.assertEqual(self.open().get(resource_key(item('i-1', '10:05:00'))),
+                         {'capture_time': '2026-10-17T10:05:00.000Z', 'payload_hash': payload_hash(data('b'))})
+
+    def test_stale_capture_time_is_skipped(self):
+        self.assertTrue(self.submit(item('i-1', '10:05:00'), data('a')))
+        self.assertFalse(self.submit(item('i-1', '10:00:00'), data('b')))
+        self.assertEqual(self.store.skipped_stale, 1)
+        self.assertEqual(self.store.get(resource_key(item('i-1', '10:00:00')))['capture_time'], '2026-10-17T10:05:00.000Z')
+
+    def test_unchanged_hash_is_skipped_and_moves_the_watermark(self):
+        self.assertTrue(self.submit(item('i-1', '10:00:00'), data('a')))
+        # The volatile fields don't count
+        self.assertFalse(self.submit(item('i-1', '10:05:00'), data('a', change_type='snapshot')))
+        self.assertEqual(self.store.skipped_unchanged, 1)
+        self.store.flush()
+        self.assertEqual(self.open().get(resource_key(item('i-1', '10:05:00')))['capture_time'], '2026-10-17T10:05:00.000Z')
+        # An item captured between the two is stale now
+        self.assertFalse(self.submit(item('i-1', '10:01:00'), data('b')))
+        self.assertEqual(self.store.skipped_stale, 1)
+
+    def test_staged_records_of_failed_tags_are_dropped(self):
+        self.assertTrue(self.store.should_submit(item('i-1', '10:00:00'), data('a'), 'ok'))
+        self.assertTrue(self.store.should_submit(item('i-2', '10:00:00'), data('a'), 'failed'))
+        self.store.commit(failed_tags=['failed'])
+        reopened = self.open()
+        self.assertIsNotNone(reopened.get(resource_key(item('i-1', '10:00:00'))))
+        self.assertIsNone(reopened.get(resource_key(item('i-2', '10:00:00'))))
+        # Submitted again
+        self.assertTrue(self.store.should_submit(item('i-2', '10:00:00'), data('a'), 'retry'))
+
+    def test_commit_of_some_tags_keeps_the_others_staged(self):
+        self.store.should_submit(item('i-1', '10:00:00'), data('a'), 'first')
+        self.store.should_submit(item('i-2', '10:00:00'), data('a'), 'second')
+        self.store.commit(tags=['first'])
+        self.assertIsNotNone(self.open().get(resource_key(item('i-1', '10:00:00'))))
+        self.assertIsNone(self.open().get(resource_key(item('i-2', '10:00:00'))))
+        self.store.commit(tags=['second'])
+        self.assertIsNotNone(self.open().get(resource_key(item('i-2', '10:00:00'))))
+
+    def test_discarded_records_are_not_written(self):
+        self.store.should_submit(item('i-1', '10:00:00'), data('a'), 'failed')
+        self.store.discard(['failed'])
+        self.store.commit()
+        self.assertIsNone(self.open().get(resource_key(item('i-1', '10:00:00'))))
+        self.assertTrue(self.store.should_submit(item('i-1', '10:00:00'), data('a'), 'retry'))
+
+    def test_resource_types_sharing_a_resource_id_have_separate_keys(self):
+        instance = item('i-1', '10:00:00')
+        inventory = item('i-1', '10:00:00', resource_type='AWS::SSM::ManagedInstanceInventory')
+        self.assertNotEqual(resource_key(instance), resource_key(inventory))
+        self.assertTrue(self.submit(instance, data('a')))
+        self.assertTrue(self.submit(inventory, data('a')))
+        self.assertEqual(self.store.skipped_unchanged, 0)
+
+    def test_prefetch_reads_the_batch_at_once(self):
+        for index in range(3):
+            self.submit(item('i-%s' % index, '10:00:00'), data('a'))
+        store = self.open()
+        keys = [resource_key(item('i-%s' % index, '10:00:00')) for index in range(5)]
+        with mock.patch.object(store, '_load_many', wraps=store._load_many) as load_many, \
+                mock.patch.object(store, '_load', side_effect=AssertionError("read one by one")):
+            store.prefetch(keys + keys)
+            store.prefetch(keys)
+            self.assertEqual(load_many.call_count, 1)
+            self.assertEqual(sorted(load_many.call_args[0][0]), keys)
+            # Known to have no record, not read again
+            self.assertIsNone(store.get(keys[4]))
+            self.assertFalse(store.should_submit(item('i-0', '10:00:00'), data('a'), 'batch'))
+            self.assertTrue(store.should_submit(item('i-4', '10:00:00'), data('a'), 'batch'))
+
+
+if __name__ == '__main__':
+    unittest.main()
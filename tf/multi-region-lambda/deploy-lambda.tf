@@ -15,6 +15,10 @@ resource "aws_lambda_function" "lambda_config_sqs_to_snow" {
       # SNOW_USER     = "${var.snow_user}"
       # SNOW_PASSWORD = "${var.snow_password}"
       SNOW_SECRET   = "${var.snow_secret}"
+      # Snapshot items are sent back to the queue in chunks
+      SNOW_FANOUT_QUEUE_URL = "${aws_sqs_queue.aws_config_queue.id}"
+      # Skip unchanged and out of order configuration items
+      SNOW_STATE_STORE = "dynamodb://${aws_dynamodb_table.snow_resource_state.name}"
     }
   }
 }
@@ -95,7 +99,62 @@ resource "aws_sqs_queue_policy" "allow_sns_to_send_to_sqs" {
   policy    = "${data.aws_iam_policy_document.allow_sns_sendmessage.json}"
 }
 
+# Lambda fans out snapshot items to its own queue
+resource "aws_iam_role_policy" "lambda_sqs_fanout" {
+  name = "lambda_sqs_to_snow_fanout_policy_${var.this_aws_region}"
+  role = "${var.lambda_iam_role_id}"
+
+  policy = <<EOF
+{
+    "Version": "2012-10-17",
+    "Statement": {
+        "Effect": "Allow",
+        "Action": [
+            "sqs:SendMessage"
+        ],
+        "Resource": "${aws_sqs_queue.aws_config_queue.arn}"
+    }
+}
+EOF
+}
+
+#
+# State of the resources submitted to SNOW
+#
+resource "aws_dynamodb_table" "snow_resource_state" {
+  name         = "snow-resource-state"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "resource_key"
+
+  attribute {
+    name = "resource_key"
+    type = "S"
+  }
+}
+
+resource "aws_iam_role_policy" "lambda_state_store" {
+  name = "lambda_sqs_to_snow_state_store_policy_${var.this_aws_region}"
+  role = "${var.lambda_iam_role_id}"
+
+  policy = <<EOF
+{
+    "Version": "2012-10-17",
+    "Statement": {
+        "Effect": "Allow",
+        "Action": [
+            "dynamodb:GetItem",
+            "dynamodb:BatchWriteItem"
+        ],
+        "Resource": "${aws_dynamodb_table.snow_resource_state.arn}"
+    }
+}
+EOF
+}
+
 resource "aws_lambda_event_source_mapping" "sqs_to_lambda_mapping" {
   event_source_arn = "${aws_sqs_queue.aws_config_queue.arn}"
   function_name    = "${aws_lambda_function.lambda_config_sqs_to_snow.arn}"
+
+  # Lambda returns batchItemFailures, only failed messages get redelivered
+  function_response_types = ["ReportBatchItemFailures"]
 }